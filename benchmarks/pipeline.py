@@ -0,0 +1,312 @@
+"""
+End-to-end benchmark of the `ag` pipelines on a synthetic repository.
+
+Generates a git repository of configurable size with `git fast-import`:
+a long history, a huge last commit, a huge staged diff, and many modified
+and untracked files. Then times:
+
+- the building blocks in-process: `git.latest_commits` with a cold and a
+  warm commit index, `git.iter_commits`, `highlight.diff`,
+  `highlight.git_status`, and prompt assembly of `ag ci`
+  (`cmd.commit._get_history` and `cmd.commit._build_prompt`);
+- full `ag review diff --cached`, `ag review range` and `ag ci` runs in a
+  fresh interpreter against the stub LLM backend, so no network is used.
+
+Results are printed as JSON, and written to `--output` if given, so they
+can be compared between releases. With `--compare` the run fails if any
+median is slower than the baseline by more than `--max-regression`.
+
+Usage:
+    python benchmarks/pipeline.py [--commits 2000] [--runs 5] [--output bench.json]
+    python benchmarks/pipeline.py --compare bench.json --max-regression 1.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho sigma tau".split()
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "Bench",
+    "GIT_AUTHOR_EMAIL": "bench@example.com",
+    "GIT_COMMITTER_NAME": "Bench",
+    "GIT_COMMITTER_EMAIL": "bench@example.com",
+    "GIT_EDITOR": "true",
+}
+
+
+def _line(rng: random.Random) -> str:
+    return f"    {rng.choice(WORDS)}_{rng.randrange(1000)} = {rng.choice(WORDS)}({rng.randrange(100)})"
+
+
+def _content(rng: random.Random, lines: int) -> bytes:
+    return ("\n".join(_line(rng) for _ in range(lines)) + "\n").encode("utf-8")
+
+
+def _blob(path: str, content: bytes) -> bytes:
+    return f"M 100644 inline {path}\ndata {len(content)}\n".encode("utf-8") + content + b"\n"
+
+
+def _commit(mark: int, message: str, timestamp: int, changes: list[bytes]) -> bytes:
+    data = message.encode("utf-8")
+    header = (
+        f"commit refs/heads/main\nmark :{mark}\n"
+        f"author Bench <bench@example.com> {timestamp} +0000\n"
+        f"committer Bench <bench@example.com> {timestamp} +0000\n"
+        f"data {len(data)}\n"
+    ).encode("utf-8")
+    parent = f"from :{mark - 1}\n".encode("utf-8") if mark > 1 else b""
+    return header + data + b"\n" + parent + b"".join(changes) + b"\n"
+
+
+def generate_repo(path: Path, args: argparse.Namespace) -> None:
+    """
+    Creates the synthetic repository in `path`.
+    """
+    rng = random.Random(args.seed)
+    env = {**os.environ, **GIT_ENV}
+    paths = [f"src/module_{i // 20}/file_{i}.py" for i in range(args.files)]
+
+    def run(*cmd: str, **kwargs) -> None:
+        subprocess.run(["git", *cmd], cwd=path, env=env, check=True, stdout=subprocess.DEVNULL, **kwargs)
+
+    run("init", "-q", "-b", "main")
+    stream = [_commit(1, "Initial commit\n", 1_600_000_000, [_blob(p, _content(rng, args.file_lines)) for p in paths])]
+    for i in range(2, args.commits):
+        changed = rng.sample(paths, min(3, len(paths)))
+        message = f"Update {', '.join(os.path.basename(p) for p in changed)}\n\n{_line(rng).strip()}\n"
+        stream.append(
+            _commit(i, message, 1_600_000_000 + i * 60, [_blob(p, _content(rng, args.file_lines)) for p in changed])
+        )
+    huge = paths[: args.diff_files]
+    stream.append(
+        _commit(
+            max(args.commits, 2),
+            "Rewrite many files\n",
+            1_600_000_000 + args.commits * 60,
+            [_blob(p, _content(rng, args.diff_lines)) for p in huge],
+        )
+    )
+    run("fast-import", "--quiet", input=b"".join(stream))
+    run("reset", "-q", "--hard")
+
+    # A huge staged diff, unstaged changes and untracked files for `ag st`.
+    for p in huge:
+        (path / p).write_bytes(_content(rng, args.diff_lines))
+    run("add", *huge)
+    for p in paths[args.diff_files : args.diff_files * 2]:
+        with open(path / p, "ab") as f:
+            f.write(_content(rng, 5))
+    for i in range(args.untracked):
+        (path / "scratch").mkdir(exist_ok=True)
+        (path / "scratch" / f"untracked_{i}.txt").write_bytes(_content(rng, 3))
+
+
+def measure(
+    fn: Callable[[], object], runs: int, setup: Optional[Callable[[], None]] = None, warmup: bool = True
+) -> dict:
+    """
+    Returns timing statistics of `fn` over `runs` runs, in milliseconds.
+    """
+    if warmup:
+        if setup:
+            setup()
+        fn()
+    times = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "runs": runs,
+        "min_ms": round(times[0], 2),
+        "median_ms": round(statistics.median(times), 2),
+        "p95_ms": round(times[min(len(times) - 1, round(0.95 * (len(times) - 1)))], 2),
+        "mean_ms": round(statistics.fmean(times), 2),
+    }
+
+
+def bench_library(repo: Path, args: argparse.Namespace) -> dict:
+    from ci import commit_index, git, highlight
+    from ci.cmd import commit
+    from ci.llm import openai
+
+    os.chdir(repo)
+    results = {}
+
+    def drop_index() -> None:
+        for index in commit_index._indexes.values():
+            if index is not None:
+                index._db.close()
+        commit_index._indexes.clear()
+        shutil.rmtree(git.cache_dir(), ignore_errors=True)
+
+    results["git.latest_commits.cold"] = measure(lambda: git.latest_commits(args.history), args.runs, setup=drop_index)
+    results["git.latest_commits.warm"] = measure(lambda: git.latest_commits(args.history), args.runs)
+
+    results["git.iter_commits"] = measure(lambda: next(git.iter_commits(n=1)), args.runs)
+
+    staged = git.cached_diff().text
+    results["highlight.diff"] = measure(lambda: highlight.diff(staged), args.runs)
+    results["highlight.iter_diff"] = measure(lambda: list(highlight.iter_diff(staged.splitlines(True))), args.runs)
+
+    status = subprocess.check_output(["git", "status"], cwd=repo).decode("utf-8")
+    results["highlight.git_status"] = measure(lambda: highlight.git_status(status), args.runs)
+
+    def assemble_prompt() -> None:
+        history = commit._get_history(args.history)
+        commit._build_prompt(staged, history, openai.Models.DEFAULT_MODEL)
+
+    results["cmd.commit.prompt"] = measure(assemble_prompt, args.runs)
+    os.chdir(ROOT)
+    return results
+
+
+def bench_cli(repo: Path, cache_home: Path, args: argparse.Namespace) -> dict:
+    env = {
+        **os.environ,
+        **GIT_ENV,
+        "PYTHONPATH": ROOT,
+        "XDG_CACHE_HOME": str(cache_home),
+        "CI_LLM_BACKEND": "stub",
+        "CI_NO_CACHE": "1",
+        "CI_STUB_LATENCY": str(args.llm_latency),
+        "CI_STUB_CHUNK_LATENCY": str(args.llm_chunk_latency),
+        # Measure the pipeline, not the API rate limits.
+        "CI_REQUESTS_PER_MINUTE": "1000000",
+        "CI_TOKENS_PER_MINUTE": "1000000000",
+    }
+
+    def ag(*argv: str, entry: tuple[str, ...] = ("-m", "ci.ag")) -> Callable[[], None]:
+        cmd = [sys.executable, *entry, *argv]
+        return lambda: subprocess.run(
+            cmd, cwd=repo, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    def undo_commit() -> None:
+        # `ag ci` commits the staged diff, so every run starts from the same state.
+        if subprocess.check_output(["git", "log", "-1", "--format=%s"], cwd=repo).strip() != b"Rewrite many files":
+            subprocess.run(["git", "reset", "-q", "--soft", "HEAD~1"], cwd=repo, check=True)
+
+    range_size = min(args.review_range, args.commits - 1)
+    results = {
+        "ag review diff --cached": measure(ag("review", "diff", "--cached"), args.runs, warmup=False),
+        f"ag review range HEAD~{range_size}..HEAD": measure(
+            ag("review", "range", "--restart", f"HEAD~{range_size}..HEAD"), args.runs, warmup=False
+        ),
+        f"ag ci --history {args.history}": measure(
+            ag("ci", "--history", str(args.history)), args.runs, setup=undo_commit, warmup=False
+        ),
+    }
+
+    # The same review through the `ag` entry point, served by `ag serve`.
+    env["CI_DAEMON_SOCKET"] = str(cache_home / "ag.sock")
+    ag("serve")()
+    try:
+        results["ag review diff --cached (daemon)"] = measure(
+            ag("review", "diff", "--cached", entry=("-c", "from ci.daemon import main; main()")),
+            args.runs,
+            warmup=False,
+        )
+    finally:
+        subprocess.run([sys.executable, "-m", "ci.ag", "serve", "--stop"], cwd=repo, env=env, stderr=subprocess.DEVNULL)
+    return results
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    """
+    Returns the benchmarks whose median regressed beyond `max_regression`.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if before and result["median_ms"] > before["median_ms"] * max_regression:
+            regressions.append(f"{name}: {before['median_ms']} ms -> {result['median_ms']} ms")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commits", type=int, default=2000, help="Number of commits in the history.")
+    parser.add_argument("--files", type=int, default=200, help="Number of tracked files.")
+    parser.add_argument("--file-lines", type=int, default=50, help="Lines per file in regular commits.")
+    parser.add_argument("--diff-files", type=int, default=40, help="Files in the huge commit and staged diff.")
+    parser.add_argument("--diff-lines", type=int, default=500, help="Lines per file in the huge diffs.")
+    parser.add_argument("--untracked", type=int, default=500, help="Number of untracked files.")
+    parser.add_argument("--history", type=int, default=50, help="Commits read by latest_commits and ag ci.")
+    parser.add_argument("--review-range", type=int, default=20, help="Commits reviewed by ag review range.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds before each stub response.")
+    parser.add_argument("--llm-chunk-latency", type=float, default=0.0, help="Seconds between stub chunks.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-cli", action="store_true", help="Only time the in-process building blocks.")
+    parser.add_argument("--output", type=Path, help="Also write the results to this file.")
+    parser.add_argument("--compare", type=Path, help="Baseline results to compare against.")
+    parser.add_argument("--max-regression", type=float, default=1.25, help="Allowed ratio to the baseline median.")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic repository.")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="ci-bench-"))
+    repo = workdir / "repo"
+    repo.mkdir()
+    os.environ["XDG_CACHE_HOME"] = str(workdir / "cache")
+    os.environ["CI_NO_CACHE"] = "1"
+    try:
+        start = time.perf_counter()
+        generate_repo(repo, args)
+        generate_s = time.perf_counter() - start
+
+        results = bench_library(repo, args)
+        if not args.no_cli:
+            results.update(bench_cli(repo, workdir / "cache", args))
+    finally:
+        if args.keep:
+            print(f"Kept {repo}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    git_version = subprocess.check_output(["git", "--version"]).decode("utf-8").strip()
+    revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    report = {
+        "meta": {
+            "revision": revision or None,
+            "python": platform.python_version(),
+            "git": git_version,
+            "platform": platform.platform(),
+            "repo": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "max_regression", "keep")},
+            "generate_s": round(generate_s, 2),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        args.output.write_text(output + "\n")
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
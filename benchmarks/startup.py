@@ -0,0 +1,98 @@
+"""
+Cold start benchmark for the `ag` commands that only shell out to git.
+
+Runs `ag st` and `ag dc` in a fresh interpreter several times and
+compares the median wall time with starting a bare interpreter plus
+running the underlying git command directly. Fails if the overhead of
+`ag` exceeds the budget or if `ag st` imports modules it should only
+import on first use.
+
+Run it from the repository to measure.
+
+Usage:
+    python benchmarks/startup.py [--runs 20] [--max-ms 100]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+    "st": ["git", "status"],
+    "dc": ["git", "diff", "--cached"],
+}
+
+LAZY_MODULES = ["openai", "aiohttp", "pygments", "sqlite3", "ci.llm.openai"]
+"""
+Modules that `ag st` must not import.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def median_ms(cmd: list[str], runs: int) -> float:
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def imported_lazy_modules(command: str) -> list[str]:
+    code = (
+        "import sys\n"
+        "from ci.ag import cli\n"
+        f"cli([{command!r}], standalone_mode=False)\n"
+        f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))\n"
+    )
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    output = subprocess.check_output([sys.executable, "-c", code], env=env, stderr=subprocess.DEVNULL)
+    return output.decode("utf-8").splitlines()[-1].split()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=100,
+        help="Maximum overhead of ag over a bare interpreter and plain git.",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    failed = False
+    python_ms = median_ms([sys.executable, "-c", "pass"], args.runs)
+    for command, git_cmd in COMMANDS.items():
+        ag_ms = median_ms([sys.executable, "-c", "from ci.daemon import main; main()", command], args.runs)
+        git_ms = median_ms(git_cmd, args.runs)
+        overhead_ms = ag_ms - python_ms - git_ms
+        results[command] = {
+            "ag_ms": round(ag_ms, 1),
+            "python_ms": round(python_ms, 1),
+            "git_ms": round(git_ms, 1),
+            "overhead_ms": round(overhead_ms, 1),
+        }
+        if overhead_ms > args.max_ms:
+            print(f"ag {command}: {overhead_ms:.0f} ms overhead exceeds {args.max_ms:.0f} ms", file=sys.stderr)
+            failed = True
+
+    lazy = imported_lazy_modules("st")
+    results["st"]["eager_imports"] = lazy
+    if lazy:
+        print(f"ag st imports {', '.join(lazy)} eagerly", file=sys.stderr)
+        failed = True
+
+    print(json.dumps(results, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,7 @@ from typing import Optional
 
 import click
 
-from ci import cmd
+from ci import cmd, telemetry
 
 LOGGER = logging.getLogger(__name__)
 
@@ -20,21 +20,102 @@ def setup_logging():
     LOGGER.debug("Debug mode enabled")
 
 
+def _disable_cache(ctx: click.Context, param: click.Parameter, value: bool) -> None:
+    if value:
+        from ci.llm import cache
+
+        cache.disable()
+
+
+def no_cache_option(f):
+    return click.option(
+        "--no-cache",
+        is_flag=True,
+        expose_value=False,
+        callback=_disable_cache,
+        help="Bypass the completion cache.",
+    )(f)
+
+
+def _trace(ctx: click.Context) -> None:
+    """
+    Records the run as a span named after the invoked command, e.g.
+    `ag review diff`. Called by every group, since subcommands of nested
+    groups are only known once their group runs.
+    """
+    span = ctx.meta.get("ci.span")
+    if span is None:
+        span = ctx.meta["ci.span"] = ctx.with_resource(telemetry.span("ag"))
+    if ctx.invoked_subcommand:
+        span.name = f"{span.name} {ctx.invoked_subcommand}"
+
+
 @click.group()
-def cli():
+@click.option(
+    "--backend",
+    type=click.Choice(["openai", "stub"]),
+    envvar="CI_LLM_BACKEND",
+    help="Provider of completions. The stub answers offline with deterministic responses.",
+)
+@click.pass_context
+def cli(ctx: click.Context, backend: Optional[str]):
     setup_logging()
-    pass
+    if backend:
+        # Read by `ci.llm.backend`, and inherited by background prefetches.
+        os.environ["CI_LLM_BACKEND"] = backend
+    _trace(ctx)
 
 
 @click.group("review")
-def cmd_review():
+@click.pass_context
+def cmd_review(ctx: click.Context):
     """Code review"""
+    _trace(ctx)
 
 
 @cmd_review.command("file")
-@click.argument("file", required=False)
-def cmd_review_file(file):
-    cmd.review.file(file)
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "--workers",
+    default=4,
+    type=click.IntRange(min=1),
+    show_default=True,
+    envvar="CI_REVIEW_WORKERS",
+    help="Maximum number of files or chunks reviewed concurrently.",
+)
+@click.option(
+    "--chunk-tokens",
+    default=6_000,
+    show_default=True,
+    envvar="CI_REVIEW_CHUNK_TOKENS",
+    help="Token budget of each chunk of a large file.",
+)
+@click.option(
+    "--chunk-threshold",
+    default=12_000,
+    show_default=True,
+    envvar="CI_REVIEW_CHUNK_THRESHOLD",
+    help="Files above this many tokens are split on function and class boundaries.",
+)
+@no_cache_option
+def cmd_review_file(paths: tuple[str, ...], workers: int, chunk_tokens: int, chunk_threshold: int):
+    """Review files, directories or globs"""
+    options = cmd.review.ChunkOptions(threshold=chunk_threshold, chunk_tokens=chunk_tokens, workers=workers)
+    try:
+        cmd.review.files(paths, options)
+    except (FileNotFoundError, ValueError) as e:
+        raise click.ClickException(str(e)) from e
+
+
+@cmd_review.command("notes")
+@click.argument("revision_range", required=False)
+@click.option("-n", "--max-count", default=10, show_default=True, help="Number of commits to look at.")
+def cmd_review_notes(revision_range: Optional[str], max_count: int):
+    """Show the reviews stored in git notes by 'ag hook install'"""
+    try:
+        cmd.notes.notes(revision_range, max_count)
+    except ValueError as e:
+        raise click.ClickException(str(e)) from e
 
 
 @cmd_review.command("pr")
@@ -44,17 +125,85 @@ def cmd_review_pr():
     click.echo("Pull request")
 
 
+@cmd_review.command("range")
+@click.argument("revision_range")
+@click.option(
+    "--workers", default=4, show_default=True, type=click.IntRange(min=1), help="Maximum number of concurrent reviews."
+)
+@click.option(
+    "--requests-per-minute",
+    default=60.0,
+    type=click.FloatRange(min=0, min_open=True),
+    show_default=True,
+    envvar="CI_REQUESTS_PER_MINUTE",
+    help="Maximum number of review requests per minute.",
+)
+@click.option("--restart", is_flag=True, help="Review all commits again instead of resuming.")
+@no_cache_option
+def cmd_review_range(revision_range: str, workers: int, requests_per_minute: float, restart: bool):
+    """Review every commit in a range, e.g. main..HEAD"""
+    try:
+        failed = cmd.review.commit_range(
+            revision_range,
+            workers=workers,
+            requests_per_minute=requests_per_minute,
+            restart=restart,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e)) from e
+    if failed:
+        raise click.ClickException(f"{len(failed)} reviews failed, run the command again to retry them.")
+
+
 @cmd_review.command("diff")
 @click.argument("commit_hash", required=False)
 @click.option("--cached", is_flag=True)
-def cmd_review_diff(commit_hash: Optional[str], cached: bool):
+@click.option(
+    "--workers",
+    default=4,
+    type=click.IntRange(min=1),
+    show_default=True,
+    envvar="CI_REVIEW_WORKERS",
+    help="Maximum number of chunks reviewed concurrently.",
+)
+@click.option(
+    "--chunk-tokens",
+    default=6_000,
+    show_default=True,
+    envvar="CI_REVIEW_CHUNK_TOKENS",
+    help="Token budget of each chunk of a large diff.",
+)
+@click.option(
+    "--chunk-threshold",
+    default=12_000,
+    show_default=True,
+    envvar="CI_REVIEW_CHUNK_THRESHOLD",
+    help="Review diffs larger than this many tokens in chunks.",
+)
+@click.option(
+    "--context-tokens",
+    default=2_000,
+    show_default=True,
+    envvar="CI_REVIEW_CONTEXT_TOKENS",
+    help="Token budget of the related repository code sent with the diff, 0 to disable.",
+)
+@no_cache_option
+def cmd_review_diff(
+    commit_hash: Optional[str], cached: bool, workers: int, chunk_tokens: int, chunk_threshold: int, context_tokens: int
+):
+    options = cmd.review.ChunkOptions(
+        threshold=chunk_threshold, chunk_tokens=chunk_tokens, workers=workers, context_tokens=context_tokens
+    )
     if cached:
-        cmd.review.cached()
+        cmd.review.cached(options)
     elif commit_hash:
-        cmd.review.commit(commit_hash)
+        try:
+            cmd.review.commit(commit_hash, options)
+        except ValueError as e:
+            raise click.ClickException(str(e)) from e
     else:
         # Example: `git dc | gi review diff`
-        cmd.review.stdin()
+        cmd.review.stdin(options)
 
 
 @click.command()
@@ -66,48 +215,208 @@ def aliases():
 @click.command()
 @click.option("--amend", is_flag=True)
 @click.option("--history", is_flag=False, default=0)
-def ci(amend: bool, history: int):
+@click.option(
+    "--max-prompt-tokens",
+    type=click.IntRange(min=1),
+    envvar="CI_MAX_PROMPT_TOKENS",
+    help="Token budget of the prompt. History is summarized or dropped to fit.",
+)
+@click.option(
+    "--candidates",
+    type=click.IntRange(1, 10),
+    default=1,
+    envvar="CI_COMMIT_CANDIDATES",
+    help="Generate this many messages in one request and pick one. "
+    "The others are used by the next retry or --amend with --candidates.",
+)
+@no_cache_option
+def ci(amend: bool, history: int, max_prompt_tokens: Optional[int], candidates: int):
     """Commit"""
     if amend:
-        cmd.commit.amend_commit()
+        cmd.commit.amend_commit(max_prompt_tokens=max_prompt_tokens, n_candidates=candidates)
     else:
-        cmd.commit.create_new_commit(history)
+        cmd.commit.create_new_commit(history, max_prompt_tokens=max_prompt_tokens, n_candidates=candidates)
+
+
+@click.group("cache")
+@click.pass_context
+def cmd_cache(ctx: click.Context):
+    """Manage the completion cache"""
+    _trace(ctx)
+
+
+@cmd_cache.command("stats")
+def cmd_cache_stats():
+    """Show cache statistics"""
+    from ci.llm import cache
+
+    click.echo(cache.get_cache().stats())
+
+
+@cmd_cache.command("clear")
+def cmd_cache_clear():
+    """Remove all cached completions and reviews"""
+    from ci.llm import cache
+
+    for name in (cache.COMPLETIONS, cache.REVIEWS):
+        cache.get_cache(name).clear()
+
+
+def pager_options(f):
+    f = click.option("--pygments", is_flag=True, help="Highlight with Pygments instead of streaming.")(f)
+    f = click.option("--no-pager", is_flag=True, help="Do not pipe the output into a pager.")(f)
+    return f
 
 
 @click.command()
 @click.argument("commit_hash", required=False, default="HEAD")
-def show(commit_hash: str):
+@pager_options
+def show(commit_hash: str, pygments: bool, no_pager: bool):
     """Show commit"""
-    cmd.show.show(commit_hash)
+    try:
+        cmd.show.show(commit_hash, pygments=pygments, use_pager=not no_pager)
+    except ValueError as e:
+        raise click.ClickException(str(e)) from e
+
+
+def prefetch_max_prompt_tokens_option(f):
+    return click.option(
+        "--max-prompt-tokens",
+        type=click.IntRange(min=1),
+        envvar="CI_MAX_PROMPT_TOKENS",
+        help="Token budget of the prompt of the prefetched message, as in 'ag ci'.",
+    )(f)
 
 
 @click.command()
 @click.argument("file_path", required=False)
 @click.option("--patch", "-p", is_flag=True)
-def add(file_path: Optional[str], patch: bool):
+@click.option("--prefetch", is_flag=True, help="Generate the commit message in the background.")
+@click.option("--history", default=0, help="History commits for the prefetched message, as in 'ag ci'.")
+@prefetch_max_prompt_tokens_option
+def add(file_path: Optional[str], patch: bool, prefetch: bool, history: int, max_prompt_tokens: Optional[int]):
     """Add commit"""
-    cmd.add.add(file_path, patch=patch)
+    cmd.add.add(
+        file_path,
+        patch=patch,
+        prefetch_history=history if prefetch else None,
+        prefetch_max_prompt_tokens=max_prompt_tokens,
+    )
+
+
+@click.command("prefetch")
+@click.option("--watch", is_flag=True, help="Keep running and prefetch whenever the index changes.")
+@click.option("--history", default=0, help="History commits for the prefetched message, as in 'ag ci'.")
+@prefetch_max_prompt_tokens_option
+def cmd_prefetch(watch: bool, history: int, max_prompt_tokens: Optional[int]):
+    """Generate the commit message for the staged changes ahead of 'ag ci'"""
+    from ci import prefetch
+
+    if watch:
+        prefetch.watch(history, max_prompt_tokens)
+    else:
+        prefetch.prefetch(history, max_prompt_tokens)
+
+
+@click.group("hook")
+@click.pass_context
+def cmd_hook(ctx: click.Context):
+    """Review every commit in the background"""
+    _trace(ctx)
+
+
+@cmd_hook.command("install")
+@click.option("--force", is_flag=True, help="Replace an existing post-commit hook.")
+def cmd_hook_install(force: bool):
+    """Install a post-commit hook that queues a review of each commit"""
+    try:
+        path = cmd.hook.install(force=force)
+    except FileExistsError as e:
+        raise click.ClickException(str(e)) from e
+    click.echo(f"Installed {path}")
+
+
+@cmd_hook.command("uninstall")
+def cmd_hook_uninstall():
+    """Remove the post-commit hook"""
+    if not cmd.hook.uninstall():
+        raise click.ClickException("No hook installed by 'ag hook install'.")
+
+
+@click.command("serve")
+@click.option("--foreground", is_flag=True, help="Run in this terminal instead of in the background.")
+@click.option(
+    "--idle-timeout",
+    default=3600.0,
+    show_default=True,
+    envvar="CI_DAEMON_IDLE_TIMEOUT",
+    help="Exit after this many seconds without a command.",
+)
+@click.option("--stop", is_flag=True, help="Stop the running daemon.")
+def cmd_serve(foreground: bool, idle_timeout: float, stop: bool):
+    """Keep a warm process that runs 'ag review'"""
+    from ci import daemon
+
+    if stop:
+        if not daemon.stop():
+            raise click.ClickException("No daemon is running.")
+    elif daemon.is_running():
+        click.echo(f"Already serving on {daemon.socket_path()}")
+    elif foreground:
+        daemon.serve(idle_timeout)
+    else:
+        try:
+            path = daemon.start(idle_timeout)
+        except RuntimeError as e:
+            raise click.ClickException(str(e)) from e
+        click.echo(f"Serving on {path}")
 
 
 @click.command("dc")
-def diff_cached():
+@pager_options
+def diff_cached(pygments: bool, no_pager: bool):
     """Show cached diff"""
-    cmd.diff.cached()
+    cmd.diff.cached(pygments=pygments, use_pager=not no_pager)
+
+
+@click.command("stats")
+@click.option("--days", type=float, help="Only include runs of the last DAYS days.")
+@click.option("--json", "as_json", is_flag=True, help="Print the statistics as JSON.")
+@click.option("--clear", is_flag=True, help="Remove the recorded telemetry.")
+def cmd_stats(days: Optional[float], as_json: bool, clear: bool):
+    """Show latency, token and cost statistics of runs recorded with CI_TELEMETRY=1"""
+    if clear:
+        telemetry.clear()
+        return
+    cmd.stats.stats(days=days, as_json=as_json)
 
 
 @click.command("st")
 @click.argument("file_path", required=False)
-def status(file_path: Optional[str]):
+@click.option(
+    "--untracked-files",
+    "-u",
+    type=click.Choice(["no", "normal", "all"]),
+    default="normal",
+    show_default=True,
+    help="Show untracked files. 'no' skips searching for them.",
+)
+def status(file_path: Optional[str], untracked_files: str):
     """Show status"""
-    cmd.status.status(file_path)
+    cmd.status.status(file_path, untracked=untracked_files)
 
 
 cli.add_command(aliases)
 cli.add_command(ci)
 cli.add_command(cmd_review)
+cli.add_command(cmd_cache)
 cli.add_command(show)
 cli.add_command(add)
+cli.add_command(cmd_prefetch)
+cli.add_command(cmd_serve)
+cli.add_command(cmd_hook)
 cli.add_command(diff_cached)
 cli.add_command(status)
+cli.add_command(cmd_stats)
 if __name__ == '__main__':
     cli()
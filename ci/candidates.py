@@ -0,0 +1,64 @@
+import contextlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from ci import git
+
+MAX_AGE = 24 * 60 * 60
+"""
+Unused candidates older than this many seconds are removed.
+"""
+
+
+def _candidates_dir() -> Path:
+    return git.cache_dir() / "candidates"
+
+
+def store(key: str, messages: list[str]) -> None:
+    """
+    Stores the unused candidate commit messages under a key, replacing any
+    stored before.
+    """
+    directory = _candidates_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{key}.json"
+    if not messages:
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+        return
+
+    tmp = directory / f"{key}.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(messages))
+    tmp.replace(path)
+    _remove_stale(directory)
+
+
+def take(key: str) -> Optional[str]:
+    """
+    Removes and returns the next unused candidate commit message under a
+    key.
+
+    The key is made of the parent commit and the tree hash of the index,
+    which stay the same when a commit is retried or amended without
+    staging anything else.
+    """
+    path = _candidates_dir() / f"{key}.json"
+    try:
+        messages = json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if not messages:
+        return None
+    store(key, messages[1:])
+    return messages[0]
+
+
+def _remove_stale(directory: Path) -> None:
+    cutoff = time.time() - MAX_AGE
+    for path in directory.glob("*.json"):
+        with contextlib.suppress(FileNotFoundError):
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
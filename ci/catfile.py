@@ -0,0 +1,170 @@
+import atexit
+import contextlib
+import os
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator, Optional
+
+BATCH_SIZE = 256
+"""
+Number of object names written to `git cat-file` before reading the
+answers back, so neither side of the pipes fills up and blocks.
+"""
+
+
+@dataclass
+class ObjectInfo:
+    object_hash: str
+    object_type: str
+    size: int
+
+
+class CatFile:
+    """
+    Long-lived `git cat-file --batch-check` and `git cat-file --batch`
+    processes for object lookups.
+
+    Object names are written to the stdin of the processes and answered
+    over their stdout, so any number of lookups costs a single process
+    start per mode.
+    """
+
+    def __init__(self, cwd: Optional[str] = None):
+        self.cwd = cwd
+        self._processes: dict[str, subprocess.Popen] = {}
+        self._lock = threading.Lock()
+
+    def _process(self, mode: str) -> subprocess.Popen:
+        p = self._processes.get(mode)
+        if p is None or p.poll() is not None:
+            p = subprocess.Popen(
+                ["git", "cat-file", mode],
+                cwd=self.cwd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self._processes[mode] = p
+        return p
+
+    @contextlib.contextmanager
+    def _session(self, mode: str) -> Iterator[subprocess.Popen]:
+        """
+        Holds the lock and the process of a mode. The process is killed if
+        the lookup fails halfway, since answers still in its pipe would be
+        read as the answers of the next lookup.
+        """
+        with self._lock:
+            p = self._process(mode)
+            try:
+                yield p
+            except BaseException:
+                p.kill()
+                p.wait()
+                del self._processes[mode]
+                raise
+
+    @staticmethod
+    def _write(stdin: IO[bytes], names: list[str]) -> None:
+        for name in names:
+            stdin.write(name.encode("utf-8") + b"\n")
+        stdin.flush()
+
+    @staticmethod
+    def _read_info(stdout: IO[bytes]) -> Optional[ObjectInfo]:
+        line = stdout.readline()
+        if not line:
+            raise EOFError("git cat-file exited")
+        # Names may contain spaces, but hashes, types and sizes do not.
+        header = line.decode("utf-8").rstrip("\n").rsplit(" ", 2)
+        if len(header) != 3 or not header[2].isdigit():
+            # "<name> missing" or "<name> ambiguous"
+            return None
+        object_hash, object_type, size = header
+        return ObjectInfo(object_hash=object_hash, object_type=object_type, size=int(size))
+
+    @staticmethod
+    def _validate(names: list[str]) -> None:
+        for name in names:
+            if "\n" in name:
+                raise ValueError(f"Invalid object name {name!r}")
+
+    def check_many(self, names: Iterable[str]) -> list[Optional[ObjectInfo]]:
+        """
+        Looks up many objects at once.
+
+        Args:
+            names: Object names, e.g. hashes, refs or `HEAD~1^{commit}`.
+
+        Returns:
+            The info of every object, or None if it does not exist.
+        """
+        names = list(names)
+        self._validate(names)
+        infos: list[Optional[ObjectInfo]] = []
+        with self._session("--batch-check") as p:
+            assert p.stdin is not None and p.stdout is not None
+            for i in range(0, len(names), BATCH_SIZE):
+                batch = names[i : i + BATCH_SIZE]
+                self._write(p.stdin, batch)
+                infos.extend(self._read_info(p.stdout) for _ in batch)
+        return infos
+
+    def check(self, name: str) -> Optional[ObjectInfo]:
+        return self.check_many([name])[0]
+
+    def read(self, name: str) -> Optional[tuple[ObjectInfo, bytes]]:
+        """
+        Returns the info and the content of an object, or None if it does
+        not exist.
+        """
+        self._validate([name])
+        with self._session("--batch") as p:
+            assert p.stdin is not None and p.stdout is not None
+            self._write(p.stdin, [name])
+            info = self._read_info(p.stdout)
+            if info is None:
+                return None
+            content = p.stdout.read(info.size)
+            if len(content) != info.size or p.stdout.read(1) != b"\n":
+                raise EOFError("git cat-file exited")
+        return info, content
+
+    def close(self) -> None:
+        with self._lock:
+            for p in self._processes.values():
+                if p.stdin is not None:
+                    p.stdin.close()
+                if p.stdout is not None:
+                    p.stdout.close()
+                p.wait()
+            self._processes.clear()
+
+
+_catfiles: dict[str, CatFile] = {}
+_catfiles_lock = threading.Lock()
+
+
+def get_catfile() -> CatFile:
+    """
+    Returns the shared `git cat-file` worker of the current directory,
+    starting it on first use.
+    """
+    cwd = os.getcwd()
+    with _catfiles_lock:
+        if cwd not in _catfiles:
+            _catfiles[cwd] = CatFile(cwd)
+        return _catfiles[cwd]
+
+
+@atexit.register
+def close_all() -> None:
+    """
+    Stops the shared workers, e.g. after each command run by `ag serve`.
+    """
+    with _catfiles_lock:
+        catfiles = list(_catfiles.values())
+        _catfiles.clear()
+    for worker in catfiles:
+        worker.close()
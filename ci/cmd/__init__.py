@@ -1,4 +1,4 @@
-from . import add, commit, diff, review, show, status
+import importlib
 
 __all__ = [
     "diff",
@@ -7,4 +7,15 @@ __all__ = [
     "show",
     "status",
     "add",
+    "stats",
+    "hook",
+    "notes",
 ]
+
+
+def __getattr__(name: str):
+    # Subcommands are imported on first use, so commands that only shell out
+    # to git do not pay for importing openai and pygments.
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,23 @@
 from typing import Optional
 
-from ci import git
+from ci import git, prefetch
 
 
-def add(file_path: Optional[str], patch: bool):
-    """Add commit"""
+def add(
+    file_path: Optional[str],
+    patch: bool,
+    prefetch_history: Optional[int] = None,
+    prefetch_max_prompt_tokens: Optional[int] = None,
+):
+    """
+    Add commit
+
+    Args:
+        prefetch_history: If set, start generating the commit message for the
+            new index in the background, with this many history commits.
+        prefetch_max_prompt_tokens: Token budget of the prompt of the
+            prefetched message, as in `ag ci`.
+    """
     git.add(file_path, patch=patch)
+    if prefetch_history is not None:
+        prefetch.start(prefetch_history, prefetch_max_prompt_tokens)
@@ -1,59 +1,107 @@
-from ci import git
-from ci.llm import openai
+import itertools
+import sys
+from typing import Iterator, Optional
 
+from ci import candidates, git, patch, prefetch
+from ci.llm import openai, prompt
 
-def create_new_commit(history=0):
+
+def create_new_commit(history=0, max_prompt_tokens: Optional[int] = None, n_candidates: int = 1):
     """
     Create a new Git commit.
 
     Args:
         history (int): Number of latest commits to consider for generating commit message.
+        max_prompt_tokens (int): Token budget of the prompt.
+        n_candidates (int): Number of alternative messages to generate and pick from.
 
     Raises:
         ValueError: If the input diff is empty or git commands fail.
     """
-    input_diff = git.cached_diff()
-    if not input_diff:
+    if not git.has_staged_changes():
         raise ValueError("No changes to commit.")
 
-    history_messages = _get_history(history) if history > 0 else []
-    commit_msg = _ask_for_commit_msg(input_diff.text, history=history_messages)
-    if not commit_msg:
-        raise ValueError("Commit message cannot be empty.")
+    key = _candidates_key(amend=False) if n_candidates > 1 else None
+    candidate_msg = candidates.take(key) if key else None
+    if candidate_msg:
+        print("Using the next candidate commit message.", file=sys.stderr)
+        git.create_commit(candidate_msg)
+        return
+
+    prefetched_msg = prefetch.take(history, max_prompt_tokens)
+    if prefetched_msg:
+        print("Using prefetched commit message.", file=sys.stderr)
+        git.create_commit(prefetched_msg)
+        return
+
+    input_diff = git.cached_diff()
+    history_commits = _get_history(history) if history > 0 else []
+    if n_candidates > 1:
+        commit_msg = _pick_commit_msg(input_diff.text, history_commits, key, n_candidates, max_prompt_tokens)
+        git.create_commit(commit_msg)
+        return
 
-    git.create_commit(commit_msg)
+    commit_msg = _stream_commit_msg(input_diff.text, history=history_commits, max_prompt_tokens=max_prompt_tokens)
 
+    git.create_commit(_echo(commit_msg))
 
-def amend_commit():
+
+def generate_commit_msg(history: int = 0, max_prompt_tokens: Optional[int] = None) -> str:
     """
-    Amend the latest Git commit.
+    Returns a commit message for the staged changes, without committing.
 
     Args:
         history (int): Number of latest commits to consider for generating commit message.
-
-    Raises:
-        ValueError: If the input diff is empty or git commands fail.
+        max_prompt_tokens (int): Token budget of the prompt.
     """
     input_diff = git.cached_diff()
-    if not input_diff:
-        raise ValueError("No changes to commit.")
+    history_commits = _get_history(history) if history > 0 else []
+    return _ask_for_commit_msg(input_diff.text, history=history_commits, max_prompt_tokens=max_prompt_tokens)
 
-    history_messages = _get_history(1)
 
-    commit_msg = _ask_for_commit_msg(input_diff.text, history=history_messages)
+def amend_commit(max_prompt_tokens: Optional[int] = None, n_candidates: int = 1):
+    """
+    Amend the latest Git commit.
 
-    git.amend_commit(commit_msg)
+    Nothing needs to be staged, which rewords the latest commit from its
+    own diff.
 
+    With `n_candidates` above 1, the next candidate left by a previous
+    `ag ci --candidates` of the same index and parent commit is used
+    without asking the model again.
 
-def _ask_for_commit_msg(
-    input_diff: str,
-    history: list,
-    model: str = openai.Models.DEFAULT_MODEL,
-    temperature: float = 0.2,
-) -> str:
-    """This function takes a git diff as input and returns a git commit message"""
+    Args:
+        max_prompt_tokens (int): Token budget of the prompt.
+        n_candidates (int): Number of alternative messages to generate and pick from.
 
-    COMMIT_INSTRUCTION = """
+    Raises:
+        ValueError: If the model responds with no message or git commands fail.
+    """
+    key = _candidates_key(amend=True) if n_candidates > 1 else None
+    candidate_msg = candidates.take(key) if key else None
+    if candidate_msg:
+        print("Using the next candidate commit message.", file=sys.stderr)
+        git.amend_commit(candidate_msg)
+        return
+
+    if git.has_staged_changes():
+        input_diff = git.cached_diff().text
+        history_commits = _get_history(1)
+    else:
+        # A reword describes the changes of the latest commit itself.
+        input_diff = git.last_commit().diff.text
+        history_commits = []
+    if n_candidates > 1:
+        commit_msg = _pick_commit_msg(input_diff, history_commits, key, n_candidates, max_prompt_tokens)
+        git.amend_commit(commit_msg)
+        return
+
+    commit_msg = _stream_commit_msg(input_diff, history=history_commits, max_prompt_tokens=max_prompt_tokens)
+
+    git.amend_commit(_echo(commit_msg))
+
+
+COMMIT_INSTRUCTION = """
 You will receive a git diff and respond with a git commit message.
 Provide a clear and concise commit message that summarizes the changes made in this diff.
 Separate subject from body with a blank line.
@@ -64,32 +112,182 @@ Use the imperative mood in the subject line.
 Wrap the body at 72 characters.
 Use the body to explain what and why vs. how.
 """
-    history = history or []
-
-    system_message = openai.SystemMessage(COMMIT_INSTRUCTION)
-    input_message = openai.UserMessage(input_diff)
-
-    response = openai.chat_completion(
-        request=openai.ChatRequest(
-            model=model,
-            messages=[
-                system_message,
-                *history,
-                input_message,
+
+
+def _build_prompt(
+    input_diff: str,
+    history: list[git.Commit],
+    model: str,
+    max_prompt_tokens: Optional[int] = None,
+) -> list[openai.Message]:
+    """
+    Assembles the prompt within the token budget.
+
+    All diffs are compacted with `patch.compact`. The instruction and the
+    diff are always sent; the diff is truncated as a last resort. Older
+    history commits are reduced first: their diffs are replaced by a
+    per-file summary, then the commits are dropped.
+    """
+    builder = prompt.PromptBuilder(model, budget=max_prompt_tokens)
+    builder.add(openai.SystemMessage(COMMIT_INSTRUCTION), required=True)
+    for age, commit in enumerate(history):
+        builder.add(
+            openai.UserMessage(commit.message),
+            openai.UserMessage(patch.compact(commit.diff.text)),
+            priority=-age,
+            summary=[
+                openai.UserMessage(commit.message),
+                openai.UserMessage(patch.stat(commit.diff.text)),
             ],
-            temperature=temperature,
         )
+    builder.add(openai.UserMessage(patch.compact(input_diff)), required=True)
+
+    return builder.build()
+
+
+def _commit_msg_request(
+    input_diff: str,
+    history: list[git.Commit],
+    model: str,
+    temperature: float,
+    max_prompt_tokens: Optional[int] = None,
+    n: int = 1,
+) -> openai.ChatRequest:
+    return openai.ChatRequest(
+        model=model,
+        messages=_build_prompt(input_diff, history or [], model, max_prompt_tokens),
+        temperature=temperature,
+        n=n,
     )
+
+
+def _ask_for_commit_msg(
+    input_diff: str,
+    history: list[git.Commit],
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+    max_prompt_tokens: Optional[int] = None,
+) -> str:
+    """This function takes a git diff as input and returns a git commit message"""
+    request = _commit_msg_request(input_diff, history, model, temperature, max_prompt_tokens)
+    response = openai.chat_completion(request=request)
     commit_msg = response.choices[0].message.content
 
     return commit_msg
 
 
-def _get_history(history: int) -> list[openai.Message]:
-    latest_commits = git.latest_commits(history)
-    history_messages: list[openai.Message] = []
-    for commit in latest_commits:
-        history_messages.append(openai.UserMessage(commit.message))
-        history_messages.append(openai.UserMessage(commit.diff.text))
+def _ask_for_commit_msgs(
+    input_diff: str,
+    history: list[git.Commit],
+    n: int,
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.8,
+    max_prompt_tokens: Optional[int] = None,
+) -> list[str]:
+    """
+    Same as `_ask_for_commit_msg`, but returns `n` alternative messages from
+    a single request. The temperature is higher so the alternatives differ.
+    """
+    request = _commit_msg_request(input_diff, history, model, temperature, max_prompt_tokens, n=n)
+    response = openai.chat_completion(request=request)
+    commit_msgs = [choice.message.content.strip() for choice in sorted(response.choices, key=lambda c: c.index)]
+    return [msg for msg in dict.fromkeys(commit_msgs) if msg]
+
+
+def _candidates_key(amend: bool) -> Optional[str]:
+    """
+    Returns the key candidate messages are stored under: the parent of the
+    commit being made and the tree hash of the index, or None if the index
+    cannot be written as a tree. The parent of an amended commit is the
+    parent of HEAD, so an amend finds the candidates of the commit it
+    replaces.
+    """
+    tree = git.write_tree()
+    if tree is None:
+        return None
+    parent = git.resolve("HEAD^" if amend else "HEAD") or "initial"
+    return f"{parent}-{tree}"
+
+
+def _pick_commit_msg(
+    input_diff: str,
+    history: list[git.Commit],
+    key: Optional[str],
+    n: int,
+    max_prompt_tokens: Optional[int] = None,
+) -> str:
+    """
+    Generates `n` candidate messages, lets the user pick one and stores the
+    others for the next `ag ci` or `ag ci --amend` of the same index and
+    parent commit.
+
+    Raises:
+        ValueError: If the model responds with no message.
+    """
+    commit_msgs = _ask_for_commit_msgs(input_diff, history, n, max_prompt_tokens=max_prompt_tokens)
+    if not commit_msgs:
+        raise ValueError("Commit message cannot be empty.")
+
+    choice = _pick(commit_msgs)
+    if key:
+        candidates.store(key, commit_msgs[choice + 1 :] + commit_msgs[:choice])
+    return commit_msgs[choice]
+
+
+def _pick(commit_msgs: list[str]) -> int:
+    """
+    Prints the numbered messages to stderr and asks for one. Picks the first
+    without asking if stdin is not a terminal.
+    """
+    for i, commit_msg in enumerate(commit_msgs, 1):
+        print(f"[{i}] {commit_msg}\n", file=sys.stderr)
+    if len(commit_msgs) == 1 or not sys.stdin.isatty():
+        return 0
+
+    while True:
+        sys.stderr.write(f"Pick a commit message [1-{len(commit_msgs)}] (1): ")
+        sys.stderr.flush()
+        answer = sys.stdin.readline().strip()
+        if not answer:
+            return 0
+        if answer.isdigit() and 1 <= int(answer) <= len(commit_msgs):
+            return int(answer) - 1
+
+
+def _stream_commit_msg(
+    input_diff: str,
+    history: list[git.Commit],
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+    max_prompt_tokens: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Same as `_ask_for_commit_msg`, but yields the message as it is generated.
+
+    Raises:
+        ValueError: If the model responds with an empty message.
+    """
+    request = _commit_msg_request(input_diff, history, model, temperature, max_prompt_tokens)
+    request.stream = True
+    chunks = openai.chat_completion_stream(request=request)
+
+    # Wait for the first delta so an empty message is caught before git
+    # opens the editor.
+    for chunk in chunks:
+        if chunk.strip():
+            return itertools.chain([chunk], chunks)
+
+    raise ValueError("Commit message cannot be empty.")
+
+
+def _echo(chunks: Iterator[str]) -> Iterator[str]:
+    """Echoes the message to stderr while it is piped into the editor."""
+    for chunk in chunks:
+        sys.stderr.write(chunk)
+        sys.stderr.flush()
+        yield chunk
+    sys.stderr.write("\n")
+
 
-    return history_messages
+def _get_history(history: int) -> list[git.Commit]:
+    return git.latest_commits(history)
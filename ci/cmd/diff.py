@@ -1,7 +1,15 @@
-from ci import git, highlight
+from ci import git, highlight, pager
 
 
-def cached() -> None:
-    diff = git.cached_diff()
-    highlighed_diff = highlight.diff(diff.text)
-    print(highlighed_diff)
+def cached(pygments: bool = False, use_pager: bool = True) -> None:
+    if pygments:
+        diff = git.cached_diff()
+        highlighed_diff = highlight.diff(diff.text)
+        with pager.pager(use_pager) as out:
+            out.write(highlighed_diff)
+        return
+
+    lines = git.iter_cached_diff()
+    with pager.pager(use_pager) as out:
+        for line in highlight.iter_diff(lines):
+            out.write(line)
@@ -0,0 +1,61 @@
+import shlex
+import sys
+from pathlib import Path
+
+from ci import git
+
+HOOK = "post-commit"
+"""
+The review needs the commit, so it is queued after the commit is made
+rather than from `pre-commit`, and never delays or blocks the commit.
+"""
+
+MARKER = "# Installed by `ag hook install`."
+
+
+def _script() -> str:
+    python = shlex.quote(sys.executable)
+    return (
+        "#!/bin/sh\n"
+        f"{MARKER}\n"
+        "# Queues a review of the new commit in the background. The results are\n"
+        "# stored in git notes, see `ag review notes`.\n"
+        "unset GIT_INDEX_FILE\n"
+        f'{python} -m ci.review_queue enqueue "$(git rev-parse HEAD)" </dev/null >/dev/null 2>&1 &\n'
+    )
+
+
+def install(force: bool = False) -> Path:
+    """
+    Installs the post-commit hook that queues the review of every new commit.
+
+    Args:
+        force: Replace a hook that was not installed by `ag hook install`.
+
+    Returns:
+        The path of the hook.
+
+    Raises:
+        FileExistsError: If another post-commit hook exists and `force` is false.
+    """
+    path = git.hooks_dir() / HOOK
+    if path.exists() and MARKER not in path.read_text(errors="replace") and not force:
+        raise FileExistsError(f"{path} already exists, use --force to replace it")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(_script())
+    path.chmod(0o755)
+    return path
+
+
+def uninstall() -> bool:
+    """
+    Removes the post-commit hook if it was installed by `ag hook install`.
+
+    Returns:
+        True if the hook was removed.
+    """
+    path = git.hooks_dir() / HOOK
+    if not path.exists() or MARKER not in path.read_text(errors="replace"):
+        return False
+    path.unlink()
+    return True
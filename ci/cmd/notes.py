@@ -0,0 +1,38 @@
+import sys
+from typing import Optional
+
+from ci import catfile, git, highlight, review_queue
+
+
+def notes(revision_range: Optional[str] = None, max_count: int = 10) -> None:
+    """
+    Prints the reviews of commits stored in git notes by the post-commit
+    hook, newest first, and which reviews are still queued or running.
+
+    Only reads git objects, so it does not import the LLM client.
+
+    Args:
+        revision_range: The commits to look at, HEAD and its ancestors by default.
+        max_count: The maximum number of commits to look at.
+    """
+    stored = git.notes()
+    states = review_queue.pending()
+    worker = catfile.get_catfile()
+    shown = 0
+    for commit in git.iter_commits(n=max_count, revs=[revision_range] if revision_range else [], patch=False):
+        subject = commit.message.split("\n", 1)[0]
+        blob = stored.get(commit.commit_hash)
+        result = worker.read(blob) if blob else None
+        if result is not None:
+            code_review = result[1].decode("utf-8", errors="replace")
+        elif commit.commit_hash in states:
+            code_review = f"Review {states[commit.commit_hash]}."
+        else:
+            continue
+        shown += 1
+        for highlighted_block in highlight.markdown_stream([f"# {commit.commit_hash[:7]} {subject}\n\n{code_review}"]):
+            sys.stdout.write(highlighted_block)
+        print()
+
+    if not shown:
+        print(f"No reviews in {git.NOTES_REF}. Install the hook with 'ag hook install'.", file=sys.stderr)
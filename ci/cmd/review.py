@@ -1,50 +1,318 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import hashlib
+import logging
+import re
 import sys
 import typing as t
+from dataclasses import dataclass
 
-from ci import git, highlight
-from ci.llm import openai
+from ci import commit_index, git, highlight, patch, source, symbol_index
+from ci.llm import cache, client, openai, scheduler, tokens
 
+LOGGER = logging.getLogger(__name__)
 
-def print_review(code_review: str):
-    highlighted_code_review = highlight.markdown(code_review)
-    print(highlighted_code_review)
 
+@dataclass
+class ChunkOptions:
+    """
+    Controls when and how large diffs are reviewed in chunks.
+    """
+
+    threshold: int = 12_000
+    """
+    Diffs estimated above this many tokens are reviewed in chunks.
+    """
+
+    chunk_tokens: int = 6_000
+    """
+    The token budget of a single chunk.
+    """
+
+    workers: int = 4
+    """
+    The maximum number of chunks reviewed concurrently.
+    """
+
+    context_tokens: int = 2_000
+    """
+    The token budget of the repository code sent along with each diff or
+    chunk, see `symbol_index.context`. Zero disables it.
+    """
+
+
+def print_review(code_review: t.Union[str, t.Iterable[str]]):
+    """
+    Prints a code review, highlighting each markdown block as soon as it
+    is complete.
+
+    Args:
+        code_review: The review, either as a string or as streamed deltas.
+    """
+    if isinstance(code_review, str):
+        code_review = [code_review]
+
+    for highlighted_block in highlight.markdown_stream(code_review):
+        sys.stdout.write(highlighted_block)
+        sys.stdout.flush()
+    print()
+
+
+def cached(options: t.Optional[ChunkOptions] = None) -> None:
+    if not git.has_staged_changes():
+        print("No staged changes to review.", file=sys.stderr)
+        return
 
-def cached() -> None:
     diff = git.cached_diff()
-    code_review = ask_for_review(diff)
+    code_review = incremental_review(diff.text, options)
     print_review(code_review)
 
 
-def commit(commit_hash: str) -> None:
+def commit(commit_hash: str, options: t.Optional[ChunkOptions] = None, notes: bool = False) -> None:
+    """
+    Reviews a commit.
+
+    Args:
+        commit_hash: The commit to review.
+        options: Controls how large commits are reviewed.
+        notes: Store the review in git notes under `git.NOTES_REF` instead
+            of printing it.
+    """
     diff = git.show(commit_hash)
-    code_review = ask_for_review(diff)
+    code_review = incremental_review(diff, options)
+    if notes:
+        git.add_note(commit_hash, "".join(code_review))
+        return
     print_review(code_review)
 
 
-def stdin() -> None:
+def commit_range(
+    revision_range: str,
+    workers: int = 4,
+    requests_per_minute: float = 60,
+    restart: bool = False,
+    options: t.Optional[ChunkOptions] = None,
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+) -> list[git.Commit]:
+    """
+    Reviews every commit in a range, oldest first.
+
+    Commits are reviewed concurrently by at most `workers` requests at a
+    time and at most `requests_per_minute` requests per minute. Reviews are
+    printed as they finish and checkpointed in the commit index under
+    `checkpoint_key`, so an interrupted run resumes where it stopped.
+    Reviews by the stub backend are never checkpointed. A commit whose
+    review fails is reported and left for the next run, the others are
+    still reviewed.
+
+    Args:
+        revision_range: The commits to review, e.g. `main..HEAD`.
+        workers: The maximum number of concurrent requests.
+        requests_per_minute: The maximum request rate.
+        restart: If true, ignore the reviews of a previous run.
+        options: Commits larger than the chunk threshold are reviewed in
+            chunks, as with `map_reduce_review`.
+
+    Returns:
+        The commits whose review failed.
+
+    Raises:
+        ValueError: If the range is a single revision, which would review
+            its whole history.
+    """
+    if ".." not in revision_range:
+        raise ValueError(f"Expected a range like main..{revision_range}, got the single revision {revision_range!r}")
+    options = options or ChunkOptions()
+    commits = list(reversed(list(git.iter_commits(revs=[revision_range], patch=False))))
+    llm = client.get_client()
+    backend = llm.async_client.backend.name
+    # Stub reviews are not worth resuming and must not end up in the index.
+    index = None if backend == "stub" else commit_index.get_index()
+    key = checkpoint_key(backend, model, temperature, options)
+    done = {} if restart or index is None else index.get_reviews([c.commit_hash for c in commits], key)
+
+    for commit in commits:
+        if commit.commit_hash in done:
+            _print_commit_review(commit, done[commit.commit_hash])
+
+    pending = [commit for commit in commits if commit.commit_hash not in done]
+    if not pending:
+        return []
+    print(f"Reviewing {len(pending)} of {len(commits)} commits...", file=sys.stderr)
+
+    # A scheduler of the range's own, so retries go through the same limiter
+    # as first attempts and the shared client keeps its limits.
+    range_client = client.AsyncClient(
+        llm.async_client.backend, scheduler.Scheduler.from_env(requests_per_minute=requests_per_minute)
+    )
+    semaphore = asyncio.Semaphore(workers)
+
+    # The commits of a range are reviewed without repository context.
+    chunk_options = dataclasses.replace(options, context_tokens=0)
+
+    # The chunks of large commits share the workers with the other commits.
+    async def complete(request: openai.ChatRequest) -> str:
+        async with semaphore:
+            response = await range_client.chat_completion(request)
+        return response.message.content
+
+    async def review(commit: git.Commit) -> str:
+        diff = patch.compact(await asyncio.to_thread(git.show, commit.commit_hash))
+        if tokens.count(diff, model) <= options.threshold:
+            return await complete(_review_request(diff, model, temperature))
+        return await _review_in_chunks(complete, diff, chunk_options, model, temperature)
+
+    futures = {llm.submit(review(commit)): commit for commit in pending}
+
+    failed = []
+    try:
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            commit = futures[future]
+            try:
+                code_review = future.result()
+            except Exception as e:
+                LOGGER.debug("Review of %s failed", commit.commit_hash, exc_info=True)
+                print(f"[{i}/{len(pending)}] {commit.commit_hash[:7]} failed: {e}", file=sys.stderr)
+                failed.append(commit)
+                continue
+            if index is not None:
+                index.put_review(commit.commit_hash, key, code_review)
+            print(f"[{i}/{len(pending)}] {commit.commit_hash[:7]}", file=sys.stderr)
+            _print_commit_review(commit, code_review)
+    finally:
+        for future in futures:
+            future.cancel()
+    return failed
+
+
+def checkpoint_key(backend: str, model: str, temperature: float, options: ChunkOptions) -> str:
+    """
+    Returns the key of the reviews `commit_range` checkpoints.
+
+    Like `cache.completion_key`, it covers everything that influences a
+    review: the backend, the model, the instructions and the options.
+    """
+    return cache.key(
+        "range_review",
+        backend,
+        model,
+        temperature,
+        REVIEW_INSTRUCTION,
+        REDUCE_INSTRUCTION,
+        options.threshold,
+        options.chunk_tokens,
+    )
+
+
+def _print_commit_review(commit: git.Commit, code_review: str) -> None:
+    subject = commit.message.split("\n", 1)[0]
+    print_review(f"# {commit.commit_hash[:7]} {subject}\n\n{code_review}")
+
+
+def stdin(options: t.Optional[ChunkOptions] = None) -> None:
     diff = sys.stdin.read()
-    code_review = ask_for_review(diff)
+    code_review = review_diff(diff, options)
     print_review(code_review)
 
 
-def file(file):
-    with open(file, "r") as f:
-        code = f.read()
-        code_review = ask_for_code_review(code)
-        print_review(code_review)
+def file(file: str) -> None:
+    """
+    Reviews a single source file, see `files`.
+    """
+    files([file])
 
 
-def ask_for_review(
-    diff: str,
+def files(
+    paths: t.Iterable[str],
+    options: t.Optional[ChunkOptions] = None,
     model: str = openai.Models.DEFAULT_MODEL,
     temperature: float = 0.2,
-) -> str:
+) -> None:
     """
-    This function takes a git diff as input and returns a code review
-    as output.
+    Reviews source files concurrently.
+
+    Paths may be files, directories or globs. At most `options.workers`
+    requests run at a time. Files above the chunk threshold are split on
+    top-level definitions into chunks of `options.chunk_tokens` tokens, and
+    the reviews of the chunks are printed together.
+
+    Reviews are cached by the content hash of the file, so reviewing the
+    same files again only pays for the ones that changed.
+
+    Raises:
+        FileNotFoundError: If a path does not exist or a glob matches
+            nothing.
+        ValueError: If the paths match no text files.
     """
-    instruction = """
+    options = options or ChunkOptions()
+    llm = client.get_client()
+    backend = llm.async_client.backend.name
+    semaphore = asyncio.Semaphore(options.workers)
+
+    async def review(path: source.Path, text: str) -> str:
+        if tokens.count(text, model) <= options.threshold:
+            segments = [source.Segment(1, text.count("\n") + 1, text)]
+        else:
+            segments = source.split(text, options.chunk_tokens, path, lambda text: tokens.count(text, model))
+
+        async def review_segment(segment: source.Segment) -> str:
+            content = f"{path} (lines {segment.start}-{segment.end})\n\n{segment.text}"
+            async with semaphore:
+                response = await llm.async_client.chat_completion(_file_review_request(content, model, temperature))
+            return response.message.content
+
+        reviews = await asyncio.gather(*(review_segment(segment) for segment in segments))
+        if len(reviews) == 1:
+            return reviews[0]
+        return "\n\n".join(f"## Lines {s.start}-{s.end}\n\n{r}" for s, r in zip(segments, reviews, strict=True))
+
+    futures: dict[concurrent.futures.Future[str], tuple[source.Path, str]] = {}
+    reviewed = 0
+    for path in source.expand(paths):
+        text = source.read_text(path)
+        if text is None:
+            LOGGER.info("Skipping binary file %s", path)
+            continue
+        reviewed += 1
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        key = cache.key(
+            "file_review",
+            backend,
+            model,
+            temperature,
+            FILE_REVIEW_INSTRUCTION,
+            options.threshold,
+            options.chunk_tokens,
+            digest,
+        )
+        cached = cache.get_cache(cache.REVIEWS).get(key) if cache.enabled else None
+        if cached is not None:
+            print_review(f"# {path}\n\n{cached['review']}")
+            continue
+        futures[llm.submit(review(path, text))] = (path, key)
+
+    if not reviewed:
+        raise ValueError("No text files to review.")
+    if not futures:
+        return
+    print(f"Reviewing {len(futures)} of {reviewed} files with {options.workers} workers...", file=sys.stderr)
+
+    try:
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            path, key = futures[future]
+            code_review = future.result()
+            if cache.enabled:
+                cache.get_cache(cache.REVIEWS).put(key, {"review": code_review})
+            print(f"[{i}/{len(futures)}] {path}", file=sys.stderr)
+            print_review(f"# {path}\n\n{code_review}")
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+REVIEW_INSTRUCTION = """
 You will receive a git diff.
 Respond with a code review of the commit.
 Look for bugs, security issues, and opportunities for improvement.
@@ -52,42 +320,426 @@ Provide short actionable comments with examples if needed.
 If no issues are found, respond with "Looks good to me".
 Use markdown to format your review.
 """
-    response = openai.chat_completion(
-        request=openai.ChatRequest(
-            model=model,
-            messages=[
-                openai.SystemMessage(instruction),
-                openai.UserMessage(diff),
-            ],
-            temperature=temperature,
-        )
-    )
+
+
+CONTEXT_INSTRUCTION = """
+The following code from the repository is referenced by or uses the code in the diff.
+It is context only, do not review it.
+"""
+
+
+def _review_request(
+    diff: str, model: str, temperature: float, context: str = "", instruction: str = REVIEW_INSTRUCTION
+) -> openai.ChatRequest:
+    messages = [openai.SystemMessage(instruction)]
+    if context:
+        messages.append(openai.UserMessage(CONTEXT_INSTRUCTION + "\n" + context))
+    messages.append(openai.UserMessage(diff))
+    return openai.ChatRequest(model=model, messages=messages, temperature=temperature)
+
+
+def ask_for_review(
+    diff: str,
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+    context_tokens: int = ChunkOptions.context_tokens,
+) -> str:
+    """
+    This function takes a git diff as input and returns a code review
+    as output.
+    """
+    diff = patch.compact(diff)
+    context = symbol_index.context(diff, context_tokens, model, symbol_index.side(diff))
+    response = openai.chat_completion(request=_review_request(diff, model, temperature, context))
     msg = response.choices[0].message.content
 
     return msg
 
 
-def ask_for_code_review(
-    code: str,
+def stream_review(
+    diff: str,
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+    context: str = "",
+) -> t.Iterator[str]:
+    """
+    Same as `ask_for_review`, but yields the review as it is generated.
+    """
+    request = _review_request(diff, model, temperature, context)
+    request.stream = True
+    return openai.chat_completion_stream(request=request)
+
+
+REDUCE_INSTRUCTION = """
+You will receive code reviews of different parts of the same git diff.
+Merge them into a single code review of the whole diff.
+Remove duplicate comments and keep the most important ones first.
+If none of the reviews found any issues, respond with "Looks good to me".
+Use markdown to format your review.
+"""
+
+
+def review_diff(diff: str, options: t.Optional[ChunkOptions] = None) -> t.Iterator[str]:
+    """
+    Reviews a diff, yielding the review as it is generated.
+
+    The diff is compacted with `patch.compact` first. The definitions and
+    callers of the changed code are looked up in the symbol index and sent
+    along as context. Diffs above the size threshold are reviewed with
+    `map_reduce_review`.
+    """
+    options = options or ChunkOptions()
+    diff = patch.compact(diff)
+    diff_tokens = tokens.count(diff, openai.Models.DEFAULT_MODEL)
+    LOGGER.info("Diff: %d tokens", diff_tokens)
+    if diff_tokens <= options.threshold:
+        context = symbol_index.context(
+            diff, options.context_tokens, openai.Models.DEFAULT_MODEL, symbol_index.side(diff)
+        )
+        return stream_review(diff, context=context)
+
+    return map_reduce_review(diff, options)
+
+
+def map_reduce_review(
+    diff: str,
+    options: ChunkOptions,
     model: str = openai.Models.DEFAULT_MODEL,
     temperature: float = 0.2,
+) -> t.Iterator[str]:
+    """
+    Reviews a large diff in chunks.
+
+    The diff is split on file and hunk boundaries into chunks that fit the
+    token budget. The chunks are reviewed concurrently over the shared
+    connection pool and the reviews are merged into one in a final request,
+    which is streamed.
+    """
+    requests = _chunk_requests(diff, options, model, temperature)
+    print(f"Reviewing {len(requests)} chunks with {options.workers} workers...", file=sys.stderr)
+
+    responses = client.gather(requests, concurrency=options.workers)
+    reviews = [response.message.content for response in responses]
+
+    if len(reviews) == 1:
+        return iter(reviews)
+
+    request = _reduce_request(reviews, model, temperature)
+    request.stream = True
+    return openai.chat_completion_stream(request=request)
+
+
+async def _review_in_chunks(
+    complete: t.Callable[[openai.ChatRequest], t.Awaitable[str]],
+    diff: str,
+    options: ChunkOptions,
+    model: str,
+    temperature: float,
 ) -> str:
-    instruction = """
-Respond with a code review of the commit.
+    """
+    Same as `map_reduce_review`, but runs the requests with `complete` and
+    returns the merged review as a whole.
+    """
+    requests = await asyncio.to_thread(_chunk_requests, diff, options, model, temperature)
+    reviews = await asyncio.gather(*(complete(request) for request in requests))
+    if len(reviews) == 1:
+        return reviews[0]
+    return await complete(_reduce_request(reviews, model, temperature))
+
+
+def _chunk_requests(diff: str, options: ChunkOptions, model: str, temperature: float) -> list[openai.ChatRequest]:
+    parsed = patch.parse(diff)
+    # Without files the whole diff is the preamble and is split itself.
+    preamble = parsed.preamble if parsed.files else ""
+    side = symbol_index.side(diff)
+    chunks = patch.chunks(diff, max_tokens=options.chunk_tokens, count_tokens=lambda text: tokens.count(text, model))
+    requests = []
+    for chunk in chunks:
+        context = symbol_index.context(chunk, options.context_tokens, model, side)
+        requests.append(_review_request(preamble + chunk, model, temperature, context))
+    return requests
+
+
+def _reduce_request(reviews: list[str], model: str, temperature: float) -> openai.ChatRequest:
+    merged = "\n\n".join(f"# Review of part {i} of {len(reviews)}\n\n{review}" for i, review in enumerate(reviews, 1))
+    return openai.ChatRequest(
+        model=model,
+        messages=[
+            openai.SystemMessage(REDUCE_INSTRUCTION),
+            openai.UserMessage(merged),
+        ],
+        temperature=temperature,
+    )
+
+
+HUNK_REVIEW_INSTRUCTION = """
+You will receive hunks of a git diff, each labeled like [H1] on the line before it.
+Respond with a code review of the changes.
 Look for bugs, security issues, and opportunities for improvement.
 Provide short actionable comments with examples if needed.
+Put the comments on each hunk under its label on a line of its own, e.g. [H1].
+Put comments on the diff as a whole under [general].
+Leave out hunks without issues.
+If no issues are found, respond with "Looks good to me".
 Use markdown to format your review.
 """
-    response = openai.chat_completion(
-        request=openai.ChatRequest(
-            model=model,
-            messages=[
-                openai.SystemMessage(instruction),
-                openai.UserMessage(code),
-            ],
-            temperature=temperature,
+
+HUNK_LABEL = re.compile(r"^[\s#*]*\[(H\d+|general)\][*:]*\s*(.*)$")
+"""
+A label of `HUNK_REVIEW_INSTRUCTION` in a review, and the text after it.
+"""
+
+NO_ISSUES = "Looks good to me"
+
+
+@dataclass
+class HunkReview:
+    """
+    A hunk of a diff, or a file without hunks such as a binary file, and
+    the findings of its review.
+    """
+
+    file: patch.FileDiff
+    hunk: t.Optional[patch.Hunk]
+    fingerprint: str
+    findings: t.Optional[str] = None
+    """
+    The comments on the hunk, empty if there are none, or None while it is
+    not reviewed.
+    """
+
+    @property
+    def title(self) -> str:
+        match = patch.HUNK_HEADER.match(self.hunk.header) if self.hunk else None
+        return f"{self.file.path}:{match.group(3)}" if match else self.file.path
+
+
+def _hunk_reviews(diff: patch.Patch, max_tokens: int, count_tokens: t.Callable[[str], int]) -> list[HunkReview]:
+    """
+    Returns the hunks of the diff to review. Hunks that do not fit in
+    `max_tokens` with the header of their file are split between lines, and
+    each piece is reviewed and stored on its own.
+    """
+    reviews = []
+    for file in diff.files:
+        budget = max(max_tokens - count_tokens(file.header_text), 1)
+        for hunk in file.hunks or [None]:
+            pieces = patch.split_hunk(hunk, budget, count_tokens) if hunk else [None]
+            reviews += [HunkReview(file, piece, patch.fingerprint(file, piece)) for piece in pieces]
+    return reviews
+
+
+def _labeled_diff(preamble: str, reviews: list[HunkReview], labels: list[str]) -> str:
+    """
+    Returns the diff of the hunks with the label of each hunk on the line
+    before it.
+    """
+    parts = [preamble]
+    file = None
+    for review, label in zip(reviews, labels, strict=True):
+        if review.hunk is None:
+            parts.append(f"[{label}]\n{review.file.text}")
+        else:
+            if review.file is not file:
+                parts.append(review.file.header_text)
+            parts.append(f"[{label}]\n{review.hunk.text}")
+        file = review.file
+    return "".join(parts)
+
+
+def _split_findings(text: str) -> dict[str, str]:
+    """
+    Splits a review into the comments under each label. Comments before the
+    first label are about the diff as a whole, like those under [general].
+    """
+    sections: dict[str, list[str]] = {"general": []}
+    current = "general"
+    for line in text.split("\n"):
+        match = HUNK_LABEL.match(line)
+        if match:
+            current = match.group(1)
+            sections.setdefault(current, [])
+            line = match.group(2)
+            if not line:
+                continue
+        sections[current].append(line)
+
+    findings = {label: "\n".join(lines).strip() for label, lines in sections.items()}
+    if findings["general"].rstrip(".!").lower() == NO_ISSUES.lower():
+        findings["general"] = ""
+    return findings
+
+
+def _format_findings(general: t.Iterable[str], reviews: t.Iterable[HunkReview]) -> str:
+    general = [text for text in general if text]
+    parts = ["### General\n\n" + "\n\n".join(general)] if general else []
+    parts += [f"### {review.title}\n\n{review.findings}" for review in reviews if review.findings]
+    return "\n\n".join(parts)
+
+
+def _relabel(chunks: t.Iterable[str], titles: dict[str, str], on_done: t.Callable[[str], None]) -> t.Iterator[str]:
+    """
+    Yields a streamed review line by line, with the labels replaced by
+    headings with the titles of the hunks, and passes the complete review
+    to `on_done` once the stream ends.
+    """
+
+    def heading(line: str) -> str:
+        match = HUNK_LABEL.match(line)
+        if match is None:
+            return line
+        title = f"### {titles.get(match.group(1), match.group(1))}\n"
+        return f"{title}\n{match.group(2)}" if match.group(2) else title
+
+    text = []
+    pending = ""
+    for chunk in chunks:
+        text.append(chunk)
+        *lines, pending = (pending + chunk).split("\n")
+        for line in lines:
+            yield heading(line) + "\n"
+    if pending:
+        yield heading(pending)
+    on_done("".join(text))
+
+
+def incremental_review(
+    diff: str,
+    options: t.Optional[ChunkOptions] = None,
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+) -> t.Iterator[str]:
+    """
+    Reviews a diff hunk by hunk, reusing the findings on hunks that were
+    reviewed before, and yields the review as it is generated.
+
+    The model is asked to group its comments by hunk, and the comments are
+    stored per hunk by `patch.fingerprint`. Reviewing again after fixing a
+    line therefore only sends the hunks that changed. Comments on the diff
+    as a whole are reused as long as all hunks they were made on are
+    unchanged.
+
+    New hunks within the size threshold are reviewed in one streamed
+    request, larger sets concurrently in batches of `options.chunk_tokens`,
+    with hunks that are larger than a batch split between lines.
+    Findings are neither reused nor stored with `--no-cache`.
+    """
+    options = options or ChunkOptions()
+    parsed = patch.parse(patch.compact(diff))
+    reviews = _hunk_reviews(parsed, options.chunk_tokens, lambda text: tokens.count(text, model))
+    if not reviews:
+        yield from review_diff(diff, options)
+        return
+
+    llm = client.get_client()
+    store = cache.get_cache(cache.REVIEWS) if cache.enabled else None
+    side = symbol_index.side(diff)
+
+    def key(*parts: str) -> str:
+        return cache.key(
+            "hunk_review", llm.async_client.backend.name, model, temperature, HUNK_REVIEW_INSTRUCTION, *parts
         )
+
+    general: list[str] = []
+    if store is not None:
+        batch_ids = set()
+        for review in reviews:
+            entry = store.get(key(review.fingerprint))
+            if entry is not None:
+                review.findings = entry["findings"]
+                batch_ids.add(entry["batch"])
+        fingerprints = {review.fingerprint for review in reviews}
+        for batch_id in sorted(batch_ids):
+            batch = store.get(key("batch", batch_id))
+            if batch is not None and batch["general"] and set(batch["hunks"]) <= fingerprints:
+                general.append(batch["general"])
+
+    new = [review for review in reviews if review.findings is None]
+    reused = _format_findings(general, (review for review in reviews if review.findings is not None))
+    if not new:
+        print(f"All {len(reviews)} hunks are unchanged since their review.", file=sys.stderr)
+        yield reused or NO_ISSUES
+        return
+    if len(new) < len(reviews):
+        print(f"Reviewing {len(new)} of {len(reviews)} hunks, the others are unchanged.", file=sys.stderr)
+
+    def save(batch: list[HunkReview], labels: list[str], text: str) -> dict[str, str]:
+        findings = _split_findings(text)
+        for review, label in zip(batch, labels, strict=True):
+            review.findings = findings.get(label, "")
+        if store is not None:
+            hunks = [review.fingerprint for review in batch]
+            batch_id = hashlib.sha256("".join(sorted(hunks)).encode("utf-8")).hexdigest()
+            store.put(key("batch", batch_id), {"hunks": hunks, "general": findings["general"]})
+            for review in batch:
+                store.put(key(review.fingerprint), {"findings": review.findings, "batch": batch_id})
+        return findings
+
+    labels = [f"H{i}" for i in range(1, len(new) + 1)]
+    prefix = f"## Unchanged hunks\n\n{reused}\n\n## Changed hunks\n\n" if reused else ""
+    request_diff = _labeled_diff(parsed.preamble, new, labels)
+    if tokens.count(request_diff, model) <= options.threshold:
+        context = symbol_index.context(request_diff, options.context_tokens, model, side)
+        request = _review_request(request_diff, model, temperature, context, HUNK_REVIEW_INSTRUCTION)
+        request.stream = True
+        titles = {"general": "General", **{label: review.title for label, review in zip(labels, new, strict=True)}}
+        if prefix:
+            yield prefix
+        yield from _relabel(
+            openai.chat_completion_stream(request=request), titles, lambda text: save(new, labels, text)
+        )
+        return
+
+    batches: list[list[int]] = [[]]
+    batch_tokens = 0
+    for i, review in enumerate(new):
+        review_tokens = tokens.count(_labeled_diff("", [review], [labels[i]]), model)
+        if batches[-1] and batch_tokens + review_tokens > options.chunk_tokens:
+            batches.append([])
+            batch_tokens = 0
+        batches[-1].append(i)
+        batch_tokens += review_tokens
+    print(f"Reviewing {len(new)} hunks in {len(batches)} batches with {options.workers} workers...", file=sys.stderr)
+
+    requests = []
+    for batch in batches:
+        batch_diff = _labeled_diff(parsed.preamble, [new[i] for i in batch], [labels[i] for i in batch])
+        context = symbol_index.context(batch_diff, options.context_tokens, model, side)
+        requests.append(_review_request(batch_diff, model, temperature, context, HUNK_REVIEW_INSTRUCTION))
+    responses = client.gather(requests, concurrency=options.workers)
+
+    new_general = []
+    for batch, response in zip(batches, responses, strict=True):
+        findings = save([new[i] for i in batch], [labels[i] for i in batch], response.message.content)
+        new_general.append(findings["general"])
+    yield prefix + (_format_findings(new_general, new) or NO_ISSUES)
+
+
+FILE_REVIEW_INSTRUCTION = """
+Respond with a code review of the commit.
+Look for bugs, security issues, and opportunities for improvement.
+Provide short actionable comments with examples if needed.
+Use markdown to format your review.
+"""
+
+
+def _file_review_request(code: str, model: str, temperature: float) -> openai.ChatRequest:
+    return openai.ChatRequest(
+        model=model,
+        messages=[
+            openai.SystemMessage(FILE_REVIEW_INSTRUCTION),
+            openai.UserMessage(code),
+        ],
+        temperature=temperature,
     )
+
+
+def ask_for_code_review(
+    code: str,
+    model: str = openai.Models.DEFAULT_MODEL,
+    temperature: float = 0.2,
+) -> str:
+    response = openai.chat_completion(request=_file_review_request(code, model, temperature))
     msg = response.choices[0].message.content
 
     return msg
@@ -1,7 +1,15 @@
-from ci import git, highlight
+from ci import git, highlight, pager
 
 
-def show(commit_hash: str):
-    text = git.show(commit_hash)
-    highlighted_text = highlight.diff(text)
-    print(highlighted_text)
+def show(commit_hash: str, pygments: bool = False, use_pager: bool = True):
+    if pygments:
+        text = git.show(commit_hash)
+        highlighted_text = highlight.diff(text)
+        with pager.pager(use_pager) as out:
+            out.write(highlighted_text)
+        return
+
+    lines = git.iter_show(commit_hash)
+    with pager.pager(use_pager) as out:
+        for line in highlight.iter_diff(lines):
+            out.write(line)
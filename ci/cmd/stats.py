@@ -0,0 +1,113 @@
+import json
+import statistics
+import time
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from ci import telemetry
+from ci.llm import tokens
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def _timings(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(_percentile(values, 50), 1),
+        "p95_ms": round(_percentile(values, 95), 1),
+        "total_ms": round(sum(values), 1),
+    }
+
+
+def summarize(spans: Iterable[dict]) -> dict:
+    """
+    Aggregates spans into latency percentiles per stage, and token usage and
+    cost per model.
+    """
+    runs = set()
+    durations: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    models: dict[str, dict] = {}
+    ttft: dict[str, list[float]] = defaultdict(list)
+
+    for span in spans:
+        name = span["name"]
+        attributes = span.get("attributes") or {}
+        runs.add(span.get("run"))
+        durations[name].append(span["duration_ms"])
+        if "error" in attributes:
+            errors[name] += 1
+
+        if name != "llm.chat_completion" or "error" in attributes or attributes.get("cancelled"):
+            continue
+        model = attributes.get("model", "unknown")
+        usage = models.setdefault(
+            model, {"requests": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+        )
+        usage["requests"] += 1
+        if attributes.get("cached"):
+            usage["cached"] += 1
+            continue
+        prompt_tokens = attributes.get("prompt_tokens", 0)
+        completion_tokens = attributes.get("completion_tokens", 0)
+        usage["prompt_tokens"] += prompt_tokens
+        usage["completion_tokens"] += completion_tokens
+        if attributes.get("backend", "openai") == "openai":
+            usage["cost_usd"] += tokens.cost(model, prompt_tokens, completion_tokens)
+        if "ttft_ms" in attributes:
+            ttft[model].append(attributes["ttft_ms"])
+
+    for model, usage in models.items():
+        usage["cost_usd"] = round(usage["cost_usd"], 4)
+        if ttft[model]:
+            usage["ttft_p50_ms"] = round(_percentile(ttft[model], 50), 1)
+            usage["ttft_p95_ms"] = round(_percentile(ttft[model], 95), 1)
+
+    return {
+        "runs": len(runs),
+        "stages": {name: {**_timings(values), "errors": errors[name]} for name, values in sorted(durations.items())},
+        "models": models,
+    }
+
+
+def stats(days: Optional[float] = None, as_json: bool = False) -> None:
+    """
+    Prints latency, token and cost statistics of the recorded runs.
+
+    Args:
+        days: Only include runs of the last `days` days.
+        as_json: Print the statistics as JSON.
+    """
+    since = None if days is None else time.time() - days * 86400
+    summary = summarize(telemetry.read(since=since))
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    if not summary["stages"]:
+        print(f"No telemetry recorded in {telemetry.telemetry_file()}, set CI_TELEMETRY=1 to record it")
+        return
+
+    print(f"{summary['runs']} runs\n")
+    width = max(len(name) for name in summary["stages"])
+    print(f"{'stage':<{width}}  {'count':>7}  {'p50 ms':>9}  {'p95 ms':>9}  {'errors':>6}")
+    for name, stage in summary["stages"].items():
+        print(
+            f"{name:<{width}}  {stage['count']:>7}  {stage['p50_ms']:>9.1f}  {stage['p95_ms']:>9.1f}"
+            f"  {stage['errors']:>6}"
+        )
+
+    if summary["models"]:
+        print()
+        print(f"{'model':<20}  {'requests':>8}  {'cached':>6}  {'prompt':>10}  {'completion':>10}  {'cost USD':>9}")
+        for model, usage in summary["models"].items():
+            print(
+                f"{model:<20}  {usage['requests']:>8}  {usage['cached']:>6}  {usage['prompt_tokens']:>10}"
+                f"  {usage['completion_tokens']:>10}  {usage['cost_usd']:>9.4f}"
+            )
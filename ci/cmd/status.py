@@ -1,11 +1,113 @@
-from typing import Optional
+import posixpath
+import sys
+from typing import Iterable, Iterator, Optional, Union
 
 from ci import git, highlight
 
+CHANGE_LABELS = {
+    "M": "modified",
+    "T": "typechange",
+    "A": "new file",
+    "D": "deleted",
+    "R": "renamed",
+    "C": "copied",
+}
 
-def status(file_path: Optional[str]):
+CONFLICT_LABELS = {
+    "DD": "both deleted",
+    "AU": "added by us",
+    "UD": "deleted by them",
+    "UA": "added by them",
+    "DU": "deleted by us",
+    "AA": "both added",
+    "UU": "both modified",
+}
+
+
+def status(file_path: Optional[str], untracked: str = "normal"):
     """Show status"""
 
-    text = git.status(file_path)
-    highlighted_text = highlight.git_status(text)
-    print(highlighted_text)
+    records = git.iter_status_records([file_path] if file_path else [], untracked=untracked, branch=True)
+    for line in highlight.iter_git_status(render(records, git.show_prefix())):
+        sys.stdout.write(line)
+
+
+def render(records: Iterable[Union[git.BranchStatus, git.StatusEntry]], prefix: str = "") -> Iterator[str]:
+    """
+    Renders porcelain v2 status records in the long format of `git status`.
+
+    Args:
+        records: The records, with paths relative to the top of the worktree.
+        prefix: The current directory within the worktree, see
+            `git.show_prefix`. Paths are shown relative to it, like
+            `git status` does.
+    """
+
+    def relative(path: str) -> str:
+        if not prefix:
+            return path
+        # Keeps the trailing slash of untracked directories.
+        return posixpath.relpath(path, prefix) + ("/" if path.endswith("/") else "")
+
+    staged: list[str] = []
+    unmerged: list[str] = []
+    unstaged: list[str] = []
+    untracked: list[str] = []
+
+    for record in records:
+        if isinstance(record, git.BranchStatus):
+            yield from _render_branch(record)
+            continue
+
+        path = relative(record.path)
+        renamed = f"{relative(record.orig_path)} -> {path}" if record.orig_path else path
+        if record.conflicted:
+            unmerged.append(f"\t{CONFLICT_LABELS.get(record.xy, 'unmerged') + ':':<17}{path}\n")
+        elif record.untracked:
+            untracked.append(f"\t{path}\n")
+        else:
+            if record.staged:
+                staged.append(f"\t{CHANGE_LABELS.get(record.xy[0], 'changed') + ':':<12}{renamed}\n")
+            if record.unstaged:
+                unstaged.append(f"\t{CHANGE_LABELS.get(record.xy[1], 'changed') + ':':<12}{path}\n")
+
+    sections = [
+        ("Changes to be committed:", staged),
+        ("Unmerged paths:", unmerged),
+        ("Changes not staged for commit:", unstaged),
+        ("Untracked files:", untracked),
+    ]
+    if not any(lines for _, lines in sections):
+        yield "\n"
+        yield "nothing to commit, working tree clean\n"
+        return
+
+    for title, lines in sections:
+        if lines:
+            yield "\n"
+            yield f"{title}\n"
+            yield from lines
+
+
+def _render_branch(branch: git.BranchStatus) -> Iterator[str]:
+    if branch.head is not None:
+        yield f"On branch {branch.head}\n"
+    else:
+        yield f"HEAD detached at {(branch.oid or '')[:7]}\n"
+
+    if branch.oid is None:
+        yield "\n"
+        yield "No commits yet\n"
+    elif branch.upstream is not None:
+        if branch.ahead and branch.behind:
+            yield f"Your branch and '{branch.upstream}' have diverged, by {branch.ahead} and {branch.behind} commits.\n"
+        elif branch.ahead:
+            yield f"Your branch is ahead of '{branch.upstream}' by {_commits(branch.ahead)}.\n"
+        elif branch.behind:
+            yield f"Your branch is behind '{branch.upstream}' by {_commits(branch.behind)}.\n"
+        else:
+            yield f"Your branch is up to date with '{branch.upstream}'.\n"
+
+
+def _commits(n: int) -> str:
+    return f"{n} commit" if n == 1 else f"{n} commits"
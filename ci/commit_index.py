@@ -0,0 +1,123 @@
+import logging
+import sqlite3
+import subprocess
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+from ci import git
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CommitIndex:
+    """
+    Persistent index of parsed commits keyed by commit hash.
+
+    Commits are immutable, so entries never need to be invalidated. The
+    index is filled as commits are looked up, see `git.latest_commits` and
+    `git.show`, rather than by walking every ref up front.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS commits (
+                commit_hash TEXT PRIMARY KEY,
+                author TEXT NOT NULL,
+                date TEXT NOT NULL,
+                message TEXT NOT NULL,
+                diff TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS range_reviews (
+                commit_hash TEXT NOT NULL,
+                key TEXT NOT NULL,
+                review TEXT NOT NULL,
+                PRIMARY KEY (commit_hash, key)
+            );
+            """)
+
+    def get(self, commit_hashes: Iterable[str]) -> dict[str, git.Commit]:
+        """
+        Returns the indexed commits among the hashes.
+        """
+        commit_hashes = list(commit_hashes)
+        commits: dict[str, git.Commit] = {}
+        with self._lock:
+            for i in range(0, len(commit_hashes), 500):
+                batch = commit_hashes[i : i + 500]
+                rows = self._db.execute(
+                    "SELECT commit_hash, author, date, message, diff FROM commits "
+                    f"WHERE commit_hash IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for commit_hash, author, date, message, diff in rows:
+                    commits[commit_hash] = git.Commit(
+                        commit_hash=commit_hash,
+                        author=author,
+                        date=date,
+                        message=message,
+                        diff=git.Diff(diff) if diff else git.EmptyDiff(),
+                    )
+        return commits
+
+    def put(self, commits: Iterable[git.Commit]) -> None:
+        rows = [
+            (commit.commit_hash, commit.author, commit.date, commit.message, commit.diff.text) for commit in commits
+        ]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get_reviews(self, commit_hashes: Iterable[str], key: str) -> dict[str, str]:
+        """
+        Returns the stored reviews of the commits under the key.
+
+        The key identifies how the commits were reviewed, see
+        `review.checkpoint_key`, so reviews by another backend, model or
+        prompt are never returned.
+        """
+        commit_hashes = list(commit_hashes)
+        reviews: dict[str, str] = {}
+        with self._lock:
+            for i in range(0, len(commit_hashes), 500):
+                batch = commit_hashes[i : i + 500]
+                rows = self._db.execute(
+                    "SELECT commit_hash, review FROM range_reviews "
+                    f"WHERE key = ? AND commit_hash IN ({', '.join('?' * len(batch))})",
+                    [key, *batch],
+                ).fetchall()
+                reviews.update(rows)
+        return reviews
+
+    def put_review(self, commit_hash: str, key: str, review: str) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO range_reviews VALUES (?, ?, ?)", (commit_hash, key, review))
+
+
+_indexes: dict[Path, Optional[CommitIndex]] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index() -> Optional[CommitIndex]:
+    """
+    Returns the index of the current repository, stored in
+    `.git/ci-cache/index.sqlite3`, or None if it cannot be opened.
+    """
+    try:
+        path = git.cache_dir() / "index.sqlite3"
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    with _indexes_lock:
+        if path not in _indexes:
+            try:
+                _indexes[path] = CommitIndex(path)
+            except (OSError, sqlite3.Error) as e:
+                LOGGER.debug("Commit index disabled: %s", e)
+                _indexes[path] = None
+        return _indexes[path]
@@ -0,0 +1,563 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+COMMANDS = ("review",)
+"""
+Commands that are run in the daemon when one is running. The daemon has no
+controlling terminal, so commands that open an editor on it, such as
+`ag ci` through `git commit -e`, always run in the process of the client.
+"""
+
+IDLE_TIMEOUT = 60 * 60
+"""
+The daemon exits after this many seconds without a command.
+"""
+
+START_TIMEOUT = 10
+"""
+Seconds to wait for a daemon started in the background to listen.
+"""
+
+REQUEST_TIMEOUT = 5
+"""
+Seconds a client has to send its request after connecting, so a client
+that connects and sends nothing does not block other clients.
+"""
+
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+STANDARD_STREAMS = (0, 1, 2)
+
+HEADER = struct.Struct("!I")
+
+
+def socket_path() -> Path:
+    """
+    Returns the socket the daemon listens on, `$CI_DAEMON_SOCKET`,
+    `$XDG_RUNTIME_DIR/ci/ag.sock` or `/tmp/ci-<uid>/ag.sock`.
+    """
+    if os.environ.get("CI_DAEMON_SOCKET"):
+        return Path(os.environ["CI_DAEMON_SOCKET"])
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return Path(os.environ["XDG_RUNTIME_DIR"]) / "ci" / "ag.sock"
+    return Path(tempfile.gettempdir()) / f"ci-{os.getuid()}" / "ag.sock"
+
+
+def _send(sock: socket.socket, message: dict[str, Any], fds: tuple[int, ...] = ()) -> None:
+    data = json.dumps(message).encode("utf-8")
+    header = HEADER.pack(len(data))
+    if fds:
+        # The descriptors travel with the first byte of the message.
+        socket.send_fds(sock, [header[:1]], list(fds))
+        header = header[1:]
+    sock.sendall(header + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return data
+
+
+def _recv(sock: socket.socket, max_fds: int = 0) -> tuple[dict[str, Any], list[int]]:
+    """
+    Receives a message and the file descriptors sent with it.
+
+    Raises:
+        EOFError: If the connection was closed.
+        ValueError: If the message is malformed.
+    """
+    fds: list[int] = []
+    if max_fds:
+        first, fds, _, _ = socket.recv_fds(sock, 1, max_fds)
+        if not first:
+            raise EOFError("Connection closed")
+        header = first + _recv_exactly(sock, HEADER.size - 1)
+    else:
+        header = _recv_exactly(sock, HEADER.size)
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Message of {size} bytes is too large")
+    return json.loads(_recv_exactly(sock, size)), fds
+
+
+def _is_private(directory: Path) -> bool:
+    """
+    Returns whether the directory of the socket is owned by this user and
+    accessible to no one else, so that no other user can listen on it.
+    """
+    try:
+        st = directory.lstat()
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def _peer_uid(sock: socket.socket) -> Optional[int]:
+    """
+    Returns the user of the process at the other end of the socket, or None
+    if the platform does not tell.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def _connect(path: Path) -> Optional[socket.socket]:
+    """
+    Connects to the daemon, if one of this user is listening on the socket.
+
+    The environment and the standard streams of commands are sent to the
+    daemon, so a socket in a directory that other users can write to, or
+    served by another user, is never used.
+    """
+    if not _is_private(path.parent):
+        LOGGER.debug("Not using %s, its directory is not private to this user", path)
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        uid = _peer_uid(sock)
+    except OSError:
+        sock.close()
+        return None
+    if uid is not None and uid != os.getuid():
+        LOGGER.debug("Not using %s, it is served by user %d", path, uid)
+        sock.close()
+        return None
+    return sock
+
+
+def _make_private_dir(directory: Path) -> None:
+    """
+    Creates the directory of the socket.
+
+    Raises:
+        RuntimeError: If it exists but is not private to this user.
+    """
+    directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if not _is_private(directory):
+        raise RuntimeError(f"{directory} must be a directory owned by this user with mode 0700")
+
+
+def is_running() -> bool:
+    sock = _connect(socket_path())
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def run(argv: list[str]) -> Optional[int]:
+    """
+    Runs an `ag` command in the daemon, with the standard streams, working
+    directory and environment of this process.
+
+    Ctrl-C interrupts the command in the daemon.
+
+    Args:
+        argv: The arguments of `ag`.
+
+    Returns:
+        The exit status of the command, or None if no daemon is running or
+        it is busy with another command, and the caller should run the
+        command itself.
+    """
+    sock = _connect(socket_path())
+    if sock is None:
+        return None
+
+    with sock:
+        try:
+            _send(sock, {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}, fds=STANDARD_STREAMS)
+            reply, _ = _recv(sock)
+        except (OSError, EOFError, ValueError) as e:
+            LOGGER.debug("Daemon unavailable: %s", e)
+            return None
+        if reply.get("status") != "started":
+            LOGGER.debug("Daemon %s, running in process", reply.get("status"))
+            return None
+
+        while True:
+            try:
+                reply, _ = _recv(sock)
+            except KeyboardInterrupt:
+                with contextlib.suppress(OSError):
+                    _send(sock, {"interrupt": True})
+                continue
+            except (OSError, EOFError, ValueError) as e:
+                print(f"ag: lost connection to the daemon: {e}", file=sys.stderr)
+                return 1
+            return int(reply["exit"])
+
+
+def stop() -> bool:
+    """
+    Stops the running daemon once its current command is done.
+
+    Returns:
+        True if a daemon was running.
+    """
+    sock = _connect(socket_path())
+    if sock is None:
+        return False
+    with sock:
+        try:
+            _send(sock, {"stop": True})
+            _recv(sock)
+        except (OSError, EOFError, ValueError):
+            pass
+    return True
+
+
+def start(idle_timeout: float = IDLE_TIMEOUT) -> Path:
+    """
+    Starts the daemon in the background, in a new session so that it has
+    no controlling terminal, and waits until it listens.
+
+    Its output goes to `ag.log` next to the socket.
+
+    Returns:
+        The socket the daemon listens on.
+
+    Raises:
+        RuntimeError: If the daemon exits or does not listen in time.
+    """
+    path = socket_path()
+    _make_private_dir(path.parent)
+    with open(path.with_suffix(".log"), "ab") as log:
+        p = subprocess.Popen(
+            [sys.executable, "-m", "ci.daemon", "--idle-timeout", str(idle_timeout)],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if is_running():
+            return path
+        if p.poll() is not None:
+            raise RuntimeError(f"Daemon exited with status {p.returncode}, see {path.with_suffix('.log')}")
+        time.sleep(0.05)
+    raise RuntimeError(f"Daemon did not start listening on {path} within {START_TIMEOUT} s")
+
+
+def _warm_up() -> None:
+    """
+    Imports the modules of the served commands and loads the lexers and
+    token encodings, which dominate the start of a cold `ag review`.
+    """
+    from ci import ag, highlight  # noqa: F401
+    from ci.cmd import review  # noqa: F401
+    from ci.llm import openai, tokens
+
+    highlight.markdown("# Review\n\n```python\npass\n```\n")
+    highlight.diff("--- a\n+++ b\n@@ -1 +1 @@\n-a\n+b\n")
+    tokens.count("warm up", openai.Models.DEFAULT_MODEL)
+
+
+def _reset_settings() -> None:
+    """
+    Reads the settings that modules read from the environment at import
+    again, for the environment of the command.
+    """
+    from ci import telemetry
+    from ci.llm import cache
+
+    cache.enabled = not os.environ.get("CI_NO_CACHE")
+    telemetry.enabled = telemetry.enabled_in_env()
+    telemetry.RUN_ID = os.urandom(8).hex()
+
+    if "openai" in sys.modules:
+        import openai
+
+        openai.api_key = os.environ.get("OPENAI_API_KEY")
+        openai.api_base = os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+        openai.organization = os.environ.get("OPENAI_ORGANIZATION")
+
+
+def _main(argv: list[str]) -> int:
+    from ci.ag import cli
+
+    try:
+        cli.main(args=argv, prog_name="ag")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def _execute(argv: list[str], cwd: str, env: dict[str, str], fds: list[int]) -> int:
+    """
+    Runs a command with the standard streams, working directory and
+    environment of the client, and restores those of the daemon after.
+
+    The received descriptors are duplicated onto 0, 1 and 2 so that
+    subprocesses such as git and the editor inherit them too. The root
+    logger is emptied so that `ag` configures its logging for the command,
+    writing to the client and honouring its `DEBUG`.
+    """
+    from ci import catfile, telemetry
+
+    root = logging.getLogger()
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    saved_streams = (sys.stdin, sys.stdout, sys.stderr)
+    saved_fds = [os.dup(fd) for fd in STANDARD_STREAMS]
+    saved_logging = (root.handlers[:], root.level)
+    root.handlers.clear()
+    try:
+        for fd, received in zip(STANDARD_STREAMS, fds, strict=True):
+            os.dup2(received, fd)
+        sys.stdin = open(0, encoding="utf-8", closefd=False)
+        sys.stdout = open(1, "w", buffering=1 if os.isatty(1) else -1, encoding="utf-8", closefd=False)
+        sys.stderr = open(2, "w", buffering=1, encoding="utf-8", closefd=False)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        _reset_settings()
+        return _main(argv)
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            with contextlib.suppress(OSError, ValueError):
+                stream.flush()
+        telemetry.flush()
+        # The workers are started in the directory of the command.
+        catfile.close_all()
+        for handler in root.handlers:
+            handler.close()
+        root.handlers[:], level = saved_logging
+        root.setLevel(level)
+        sys.stdin, sys.stdout, sys.stderr = saved_streams
+        for fd, saved in zip(STANDARD_STREAMS, saved_fds, strict=True):
+            os.dup2(saved, fd)
+            os.close(saved)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+
+
+class Server:
+    """
+    Runs `ag` commands sent over a Unix socket in a warm interpreter.
+
+    Commands run one at a time in the main thread of the daemon, so the
+    shared LLM client with its pooled connections, the caches and the
+    loaded lexers are reused by every command. A client that connects while
+    a command is running is told that the daemon is busy and runs its
+    command itself.
+    """
+
+    def __init__(self, path: Path, idle_timeout: float = IDLE_TIMEOUT):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._requests: queue.Queue = queue.Queue()
+        self._busy = threading.Lock()
+        self._interrupted = False
+        self._inode: Optional[int] = None
+
+    def serve_forever(self) -> None:
+        _make_private_dir(self.path.parent)
+        if is_running():
+            raise RuntimeError(f"A daemon is already listening on {self.path}")
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+        self._listener.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        self._inode = self.path.stat().st_ino
+        self._listener.listen()
+        LOGGER.info("Listening on %s", self.path)
+
+        threading.Thread(target=self._accept, name="ci-daemon-accept", daemon=True).start()
+        try:
+            while True:
+                try:
+                    item = self._requests.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    LOGGER.info("Idle for %d s, exiting", self.idle_timeout)
+                    return
+                except KeyboardInterrupt:
+                    # A late interrupt of a command that had already finished.
+                    if self._interrupted:
+                        self._interrupted = False
+                        continue
+                    raise
+                if item is None:
+                    LOGGER.info("Stopped")
+                    return
+                self._handle(*item)
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        """
+        Stops listening and removes the socket, unless a new daemon already
+        listens on the path.
+        """
+        self._listener.close()
+        with contextlib.suppress(FileNotFoundError):
+            if self.path.stat().st_ino == self._inode:
+                self.path.unlink()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            try:
+                conn.settimeout(REQUEST_TIMEOUT)
+                request, fds = _recv(conn, max_fds=len(STANDARD_STREAMS))
+                conn.settimeout(None)
+            except (OSError, EOFError, ValueError) as e:
+                LOGGER.debug("Bad request: %s", e)
+                conn.close()
+                continue
+
+            if request.get("stop"):
+                # The daemon is gone for clients once `stop` returns, even
+                # while its last command is still running.
+                self._close()
+                with contextlib.suppress(OSError):
+                    _send(conn, {"status": "stopping"})
+                conn.close()
+                self._requests.put(None)
+                return
+
+            if len(fds) != len(STANDARD_STREAMS) or not self._busy.acquire(blocking=False):
+                with contextlib.suppress(OSError):
+                    _send(conn, {"status": "busy"})
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+                continue
+            self._requests.put((conn, request, fds))
+
+    def _watch(self, conn: socket.socket, done: threading.Event) -> None:
+        """
+        Interrupts the running command when the client sends Ctrl-C or goes
+        away.
+        """
+        while True:
+            try:
+                message, _ = _recv(conn)
+            except (OSError, EOFError, ValueError):
+                message = None
+            if done.is_set():
+                return
+            if message is None or message.get("interrupt"):
+                self._interrupted = True
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+            if message is None:
+                return
+
+    def _handle(self, conn: socket.socket, request: dict[str, Any], fds: list[int]) -> None:
+        started = time.perf_counter()
+        done = threading.Event()
+        code = 1
+        with conn:
+            try:
+                _send(conn, {"status": "started"})
+                threading.Thread(target=self._watch, args=(conn, done), name="ci-daemon-watch", daemon=True).start()
+                code = _execute(request["argv"], request["cwd"], request["env"], fds)
+            except KeyboardInterrupt:
+                code = 130
+            except Exception:
+                LOGGER.exception("Command failed")
+            finally:
+                done.set()
+                self._interrupted = False
+                for fd in fds:
+                    os.close(fd)
+                self._busy.release()
+            elapsed = (time.perf_counter() - started) * 1000
+            LOGGER.info("ag %s: exit %d in %.0f ms", " ".join(request["argv"]), code, elapsed)
+            with contextlib.suppress(OSError):
+                _send(conn, {"exit": code})
+
+
+def serve(idle_timeout: float = IDLE_TIMEOUT) -> None:
+    """
+    Runs the daemon in this process until it is stopped or idle.
+    """
+    # Interrupts from clients are delivered as SIGINT, which is ignored in
+    # processes started in the background by some shells.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    _warm_up()
+    Server(socket_path(), idle_timeout).serve_forever()
+
+
+def _command(argv: list[str]) -> Optional[str]:
+    """
+    Returns the name of the command in the arguments of `ag`, skipping the
+    options of the group.
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg == "--backend":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
+def main() -> None:
+    """
+    Entry point of `ag`. Runs `ag review` in the daemon if one is running,
+    and every other command in this process.
+
+    Set `CI_DAEMON=0` to never use the daemon.
+    """
+    argv = sys.argv[1:]
+    if _command(argv) in COMMANDS and os.environ.get("CI_DAEMON", "1") != "0":
+        code = run(argv)
+        if code is not None:
+            sys.exit(code)
+
+    from ci.ag import cli
+
+    cli(prog_name="ag")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves `ag` commands over a Unix socket.")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if os.environ.get("DEBUG") else logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    serve(args.idle_timeout)
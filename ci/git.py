@@ -1,7 +1,13 @@
+import contextlib
+import functools
+import os
 import re
 import subprocess
 from dataclasses import dataclass, field
-from typing import Optional
+from pathlib import Path
+from typing import IO, Iterable, Iterator, Optional, Union
+
+from ci import catfile, telemetry
 
 
 @dataclass
@@ -33,6 +39,86 @@ class Commit:
         return f"{self.commit_hash} {self.author} {self.date}\n{self.message}"
 
 
+@functools.lru_cache(maxsize=None)
+def _git_dir(cwd: str) -> Path:
+    git_dir = subprocess.check_output(["git", "rev-parse", "--git-common-dir"], stderr=subprocess.DEVNULL)
+    return Path(cwd, git_dir.decode("utf-8").strip()).resolve()
+
+
+def git_dir() -> Path:
+    """
+    Returns the absolute path of the `.git` directory, shared by all
+    worktrees of the repository.
+    """
+    return _git_dir(os.getcwd())
+
+
+def cache_dir() -> Path:
+    """
+    Returns the directory for caches of the repository, `.git/ci-cache`.
+    """
+    return git_dir() / "ci-cache"
+
+
+def git_path(name: str) -> Path:
+    """
+    Returns the absolute path of a file in the `.git` directory as git
+    resolves it, e.g. the index of the current worktree or the hooks
+    directory set by `core.hooksPath`.
+    """
+    output = subprocess.check_output(["git", "rev-parse", "--git-path", name], stderr=subprocess.DEVNULL)
+    return Path(output.decode("utf-8").strip()).resolve()
+
+
+def hooks_dir() -> Path:
+    """
+    Returns the directory of the hooks of the repository, which honors
+    `core.hooksPath`.
+    """
+    return git_path("hooks")
+
+
+NOTES_REF = "refs/notes/ci-review"
+"""
+The notes ref reviews of commits are stored under, shown by
+`git log --notes=ci-review`.
+"""
+
+
+def add_note(commit_hash: str, message: str, ref: str = NOTES_REF) -> None:
+    """
+    Attaches a note to a commit, replacing the note it has under the ref.
+
+    Writers are serialized with a lock file, since `git notes` fails rather
+    than waits while another process updates the ref.
+    """
+    import fcntl
+
+    directory = cache_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / "notes.lock", "w") as lock, telemetry.span("git notes add"):
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        subprocess.run(
+            ["git", "notes", f"--ref={ref}", "add", "--force", "--file=-", commit_hash],
+            input=message.encode("utf-8"),
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+
+def notes(ref: str = NOTES_REF) -> dict[str, str]:
+    """
+    Returns the hash of the note blob of every commit with a note under the
+    ref.
+    """
+    try:
+        output = subprocess.check_output(["git", "notes", f"--ref={ref}", "list"], stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return {}
+    entries = (line.split() for line in output.decode("utf-8").splitlines())
+    return {commit_hash: blob for blob, commit_hash in entries}
+
+
 def add(file_path: Optional[str], patch: bool = False) -> None:
     """
     Adds a file to the git index.
@@ -66,106 +152,607 @@ def status(file_path: Optional[str]) -> str:
     return subprocess.check_output(cmd).decode("utf-8")
 
 
+@dataclass(slots=True, frozen=True)
+class StatusEntry:
+    """
+    A changed path in the output of `git status --porcelain=v2`.
+    """
+
+    kind: str
+    """
+    "1" changed, "2" renamed or copied, "u" unmerged, "?" untracked or
+    "!" ignored.
+    """
+
+    xy: str
+    """
+    The staged (X) and unstaged (Y) state, e.g. "M.", ".M" or "R.". "??"
+    and "!!" for untracked and ignored paths.
+    """
+
+    path: str
+    orig_path: Optional[str] = None
+    """
+    The source of a rename or copy.
+    """
+
+    @property
+    def staged(self) -> bool:
+        return self.kind in "12u" and self.xy[0] != "."
+
+    @property
+    def unstaged(self) -> bool:
+        return self.kind in "12" and self.xy[1] != "."
+
+    @property
+    def untracked(self) -> bool:
+        return self.kind == "?"
+
+    @property
+    def conflicted(self) -> bool:
+        return self.kind == "u"
+
+
+@dataclass(slots=True)
+class BranchStatus:
+    """
+    The `# branch.*` headers of `git status --porcelain=v2 --branch`.
+    """
+
+    oid: Optional[str] = None
+    """
+    The current commit, or None before the initial commit.
+    """
+
+    head: Optional[str] = None
+    """
+    The current branch, or None if HEAD is detached.
+    """
+
+    upstream: Optional[str] = None
+    ahead: int = 0
+    behind: int = 0
+
+
+def iter_status_records(
+    paths: Iterable[str] = (),
+    untracked: str = "normal",
+    branch: bool = False,
+) -> Iterator[Union[BranchStatus, StatusEntry]]:
+    """
+    Yields the records of `git status --porcelain=v2 -z` as they are read.
+
+    The untracked cache is enabled for the call, and untracked files are
+    not searched for at all with `untracked="no"`, which keeps huge
+    worktrees fast.
+
+    Args:
+        paths: Limit the status to these paths.
+        untracked: Show untracked files: "no", "normal" or "all".
+        branch: If true, first yield a BranchStatus.
+
+    Returns:
+        An iterator over the records.
+    """
+    cmd = [
+        "git",
+        "-c",
+        "core.untrackedCache=true",
+        "status",
+        "--porcelain=v2",
+        "-z",
+        f"--untracked-files={untracked}",
+    ]
+    if branch:
+        cmd.append("--branch")
+    cmd.append("--")
+    cmd.extend(paths)
+
+    branch_status = BranchStatus() if branch else None
+    with _stream(cmd) as stdout:
+        fields = (value.decode("utf-8", errors="replace") for value in _read_fields(stdout, b"\x00") if value)
+        for record in fields:
+            kind = record[0]
+            if kind == "#":
+                assert branch_status is not None
+                key, _, value = record[2:].partition(" ")
+                if key == "branch.oid":
+                    branch_status.oid = None if value == "(initial)" else value
+                elif key == "branch.head":
+                    branch_status.head = None if value == "(detached)" else value
+                elif key == "branch.upstream":
+                    branch_status.upstream = value
+                elif key == "branch.ab":
+                    ahead, behind = value.split()
+                    branch_status.ahead, branch_status.behind = int(ahead), -int(behind)
+                continue
+
+            if branch_status is not None:
+                yield branch_status
+                branch_status = None
+
+            if kind == "1":
+                parts = record.split(" ", 8)
+                yield StatusEntry(kind, parts[1], parts[8])
+            elif kind == "2":
+                parts = record.split(" ", 9)
+                yield StatusEntry(kind, parts[1], parts[9], orig_path=next(fields))
+            elif kind == "u":
+                parts = record.split(" ", 10)
+                yield StatusEntry(kind, parts[1], parts[10])
+            else:
+                # Untracked "?" or ignored "!".
+                yield StatusEntry(kind, kind * 2, record[2:])
+
+        if branch_status is not None:
+            yield branch_status
+
+
+def status_entries(paths: Iterable[str] = (), untracked: str = "normal") -> Iterator[StatusEntry]:
+    """
+    Yields the changed paths of the worktree and the index.
+
+    See `iter_status_records`.
+    """
+    for record in iter_status_records(paths, untracked=untracked):
+        assert isinstance(record, StatusEntry)
+        yield record
+
+
+def show_prefix() -> str:
+    """
+    Returns the path of the current directory relative to the top of the
+    worktree, with a trailing slash, or an empty string at the top.
+    """
+    return subprocess.check_output(["git", "rev-parse", "--show-prefix"]).decode("utf-8").strip()
+
+
+def has_staged_changes() -> bool:
+    """
+    Returns True if the index differs from HEAD.
+    """
+    return any(entry.staged for entry in status_entries(untracked="no"))
+
+
+def write_tree() -> Optional[str]:
+    """
+    Writes the index as a tree object and returns its hash.
+
+    Returns:
+        The tree hash, or None if the index cannot be written as a tree,
+        e.g. while there are unresolved conflicts.
+    """
+    try:
+        output = subprocess.check_output(["git", "write-tree"], stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    return output.decode("utf-8").strip()
+
+
+DIFF_PREFIXES = ["--src-prefix=a/", "--dst-prefix=b/"]
+"""
+Options of the git commands whose diffs are parsed, so that paths have the
+prefixes `patch.parse` expects whatever `diff.noprefix` and
+`diff.mnemonicPrefix` say.
+"""
+
+
 def cached_diff() -> Diff:
-    diff = subprocess.check_output(["git", "diff", "--cached"])
+    with telemetry.span("git diff", args="--cached") as s:
+        diff = subprocess.check_output(["git", "diff", "--cached", *DIFF_PREFIXES])
+        s.set(bytes=len(diff))
     return Diff(diff.decode("utf-8"))
 
 
-def create_commit(message: str) -> None:
+def _span_name(cmd: list[str]) -> str:
+    # Skips global options like `-c key=value` to name the span after the
+    # git subcommand.
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg == "-c":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return f"git {arg}"
+    return "git"
+
+
+@contextlib.contextmanager
+def _stream(cmd: list[str], input: Optional[bytes] = None) -> Iterator[IO[bytes]]:
+    """
+    Runs the command and yields its stdout for incremental reading.
+
+    The command is killed if reading stops early.
+
+    Args:
+        cmd: The command.
+        input: Written to the stdin of the command before its output is
+            read, so the command must read all of it first, as
+            `git log --stdin` does.
+
+    Raises:
+        CalledProcessError: If the command fails.
+    """
+    with telemetry.span(_span_name(cmd), streamed=True):
+        p = subprocess.Popen(cmd, stdin=None if input is None else subprocess.PIPE, stdout=subprocess.PIPE)
+        assert p.stdout is not None
+        try:
+            if p.stdin is not None:
+                with p.stdin:
+                    p.stdin.write(input or b"")
+            yield p.stdout
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            returncode = p.wait()
+
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def _iter_output(cmd: list[str]) -> Iterator[str]:
+    """
+    Runs the command and yields its output line by line as it is written.
+    """
+    with _stream(cmd) as stdout:
+        for line in stdout:
+            yield line.decode("utf-8", errors="replace")
+
+
+def iter_cached_diff() -> Iterator[str]:
+    """
+    Yields the lines of `git diff --cached` as they are produced.
+    """
+    return _iter_output(["git", "diff", "--cached"])
+
+
+def _pipe_message(p: subprocess.Popen, message: Union[str, Iterable[str]]) -> None:
+    """
+    Writes the message to the stdin of the process as it becomes available.
+    """
+    if isinstance(message, str):
+        message = [message]
+
+    assert p.stdin is not None
+    try:
+        for chunk in message:
+            p.stdin.write(chunk.encode("utf-8"))
+            p.stdin.flush()
+    except BrokenPipeError:
+        pass
+    _ = p.communicate()[0]
+
+
+def create_commit(message: Union[str, Iterable[str]]) -> None:
     """
     Creates a commit with the given message.
 
     Set editor by setting the EDITOR environment variable.
 
     Args:
-        message: The commit message.
+        message: The commit message, either as a string or as streamed chunks.
 
     Returns:
         None
     """
-    p = subprocess.Popen(['git', "commit", "-eF", "-"], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    _ = p.communicate(input=message.encode("utf-8"))[0]
+    with telemetry.span("git commit"):
+        p = subprocess.Popen(['git', "commit", "-eF", "-"], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        _pipe_message(p, message)
 
 
-def amend_commit(message: str) -> None:
+def amend_commit(message: Union[str, Iterable[str]]) -> None:
     """
     Creates a commit with the given message.
 
     Set editor by setting the EDITOR environment variable.
 
     Args:
-        message: The commit message.
+        message: The commit message, either as a string or as streamed chunks.
 
     Returns:
         None
     """
-    p = subprocess.Popen(['git', "commit", "--amend", "-e", "-F", "-"], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    _ = p.communicate(input=message.encode("utf-8"))[0]
+    with telemetry.span("git commit", args="--amend"):
+        p = subprocess.Popen(
+            ['git', "commit", "--amend", "-e", "-F", "-"], stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        _pipe_message(p, message)
 
 
-def validate_commit_hash(commit_hash: str) -> bool:
-    if commit_hash.startswith("HEAD"):
-        return True
+def is_ancestor(ancestor: str, rev: str = "HEAD") -> bool:
+    """
+    Returns True if `ancestor` is `rev` or one of its ancestors.
+    """
+    cmd = ["git", "merge-base", "--is-ancestor", ancestor, rev]
+    return subprocess.run(cmd, stderr=subprocess.DEVNULL).returncode == 0
+
 
-    return bool(re.match(r'^[0-9a-f]{7,40}$', commit_hash))
+COMMIT_REF = re.compile(r"(?:HEAD|[0-9a-f]{7,64})(?:[~^][0-9]*)*")
+"""
+Commits that `show` accepts: a commit hash or HEAD, optionally followed by
+ancestry suffixes like `~2` or `^`.
+"""
+
+
+def validate_commit_hash(commit_hash: str) -> bool:
+    return bool(COMMIT_REF.fullmatch(commit_hash))
 
 
 def commit_hash_exists(commit_hash: str) -> bool:
     """
     Returns True if the commit hash exists in the git repository.
 
-    git rev-parse --verify <commit_hash>
+    Answered by the shared `git cat-file --batch-check` worker.
     """
-    try:
-        subprocess.check_output(["git", "rev-parse", "--verify", commit_hash])
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return resolve(commit_hash) is not None
+
+
+def resolve_many(revs: Iterable[str]) -> dict[str, Optional[str]]:
+    """
+    Resolves many revisions to full commit hashes over a single pipe.
+
+    Args:
+        revs: Revisions, e.g. abbreviated hashes, refs or `HEAD~1`.
+
+    Returns:
+        The full hash of every revision, or None if it is not a commit.
+    """
+    revs = list(revs)
+    infos = catfile.get_catfile().check_many(f"{rev}^{{commit}}" for rev in revs)
+    return {rev: info.object_hash if info else None for rev, info in zip(revs, infos, strict=True)}
+
+
+def resolve(rev: str) -> Optional[str]:
+    return resolve_many([rev])[rev]
+
+
+def rev_parse(rev: str) -> str:
+    """
+    Returns the full hash of the commit the revision points to.
+
+    Raises:
+        ValueError: If the revision does not point to a commit.
+    """
+    commit_hash = resolve(rev)
+    if commit_hash is None:
+        raise ValueError(f"Unknown revision {rev}")
+    return commit_hash
+
+
+def rev_list(n: Optional[int] = None, rev: str = "HEAD") -> list[str]:
+    """
+    Returns the hashes of the latest n commits reachable from the revision.
+
+    Left to `git rev-list`, which knows about shallow clones, grafts and
+    replace refs.
+    """
+    cmd = ["git", "rev-list"]
+    if n is not None:
+        cmd.append(f"-{n}")
+    cmd.extend([rev, "--"])
+    with telemetry.span("git rev-list"):
+        return subprocess.check_output(cmd).decode("utf-8").split()
 
 
 def show(commit_hash: str) -> str:
-    # TODO: Handle command injection, this may not be enough.
+    """
+    Returns the output of `git show` for the commit.
+
+    Commits with a diff are rendered from the commit index by `format_show`,
+    and added to it if missing. Merges, whose combined diff `git log -p`
+    does not print, are read from `git show`. Only the full hash of the
+    commit is ever passed to git.
+
+    Raises:
+        ValueError: If the commit is not matched by `COMMIT_REF` or does
+            not exist.
+    """
     if not validate_commit_hash(commit_hash):
         raise ValueError(f"Invalid commit hash {commit_hash}")
+    full_hash = rev_parse(commit_hash)
+
+    from ci import commit_index
+
+    index = commit_index.get_index()
+    if index is None:
+        return _show(full_hash)
+
+    commit = index.get([full_hash]).get(full_hash)
+    if commit is None:
+        commit = next(iter_commits(revs=[full_hash], walk=False))
+        index.put([commit])
+    if isinstance(commit.diff, EmptyDiff):
+        return _show(full_hash)
+    return format_show(commit)
+
+
+def iter_show(commit_hash: str) -> Iterator[str]:
+    """
+    Yields the lines of `git show` as they are produced, or from the commit
+    index if the commit has been indexed before.
+    """
+    if not validate_commit_hash(commit_hash):
+        raise ValueError(f"Invalid commit hash {commit_hash}")
+    full_hash = rev_parse(commit_hash)
+
+    from ci import commit_index
+
+    index = commit_index.get_index()
+    if index is not None:
+        commit = index.get([full_hash]).get(full_hash)
+        if commit is not None and not isinstance(commit.diff, EmptyDiff):
+            return iter(format_show(commit).splitlines(keepends=True))
+
+    return _iter_output(["git", "show", *DIFF_PREFIXES, full_hash])
+
+
+def format_show(commit: Commit) -> str:
+    """
+    Formats the commit the way `git show` prints it by default.
+    """
+    message = "".join(f"    {line}\n" for line in commit.message.split("\n"))
+    return (
+        f"commit {commit.commit_hash}\nAuthor: {commit.author}\nDate:   {commit.date}\n\n{message}\n{commit.diff.text}"
+    )
+
 
-    cmd = ["git", "show", commit_hash]
-    diff = subprocess.check_output(cmd)
+def _show(commit_hash: str) -> str:
+    cmd = ["git", "show", *DIFF_PREFIXES, commit_hash]
+    with telemetry.span("git show") as s:
+        diff = subprocess.check_output(cmd)
+        s.set(bytes=len(diff))
     return diff.decode("utf-8")
 
 
-def parse_commit(commit_text: str) -> Commit:
-    commit_and_diff = re.split("\n(?=diff --git)", commit_text)
-    commit_text = commit_and_diff[0]
-    lines = commit_text.strip().split("\n")
-    # Merge commits dont have a diff
+FIELD_SEPARATOR = b"\x00"
+LOG_FORMAT = "%x00%H%x00%aN <%aE>%x00%ad%x00%B%x00"
+"""
+Machine readable `git log` format, framed by NUL bytes only: every commit
+starts with a NUL and the hash, author, date and message are NUL
+terminated. The patch, if any, follows the message up to the NUL of the
+next commit. Git does not write NUL into any of these, nor into textual
+patches, except past the first few kilobytes of a file it took for text.
+The author honors `.mailmap`, like `git show`.
+"""
+
+LOG_FIELDS = 5
+COMMIT_HASH = re.compile(rb"[0-9a-f]{40}(?:[0-9a-f]{24})?")
+
+READ_SIZE = 64 * 1024
+
+
+def _read_fields(stream: IO[bytes], separator: bytes) -> Iterator[bytes]:
+    """
+    Reads the stream incrementally and yields the fields between separators,
+    including empty ones.
+    """
+    pieces: list[bytes] = []
+    while True:
+        data = stream.read(READ_SIZE)
+        if not data:
+            break
+        *values, rest = data.split(separator)
+        for value in values:
+            # Only the first field continues the pieces read before.
+            pieces.append(value)
+            yield b"".join(pieces)
+            pieces = []
+        pieces.append(rest)
+    yield b"".join(pieces)
+
+
+def _log_records(fields: Iterator[bytes]) -> Iterator[list[bytes]]:
+    """
+    Groups the fields of `git log --format=LOG_FORMAT` output by commit.
+    """
+    # The output starts with the NUL of the first commit.
+    next(fields, None)
+    record: list[bytes] = []
+    for value in fields:
+        if len(record) == LOG_FIELDS:
+            if not COMMIT_HASH.fullmatch(value):
+                # A NUL in the patch itself.
+                record[-1] += FIELD_SEPARATOR + value
+                continue
+            yield record
+            record = []
+        record.append(value)
+    if len(record) == LOG_FIELDS:
+        yield record
+
+
+def parse_log_record(fields: list[str]) -> Commit:
+    """
+    Parses the fields of a single commit of `git log --format=LOG_FORMAT`
+    output.
+    """
+    commit_hash, author, date, message, patch = fields
+    patch = patch.lstrip("\n")
     return Commit(
-        commit_hash=lines[0].split(" ")[1],
-        author=lines[1].replace("Author: ", ""),
-        date=lines[2].replace("Date:   ", ""),
-        message="\n".join([line.strip() for line in lines[4:]]),
-        diff=Diff(commit_and_diff[1]) if len(commit_and_diff) > 1 else EmptyDiff(),
+        commit_hash=commit_hash,
+        author=author,
+        date=date,
+        message=message.strip(),
+        diff=Diff(patch) if patch else EmptyDiff(),
     )
 
 
-def parse_git_log(log_data) -> list[Commit]:
-    commits = re.split("\n(?=commit)", log_data)
-    return [parse_commit(commit_text=commit) for commit in commits]
+def iter_commits(
+    n: Optional[int] = None,
+    revs: Iterable[str] = (),
+    patch: bool = True,
+    walk: bool = True,
+) -> Iterator[Commit]:
+    """
+    Yields commits from `git log` as they are read.
+
+    The output of `git log` is parsed incrementally, so memory use is bounded
+    by the size of a single commit rather than the whole history.
+
+    Args:
+        n: The maximum number of commits, or None for all of them.
+        revs: Revisions or ranges to list, HEAD by default.
+        patch: If true, include the diff of every commit.
+        walk: If false, list only the given revisions, not their ancestors.
+
+    Returns:
+        An iterator over Commit objects, newest first.
+
+    Raises:
+        ValueError: If a revision starts with `-`, since git would take it
+            for an option, or spans lines.
+    """
+    revs = list(revs)
+    for rev in revs:
+        if rev.startswith("-") or "\n" in rev:
+            raise ValueError(f"Invalid revision {rev!r}")
+
+    cmd = ["git", "log", f"--format={LOG_FORMAT}"]
+    if patch:
+        cmd.extend(["-p", *DIFF_PREFIXES])
+    if n is not None:
+        cmd.append(f"-{n}")
+    if not walk:
+        cmd.append("--no-walk=unsorted")
+    # The revisions are read from stdin, so any number of them fits.
+    cmd.extend(["--stdin", "--"])
+
+    with _stream(cmd, input="".join(f"{rev}\n" for rev in revs).encode("utf-8")) as stdout:
+        for record in _log_records(_read_fields(stdout, FIELD_SEPARATOR)):
+            yield parse_log_record([field.decode("utf-8", errors="replace") for field in record])
 
 
 def last_commit() -> Commit:
-    show = subprocess.check_output(["git", "show"])
-    show_text = show.decode("utf-8")
-    return parse_commit(show_text)
+    return latest_commits(1)[0]
 
 
 def latest_commits(n: int) -> list[Commit]:
     """
     Returns the latest n commits as a list of Commit objects.
+
+    Commits are looked up in the commit index first, only the missing ones
+    are read from `git log` and then added to the index.
+
     Args:
         n: The number of commits to return.
     Returns:
         A list of Commit objects.
     """
-    log_data = subprocess.check_output(["git", "log", "-p", "-{}".format(n)]).decode("utf-8").strip()
-    commits = re.split("\n(?=commit)", log_data)
-    return [parse_commit(commit_text=commit) for commit in commits]
+    from ci import commit_index
+
+    with telemetry.span("git.latest_commits", n=n) as s:
+        index = commit_index.get_index()
+        if index is None:
+            return list(iter_commits(n))
+
+        commit_hashes = rev_list(n)
+        commits = index.get(commit_hashes)
+        missing = [commit_hash for commit_hash in commit_hashes if commit_hash not in commits]
+        s.set(indexed=len(commits), missing=len(missing))
+        if missing:
+            new_commits = list(iter_commits(revs=missing, walk=False))
+            index.put(new_commits)
+            commits.update((commit.commit_hash, commit) for commit in new_commits)
+
+        return [commits[commit_hash] for commit_hash in commit_hashes]
@@ -1,9 +1,9 @@
+import re
 import textwrap
+from typing import Iterable, Iterator
 
-import pygments
-from pygments.formatters import TerminalFormatter
-from pygments.lexers import DiffLexer
-from pygments.lexers.markup import MarkdownLexer
+# pygments is imported where it is used, since importing it dominates the
+# startup time of commands that do not need it, such as `ag st`.
 
 
 def diff(text: str) -> str:
@@ -16,9 +16,93 @@ def diff(text: str) -> str:
     Returns:
         The highlighted text.
     """
+    import pygments
+    from pygments.formatters import TerminalFormatter
+    from pygments.lexers import DiffLexer
+
     return pygments.highlight(text, DiffLexer(), TerminalFormatter())
 
 
+BOLD = '\033[1m'
+CYAN = '\033[36m'
+GREEN = '\033[32m'
+RED = '\033[31m'
+YELLOW = '\033[33m'
+RESET = '\033[0m'
+
+DIFF_HEADER_PREFIXES = (
+    "diff --git ",
+    "index ",
+    "--- ",
+    "+++ ",
+    "new file mode ",
+    "deleted file mode ",
+    "old mode ",
+    "new mode ",
+    "similarity index ",
+    "dissimilarity index ",
+    "rename from ",
+    "rename to ",
+    "copy from ",
+    "copy to ",
+    "Binary files ",
+)
+
+
+def diff_line(line: str, in_header: bool = False) -> str:
+    """
+    Highlights a single line of a diff by its prefix.
+
+    Args:
+        line: The line to highlight, with or without its newline.
+        in_header: If true, the line belongs to the header of a file, where
+            `---` and `+++` name the files instead of removing and adding lines.
+
+    Returns:
+        The highlighted line.
+    """
+    text = line.rstrip("\n")
+    newline = line[len(text) :]
+    if not text:
+        return line
+    if text.startswith("commit "):
+        color = YELLOW
+    elif (in_header and text.startswith(DIFF_HEADER_PREFIXES)) or text.startswith("diff --git "):
+        color = BOLD
+    elif text.startswith("@@"):
+        color = CYAN
+    elif text.startswith("+"):
+        color = GREEN
+    elif text.startswith("-"):
+        color = RED
+    else:
+        return line
+    return f"{color}{text}{RESET}{newline}"
+
+
+def iter_diff(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Highlights diff lines as they are read.
+
+    A cheap line-prefix classifier colors file headers, hunk headers,
+    additions and removals, so arbitrarily large diffs are highlighted in
+    constant memory. Use `diff` for full Pygments highlighting.
+
+    Args:
+        lines: The lines of the diff, e.g. streamed from git.
+
+    Returns:
+        An iterator over the highlighted lines.
+    """
+    in_header = False
+    for line in lines:
+        if line.startswith("diff --git "):
+            in_header = True
+        elif line.startswith("@@"):
+            in_header = False
+        yield diff_line(line, in_header)
+
+
 def wrap_text(text: str, width: int = 88, break_long_words: bool = False) -> str:
     """
     Wraps the input text to the specified width.
@@ -48,12 +132,147 @@ def markdown(text: str, wrap: bool = True):
     Returns:
         The highlighted text.
     """
+    import pygments
+    from pygments.formatters import TerminalFormatter
+    from pygments.lexers.markup import MarkdownLexer
+
     if wrap:
         text = wrap_text(text)
 
     return pygments.highlight(text, MarkdownLexer(), TerminalFormatter())
 
 
+def markdown_blocks(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Groups streamed text into complete markdown blocks.
+
+    A block ends at a blank line outside of a fenced code block, or when a
+    fenced code block is closed.
+
+    Args:
+        chunks: The text to group, in arbitrary pieces.
+
+    Returns:
+        An iterator over the blocks, each ending with a newline.
+    """
+    block: list[str] = []
+    in_fence = False
+    pending = ""
+
+    def take_line(line: str) -> Iterator[str]:
+        nonlocal block, in_fence
+        if line.lstrip().startswith("```"):
+            block.append(line)
+            in_fence = not in_fence
+            if not in_fence:
+                yield "\n".join(block) + "\n"
+                block = []
+        elif not line.strip() and not in_fence:
+            if block:
+                yield "\n".join(block) + "\n"
+                block = []
+        else:
+            block.append(line)
+
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield from take_line(line)
+
+    if pending:
+        yield from take_line(pending)
+    if block:
+        yield "\n".join(block) + "\n"
+
+
+def markdown_stream(chunks: Iterable[str], wrap: bool = True) -> Iterator[str]:
+    """
+    Highlights streamed markdown one block at a time.
+
+    Args:
+        chunks: The text to highlight, in arbitrary pieces.
+        wrap: If true, the text will be wrapped to 88 characters.
+
+    Returns:
+        An iterator over the highlighted blocks, separated by blank lines.
+    """
+    for i, block in enumerate(markdown_blocks(chunks)):
+        if i > 0:
+            yield "\n"
+        yield markdown(block, wrap=wrap)
+
+
+BLUE = '\033[94m'
+BRIGHT_GREEN = '\033[92m'
+BRIGHT_YELLOW = '\033[93m'
+BRIGHT_RED = '\033[91m'
+PURPLE = '\033[95m'
+GREY = '\033[90m'
+
+STATUS_COLORS = {
+    "branch": BLUE,
+    "staged": BRIGHT_GREEN,
+    "unstaged": BRIGHT_YELLOW,
+    "untracked": BRIGHT_RED,
+    "conflict": BRIGHT_RED,
+    "change": PURPLE,
+    "ignored": GREY,
+}
+
+STATUS_PATTERN = re.compile(
+    r"""
+    (?P<branch>
+        On\ branch | HEAD\ detached | Your\ branch | No\ commits\ yet | Not\ currently\ on\ any\ branch
+        | \#\ branch\.                             # porcelain v2 branch headers
+    )
+    | (?P<staged>Changes\ to\ be\ committed:)
+    | (?P<unstaged>Changes\ not\ staged\ for\ commit:)
+    | (?P<untracked>Untracked\ files: | \?\ )       # porcelain v2 "? <path>"
+    | (?P<conflict>
+        Unmerged\ paths:
+        | both\ (?:modified|added|deleted): | (?:added|deleted)\ by\ (?:us|them):
+        | u\ [A-Z.]{2}\                              # porcelain v2 unmerged entry
+    )
+    | (?P<change>
+        (?:modified|new\ file|deleted|renamed|copied|typechange):
+        | [12]\ [A-Z.]{2}\                           # porcelain v2 changed entry
+    )
+    | (?P<ignored>Ignored\ files: | !\ )             # porcelain v2 "! <path>"
+    """,
+    re.VERBOSE,
+)
+"""
+Classifies a line of `git status` output, in long or porcelain v2 format,
+by its leading label.
+"""
+
+
+def git_status_line(line: str) -> str:
+    """
+    Highlights a single line of `git status` output.
+    """
+    match = STATUS_PATTERN.match(line.lstrip())
+    if match is None:
+        return line
+
+    text = line.rstrip("\n")
+    return f"{STATUS_COLORS[match.lastgroup]}{text}{RESET}{line[len(text):]}"
+
+
+def iter_git_status(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Highlights `git status` output as it is read.
+
+    Args:
+        lines: The lines to highlight.
+
+    Returns:
+        An iterator over the highlighted lines.
+    """
+    return map(git_status_line, lines)
+
+
 def git_status(status_text: str):
     """
     Highlights the git status output.
@@ -64,30 +283,4 @@ def git_status(status_text: str):
     Returns:
         The highlighted text.
     """
-    BLUE = '\033[94m'
-    GREEN = '\033[92m'
-    YELLOW = '\033[93m'
-    RED = '\033[91m'
-    PURPLE = '\033[95m'
-    RESET = '\033[0m'
-    STATUS_COLORS = {
-        "On branch": BLUE,
-        "Changes to be committed:": GREEN,
-        "Changes not staged for commit:": YELLOW,
-        "Untracked files:": RED,
-        "modified:": PURPLE,
-        "new file:": PURPLE,
-    }
-
-    lines = status_text.split('\n')
-    highlighted = []
-
-    for line in lines:
-        for status, color in STATUS_COLORS.items():
-            if status in line:
-                highlighted.append(f'{color}{line}{RESET}')
-                break
-        else:
-            highlighted.append(line)
-
-    return '\n'.join(highlighted)
+    return "\n".join(iter_git_status(status_text.split("\n")))
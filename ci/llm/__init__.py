@@ -1,3 +1,10 @@
-from . import openai
+import importlib
 
-__all__ = ["openai"]
+__all__ = ["backend", "cache", "client", "openai", "prompt", "ratelimit", "scheduler", "stub", "tokens"]
+
+
+def __getattr__(name: str):
+    # Imported on first use, since openai and aiohttp are slow to import.
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
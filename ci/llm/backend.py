@@ -0,0 +1,104 @@
+import os
+from typing import Any, AsyncIterator, Optional, Protocol
+
+import aiohttp
+import openai
+
+MAX_CONNECTIONS = 16
+"""
+Maximum number of open connections in the pool.
+"""
+
+KEEPALIVE_TIMEOUT = 60
+"""
+Seconds an idle connection is kept open for reuse.
+"""
+
+BACKENDS = ["openai", "stub"]
+
+
+class Backend(Protocol):
+    """
+    A provider of chat completions.
+
+    Requests and responses use the dicts of the OpenAI chat completions API,
+    and failures raise the matching `openai.error` exceptions, so callers can
+    retry them the same way whatever the provider.
+    """
+
+    name: str
+
+    async def create(self, kwargs: dict[str, Any]) -> dict:
+        """
+        Creates a chat completion and returns the full response.
+        """
+        ...
+
+    async def stream(self, kwargs: dict[str, Any]) -> AsyncIterator[dict]:
+        """
+        Opens a streamed chat completion and returns its chunks.
+        """
+        ...
+
+    async def aclose(self) -> None: ...
+
+
+class OpenAIBackend:
+    """
+    Chat completions from the OpenAI API over a shared pool of keep-alive
+    connections.
+
+    Every request reuses the same aiohttp session, so concurrent and
+    consecutive requests only pay for the TLS handshake once per pooled
+    connection.
+    """
+
+    name = "openai"
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, keepalive_timeout: float = KEEPALIVE_TIMEOUT):
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session is bound to the event loop it is created in, so it is
+        # created lazily from within the loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def create(self, kwargs: dict[str, Any]) -> Any:
+        token = openai.aiosession.set(self._get_session())
+        try:
+            return await openai.ChatCompletion.acreate(**kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def stream(self, kwargs: dict[str, Any]) -> AsyncIterator[dict]:
+        return await self.create({**kwargs, "stream": True})
+
+    async def aclose(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def get_backend(name: Optional[str] = None) -> Backend:
+    """
+    Returns a new backend by name.
+
+    Args:
+        name: One of `BACKENDS`. Defaults to `$CI_LLM_BACKEND`, or `openai`.
+
+    Raises:
+        ValueError: If the backend does not exist.
+    """
+    name = name or os.environ.get("CI_LLM_BACKEND") or "openai"
+    if name == "openai":
+        return OpenAIBackend()
+    if name == "stub":
+        from ci.llm.stub import StubBackend
+
+        return StubBackend.from_env()
+    raise ValueError(f"Unknown LLM backend {name!r}, expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from ci.llm.openai import ChatRequest
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_BYTES = 64 * 1024 * 1024
+"""
+Maximum total size of the cached responses before the least recently used
+entries are evicted.
+"""
+
+MAX_AGE = 30 * 24 * 60 * 60
+"""
+Entries that have not been used for this many seconds are evicted.
+"""
+
+enabled = not os.environ.get("CI_NO_CACHE")
+"""
+Set to False to bypass the cache, e.g. with `--no-cache`.
+"""
+
+
+def cache_dir() -> Path:
+    """
+    Returns the cache directory, `$XDG_CACHE_HOME/ci` or `~/.cache/ci`.
+    """
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(xdg_cache_home) / "ci"
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+
+@dataclass
+class Stats:
+    hits: int
+    misses: int
+    entries: int
+    size: int
+
+    def __str__(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (
+            f"entries: {self.entries}\n"
+            f"size:    {self.size / 1024 / 1024:.1f} MiB\n"
+            f"hits:    {self.hits}\n"
+            f"misses:  {self.misses}\n"
+            f"hit rate: {hit_rate:.0%}"
+        )
+
+
+class Cache:
+    """
+    Persistent key-value store for JSON documents backed by SQLite.
+
+    Entries are evicted least recently used first once they are older than
+    `max_age` seconds or the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = MAX_BYTES, max_age: float = MAX_AGE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at);
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._count("misses")
+                LOGGER.debug("Cache miss %s", key)
+                return None
+
+            self.hits += 1
+            self._count("hits")
+            self._db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            LOGGER.debug("Cache hit %s", key)
+            return json.loads(row[0])
+
+    def put(self, key: str, value: dict) -> None:
+        data = json.dumps(value)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.execute("DELETE FROM counters")
+
+    def stats(self) -> Stats:
+        with self._lock:
+            counters = dict(self._db.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return Stats(
+            hits=counters.get("hits", 0),
+            misses=counters.get("misses", 0),
+            entries=entries,
+            size=size,
+        )
+
+    def _count(self, name: str) -> None:
+        self._db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def _evict(self) -> None:
+        self._db.execute("DELETE FROM entries WHERE accessed_at < ?", (time.time() - self.max_age,))
+        self._db.execute(
+            """
+            DELETE FROM entries WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC) AS total FROM entries
+                ) WHERE total > ?
+            )
+            """,
+            (self.max_bytes,),
+        )
+
+
+COMPLETIONS = "completions"
+"""
+The name of the completion cache.
+"""
+
+REVIEWS = "reviews"
+"""
+The name of the store of file and hunk reviews, which are not completions
+of a single request.
+"""
+
+_caches: dict[Path, Cache] = {}
+_cache_lock = threading.Lock()
+
+
+def get_cache(name: str = COMPLETIONS) -> Cache:
+    """
+    Returns a shared cache, opening it on first use.
+
+    Every cache is a file of its own in `cache_dir`, so the lookups of one
+    do not count as hits or misses of another and its entries never evict
+    those of another.
+
+    Args:
+        name: The name of the cache, `COMPLETIONS` or `REVIEWS`.
+    """
+    path = cache_dir() / f"{name}.sqlite3"
+    with _cache_lock:
+        if path not in _caches:
+            _caches[path] = Cache(path)
+        return _caches[path]
+
+
+def key(*parts) -> str:
+    """
+    Returns a content address for the JSON serializable parts.
+    """
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def completion_key(request: "ChatRequest", backend: str = "openai") -> str:
+    """
+    Returns the cache key for a chat request.
+
+    Everything that influences the completion is part of the key: the model,
+    the messages (including the system prompt) and the sampling parameters.
+    Responses of other backends than OpenAI are kept apart, so stub responses
+    are never served for real requests.
+    """
+    return key(
+        "chat_completion" if backend == "openai" else f"chat_completion:{backend}",
+        request.model,
+        [[message.role, message.content] for message in request.messages],
+        request.temperature,
+        request.top_p,
+        request.n,
+        request.stop,
+        request.max_tokens,
+        request.presence_penalty,
+        request.frequency_penalty,
+        request.logit_bias,
+    )
+
+
+def get(request: "ChatRequest", backend: str = "openai") -> Optional[dict]:
+    """
+    Returns the cached response for the request, if any.
+    """
+    if not enabled:
+        return None
+    return get_cache().get(completion_key(request, backend))
+
+
+def put(request: "ChatRequest", response: dict, backend: str = "openai") -> None:
+    """
+    Stores the response for the request.
+    """
+    if not enabled:
+        return
+    get_cache().put(completion_key(request, backend), response)
@@ -0,0 +1,312 @@
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+from typing import (
+    Any,
+    AsyncIterator,
+    ContextManager,
+    Coroutine,
+    Iterable,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+from ci import telemetry
+from ci.llm import cache, tokens
+from ci.llm.backend import MAX_CONNECTIONS, Backend, get_backend
+from ci.llm.openai import (
+    ChatCompletionResponse,
+    ChatRequest,
+    assemble_chunks,
+    request_kwargs,
+)
+from ci.llm.scheduler import Scheduler
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class AsyncClient:
+    """
+    Chat completions from a backend, with caching, rate limiting and
+    retries.
+    """
+
+    def __init__(self, backend: Optional[Backend] = None, scheduler: Optional[Scheduler] = None):
+        self.backend = backend or get_backend()
+        self.scheduler = scheduler or Scheduler.from_env()
+
+    @staticmethod
+    def _request_tokens(request: ChatRequest) -> int:
+        # Prompt and completion tokens both count against the rate limit.
+        return tokens.count_messages(request.messages, request.model) + (request.max_tokens or 0)
+
+    async def _open_stream(self, kwargs: dict[str, Any]) -> tuple[Optional[dict], AsyncIterator[dict]]:
+        # Opening the stream and receiving the first chunk is the part that
+        # is retried. Once content has been yielded the stream cannot be
+        # restarted without repeating it.
+        stream = await self.backend.stream(kwargs)
+        try:
+            return await stream.__anext__(), stream
+        except StopAsyncIteration:
+            return None, stream
+        except BaseException:
+            # E.g. cancelled as the losing attempt of a hedged request.
+            await _close(stream)
+            raise
+
+    def _span(self, request: ChatRequest, stream: bool) -> ContextManager[telemetry.Span]:
+        return telemetry.span("llm.chat_completion", model=request.model, backend=self.backend.name, stream=stream)
+
+    @staticmethod
+    def _record_usage(span: telemetry.Span, request: ChatRequest, response: dict) -> None:
+        usage = response.get("usage") or {}
+        if usage.get("total_tokens"):
+            span.set(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+            return
+        # Streamed responses do not report usage, so it is counted locally.
+        contents = [choice["message"]["content"] or "" for choice in response["choices"]]
+        span.set(
+            prompt_tokens=tokens.count_messages(request.messages, request.model),
+            completion_tokens=sum(tokens.count(content, request.model) for content in contents),
+            estimated=True,
+        )
+
+    async def chat_completion(self, request: ChatRequest) -> ChatCompletionResponse:
+        """
+        Creates a chat completion.
+
+        Responses are served from and stored in the completion cache.
+        Requests are rate limited and retried by the client's scheduler.
+        """
+        with self._span(request, bool(request.stream)) as span:
+            cached = cache.get(request, self.backend.name)
+            span.set(cached=cached is not None)
+            if cached is not None:
+                return ChatCompletionResponse(**cached)
+
+            if request.stream:
+                chunks = []
+                async for chunk in self._chunks(request):
+                    if not chunks:
+                        span.set(ttft_ms=round(span.elapsed_ms(), 1))
+                    chunks.append(chunk)
+                response = assemble_chunks(chunks)
+            else:
+                kwargs = request_kwargs(request)
+                response = await self.scheduler.run(
+                    lambda: self.backend.create(kwargs), tokens=self._request_tokens(request)
+                )
+            self._record_usage(span, request, response)
+
+        LOGGER.debug(response)
+
+        cache.put(request, response, self.backend.name)
+        return ChatCompletionResponse(**response)
+
+    async def _chunks(self, request: ChatRequest) -> AsyncIterator[dict]:
+        kwargs = request_kwargs(request)
+        first, stream = await self.scheduler.run(
+            lambda: self._open_stream(kwargs),
+            tokens=self._request_tokens(request),
+            discard=lambda opened: _close(opened[1]),
+        )
+        if first is None:
+            return
+        yield first
+        async for chunk in stream:
+            yield chunk
+
+    async def chat_completion_stream(self, request: ChatRequest) -> AsyncIterator[str]:
+        """
+        Creates a chat completion and yields the content of the first choice
+        as it arrives.
+        """
+        with self._span(request, True) as span:
+            cached = cache.get(request, self.backend.name)
+            span.set(cached=cached is not None)
+            if cached is not None:
+                yield ChatCompletionResponse(**cached).message.content
+                return
+
+            chunks = []
+            async for chunk in self._chunks(request):
+                chunks.append(chunk)
+                for choice in chunk["choices"]:
+                    content = (choice.get("delta") or {}).get("content")
+                    if choice["index"] == 0 and content:
+                        if "ttft_ms" not in span.attributes:
+                            span.set(ttft_ms=round(span.elapsed_ms(), 1))
+                        yield content
+            response = assemble_chunks(chunks)
+            self._record_usage(span, request, response)
+
+        cache.put(request, response, self.backend.name)
+
+    async def gather(
+        self, requests: Iterable[ChatRequest], concurrency: int = MAX_CONNECTIONS
+    ) -> list[ChatCompletionResponse]:
+        """
+        Creates chat completions for the requests, at most `concurrency` at
+        a time, and returns the responses in the order of the requests.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def complete(request: ChatRequest) -> ChatCompletionResponse:
+            async with semaphore:
+                return await self.chat_completion(request)
+
+        return await asyncio.gather(*(complete(request) for request in requests))
+
+    async def aclose(self) -> None:
+        await self.backend.aclose()
+
+
+class Client:
+    """
+    Synchronous wrapper around `AsyncClient`.
+
+    The async client runs on an event loop in a background thread that
+    lives as long as the wrapper, so the connection pool of the backend is
+    shared by all calls, including calls made concurrently from different
+    threads.
+    """
+
+    def __init__(self, backend: Optional[Backend] = None, scheduler: Optional[Scheduler] = None):
+        self.async_client = AsyncClient(backend=backend, scheduler=scheduler)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="ci-llm-client", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro: Coroutine[None, None, T]) -> concurrent.futures.Future[T]:
+        """
+        Schedules a coroutine on the client's event loop.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro: Coroutine[None, None, T]) -> T:
+        """
+        Runs a coroutine on the client's event loop and waits for the result.
+        """
+        return self.submit(coro).result()
+
+    def chat_completion(self, request: ChatRequest) -> ChatCompletionResponse:
+        return self.run(self.async_client.chat_completion(request))
+
+    def chat_completion_stream(self, request: ChatRequest) -> Iterator[str]:
+        return self.iterate(self.async_client.chat_completion_stream(request))
+
+    def gather(
+        self, requests: Iterable[ChatRequest], concurrency: int = MAX_CONNECTIONS
+    ) -> list[ChatCompletionResponse]:
+        return self.run(self.async_client.gather(requests, concurrency=concurrency))
+
+    def iterate(self, iterator: AsyncIterator[T]) -> Iterator[T]:
+        """
+        Runs an async iterator on the client's event loop and yields its
+        items in the calling thread as they arrive.
+        """
+        items: queue.Queue = queue.Queue()
+
+        async def pump() -> None:
+            try:
+                async for item in iterator:
+                    items.put((item, None))
+            except BaseException as e:
+                items.put((_DONE, e))
+                raise
+            items.put((_DONE, None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item, error = items.get()
+                if item is _DONE:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        self.run(self.async_client.aclose())
+        LOGGER.debug("Scheduler: %s", self.async_client.scheduler.metrics)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+_DONE = object()
+
+
+async def _close(stream: AsyncIterator[dict]) -> None:
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+SETTINGS_PREFIXES = ("CI_", "OPENAI_")
+"""
+Prefixes of the environment variables the shared client is configured from.
+"""
+
+_client: Optional[Client] = None
+_client_settings: dict[str, str] = {}
+_client_lock = threading.Lock()
+
+
+def get_client() -> Client:
+    """
+    Returns the shared client, starting it on first use.
+
+    The client is started again if the environment it was configured from
+    has changed, e.g. between the commands run by `ag serve`.
+    """
+    global _client, _client_settings
+    settings = {name: value for name, value in os.environ.items() if name.startswith(SETTINGS_PREFIXES)}
+    with _client_lock:
+        if _client is not None and settings != _client_settings:
+            _client.close()
+            _client = None
+        if _client is None:
+            _client = Client()
+            _client_settings = settings
+        return _client
+
+
+@atexit.register
+def _close_client() -> None:
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+
+
+def chat_completion(request: ChatRequest) -> ChatCompletionResponse:
+    """
+    Creates a chat completion through the shared connection pool.
+    """
+    return get_client().chat_completion(request)
+
+
+def chat_completion_stream(request: ChatRequest) -> Iterator[str]:
+    """
+    Creates a chat completion through the shared connection pool and yields
+    the content of the first choice as it arrives.
+    """
+    return get_client().chat_completion_stream(request)
+
+
+def gather(requests: Iterable[ChatRequest], concurrency: int = MAX_CONNECTIONS) -> list[ChatCompletionResponse]:
+    """
+    Creates chat completions concurrently through the shared connection pool.
+    """
+    return get_client().gather(requests, concurrency=concurrency)
@@ -1,11 +1,8 @@
 import datetime
 import json
-from dataclasses import asdict, dataclass, field
-from typing import Optional
 import logging
-
-
-import openai
+from dataclasses import asdict, dataclass, field
+from typing import Iterator, Optional
 
 LOGGER = logging.getLogger(__name__)
 
@@ -215,8 +212,7 @@ class ChatCompletionResponse:
         if isinstance(self.created, int):
             self.created = datetime.datetime.fromtimestamp(self.created)
 
-        if isinstance(self.choices, list):
-            self.choices = [self.Choices(**choice) for choice in self.choices if isinstance(choice, dict)]
+        self.choices = [self.Choices(**choice) if isinstance(choice, dict) else choice for choice in self.choices]
 
         if isinstance(self.usage, dict):
             self.usage = self.Usage(**self.usage)
@@ -226,21 +222,103 @@ class ChatCompletionResponse:
         return self.choices[0].message
 
 
+def request_kwargs(request: ChatRequest) -> dict:
+    """
+    Translates a ChatRequest into keyword arguments for the OpenAI API.
+
+    Optional parameters that are unset are left out so the API defaults apply.
+    """
+    kwargs: dict = {
+        "model": request.model,
+        "messages": [
+            {
+                "role": message.role,
+                "content": message.content,
+            }
+            for message in request.messages
+        ],
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "n": request.n,
+        "stream": bool(request.stream),
+        "presence_penalty": request.presence_penalty,
+        "frequency_penalty": request.frequency_penalty,
+    }
+    if request.stop is not None:
+        kwargs["stop"] = request.stop
+    if request.max_tokens is not None:
+        kwargs["max_tokens"] = request.max_tokens
+    if request.logit_bias:
+        kwargs["logit_bias"] = request.logit_bias
+    if request.user is not None:
+        kwargs["user"] = request.user
+
+    return kwargs
+
+
+def assemble_chunks(chunks: list[dict]) -> dict:
+    """
+    Assembles streamed completion chunks into the shape of a regular
+    (non-streamed) chat completion response.
+    """
+    choices: dict[int, dict] = {}
+    for chunk in chunks:
+        for choice in chunk["choices"]:
+            index = choice["index"]
+            assembled = choices.setdefault(
+                index,
+                {
+                    "message": {"role": "assistant", "content": ""},
+                    "index": index,
+                    "logprobs": None,
+                    "finish_reason": None,
+                },
+            )
+            delta = choice.get("delta") or {}
+            if delta.get("role"):
+                assembled["message"]["role"] = delta["role"]
+            if delta.get("content"):
+                assembled["message"]["content"] += delta["content"]
+            if choice.get("finish_reason"):
+                assembled["finish_reason"] = choice["finish_reason"]
+
+    first = chunks[0] if chunks else {}
+    return {
+        "id": first.get("id", ""),
+        "object": "chat.completion",
+        "created": first.get("created", int(datetime.datetime.now().timestamp())),
+        "model": first.get("model", ""),
+        "choices": [choices[index] for index in sorted(choices)],
+        # Streamed responses do not report token usage.
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        "system_fingerprint": first.get("system_fingerprint"),
+    }
+
+
 def chat_completion(request: ChatRequest) -> ChatCompletionResponse:
-    messages: list[dict] = [
-        {
-            "role": message.role,
-            "content": message.content,
-        }
-        for message in request.messages
-    ]
-
-    response = openai.ChatCompletion.create(
-        model=request.model,
-        messages=messages,
-        temperature=request.temperature,
-    )
-
-    LOGGER.debug(response)
-
-    return ChatCompletionResponse(**response)
+    """
+    Creates a chat completion and waits for the full response.
+
+    If `request.stream` is set the completion is received as server-sent
+    events and assembled into a single response.
+
+    Requests go through the shared client, which serves responses from the
+    completion cache, rate limits the requests and retries transient errors.
+    """
+    from ci.llm import client
+
+    return client.chat_completion(request)
+
+
+def chat_completion_stream(request: ChatRequest) -> Iterator[str]:
+    """
+    Creates a chat completion and yields the content of the first choice
+    as it arrives, delta by delta.
+
+    The request is always streamed, regardless of `request.stream`. A cached
+    response is yielded as a single delta, and a completed stream is stored
+    in the cache.
+    """
+    from ci.llm import client
+
+    return client.chat_completion_stream(request)
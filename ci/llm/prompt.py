@@ -0,0 +1,159 @@
+import dataclasses
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+from ci import telemetry
+from ci.llm import tokens
+from ci.llm.openai import Message
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 16_000
+"""
+Default prompt budget in tokens, capped by the context window of the model.
+"""
+
+COMPLETION_RESERVE = 1_024
+"""
+Tokens of the context window left for the completion.
+"""
+
+
+@dataclass
+class Section:
+    """
+    A group of messages that is kept, summarized or dropped as a whole.
+    """
+
+    messages: list[Message]
+    priority: int = 0
+    """
+    Sections with lower priority are summarized, then dropped first.
+    """
+
+    summary: Optional[list[Message]] = None
+    """
+    A cheaper replacement for the messages, used when the budget is tight.
+    """
+
+    required: bool = False
+    """
+    Required sections are never dropped. Their last message is truncated
+    if nothing else fits.
+    """
+
+    order: int = field(default=0, repr=False)
+
+
+class PromptBuilder:
+    """
+    Assembles chat messages that fit a token budget.
+
+    Sections are added in the order they are sent. When the prompt does not
+    fit the budget, sections are reduced in priority order: first replaced
+    by their summary, then dropped, and finally the last message of the
+    required sections is truncated.
+
+    Raises:
+        ValueError: If the budget is not positive.
+    """
+
+    def __init__(self, model: str, budget: Optional[int] = None):
+        if budget is not None and budget <= 0:
+            raise ValueError(f"The prompt budget must be positive, got {budget} tokens")
+        self.model = model
+        max_budget = tokens.context_window(model) - COMPLETION_RESERVE
+        self.budget = min(DEFAULT_BUDGET if budget is None else budget, max_budget)
+        self.sections: list[Section] = []
+
+    def add(
+        self,
+        *messages: Message,
+        priority: int = 0,
+        summary: Optional[list[Message]] = None,
+        required: bool = False,
+    ) -> "PromptBuilder":
+        self.sections.append(
+            Section(
+                messages=list(messages),
+                priority=priority,
+                summary=summary,
+                required=required,
+                order=len(self.sections),
+            )
+        )
+        return self
+
+    def count(self, sections: Optional[list[Section]] = None) -> int:
+        sections = self.sections if sections is None else sections
+        return sum(self._count_section(section) for section in sections) + tokens.TOKENS_PER_REPLY
+
+    def _count_section(self, section: Section) -> int:
+        return tokens.count_messages(section.messages, self.model) - tokens.TOKENS_PER_REPLY
+
+    def build(self) -> list[Message]:
+        """
+        Returns the messages of the prompt, reduced to fit the budget.
+        """
+        with telemetry.span("prompt.build", model=self.model, budget=self.budget) as s:
+            return self._build(s)
+
+    def _build(self, s: telemetry.Span) -> list[Message]:
+        sections = [
+            Section(
+                messages=list(section.messages),
+                priority=section.priority,
+                summary=section.summary,
+                required=section.required,
+                order=section.order,
+            )
+            for section in self.sections
+        ]
+        optional = sorted((s for s in sections if not s.required), key=lambda s: (s.priority, -s.order))
+
+        # Every message is counted once, and again only when it changes.
+        counts = {section.order: self._count_section(section) for section in sections}
+        total = sum(counts.values()) + tokens.TOKENS_PER_REPLY
+
+        for section in optional:
+            if total <= self.budget:
+                break
+            if section.summary is not None:
+                section.messages = list(section.summary)
+                count = self._count_section(section)
+                total += count - counts[section.order]
+                counts[section.order] = count
+
+        for section in optional:
+            if total <= self.budget:
+                break
+            sections.remove(section)
+            total -= counts.pop(section.order)
+
+        for section in reversed(sections):
+            overflow = total - self.budget
+            if overflow <= 0:
+                break
+            if not section.messages:
+                continue
+            last = section.messages[-1]
+            max_tokens = max(tokens.count(last.content, self.model) - overflow, 0)
+            section.messages[-1] = dataclasses.replace(
+                last, content=tokens.truncate(last.content, max_tokens, self.model)
+            )
+            count = self._count_section(section)
+            total += count - counts[section.order]
+            counts[section.order] = count
+
+        messages = [message for section in sections for message in section.messages]
+        prompt_tokens = total
+        s.set(prompt_tokens=prompt_tokens, sections=len(sections), total_sections=len(self.sections))
+        LOGGER.info(
+            "Prompt: %d tokens (budget %d), %d of %d sections",
+            prompt_tokens,
+            self.budget,
+            len(sections),
+            len(self.sections),
+        )
+        return messages
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket that allows `per_minute` units per minute, with bursts of
+    up to `burst` units at once.
+
+    Raises:
+        ValueError: If `per_minute` is not positive.
+    """
+
+    def __init__(self, per_minute: float, burst: float = 1):
+        if per_minute <= 0:
+            raise ValueError(f"The rate limit must be positive, got {per_minute} per minute")
+        self.rate = per_minute / 60
+        self.capacity = max(burst, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        """
+        Waits until `amount` units are available and takes them.
+
+        Amounts larger than the burst size wait for a full bucket, so a
+        single oversized request cannot block forever.
+        """
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            if self._tokens < amount:
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= amount
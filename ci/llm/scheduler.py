@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import os
+import random
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+from ci.llm.ratelimit import RateLimiter
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 150_000
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return float(value) if value else None
+
+
+@dataclass
+class Policy:
+    """
+    Retry, timeout and hedging policy of a request.
+    """
+
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    """
+    Backoff before the first retry, doubled for every further retry.
+    """
+
+    max_delay: float = 30.0
+    timeout: Optional[float] = 120.0
+    """
+    Seconds a single attempt may take. For streams this is the time to the
+    first chunk.
+    """
+
+    deadline: Optional[float] = 300.0
+    """
+    Seconds the request may take in total, including rate limiting and
+    retries.
+    """
+
+    hedge_after: Optional[float] = None
+    """
+    If set, a duplicate attempt is started when the first one has not
+    finished after this many seconds, and the first to succeed wins.
+    """
+
+    def __post_init__(self):
+        if self.max_attempts < 1:
+            raise ValueError(f"A request needs at least 1 attempt, got {self.max_attempts}")
+
+    @classmethod
+    def from_env(cls) -> "Policy":
+        return cls(
+            max_attempts=int(os.environ.get("CI_MAX_ATTEMPTS", cls.max_attempts)),
+            timeout=_env_float("CI_REQUEST_TIMEOUT", cls.timeout),
+            deadline=_env_float("CI_REQUEST_DEADLINE", cls.deadline),
+            hedge_after=_env_float("CI_HEDGE_AFTER", cls.hedge_after),
+        )
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0]}
+    quantiles = statistics.quantiles(values, n=20, method="inclusive")
+    return {"p50": statistics.median(values), "p95": quantiles[18]}
+
+
+@dataclass
+class Metrics:
+    """
+    Counters and timings of the requests run by a scheduler.
+    """
+
+    requests: int = 0
+    attempts: int = 0
+    retries: int = 0
+    hedges: int = 0
+    failures: int = 0
+    queue_wait: list[float] = field(default_factory=list)
+    """
+    Seconds each attempt waited for the rate limits.
+    """
+
+    service_time: list[float] = field(default_factory=list)
+    """
+    Seconds each successful attempt took once it was sent.
+    """
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "failures": self.failures,
+            "queue_wait": _percentiles(self.queue_wait),
+            "service_time": _percentiles(self.service_time),
+        }
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        return (
+            f"{self.requests} requests, {self.attempts} attempts, {self.retries} retries, "
+            f"{self.hedges} hedges, {self.failures} failures, "
+            f"queue wait p50 {summary['queue_wait']['p50']:.2f}s p95 {summary['queue_wait']['p95']:.2f}s, "
+            f"service time p50 {summary['service_time']['p50']:.2f}s p95 {summary['service_time']['p95']:.2f}s"
+        )
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Returns True for rate limits, timeouts, connection errors and server
+    errors, which are worth retrying.
+    """
+    if isinstance(
+        error,
+        (
+            openai.error.RateLimitError,
+            openai.error.APIConnectionError,
+            openai.error.Timeout,
+            openai.error.ServiceUnavailableError,
+            openai.error.TryAgain,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+def _retry_after(error: BaseException) -> float:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Scheduler:
+    """
+    Runs requests under requests-per-minute and tokens-per-minute limits,
+    retrying transient failures with exponential backoff and full jitter.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = TOKENS_PER_MINUTE,
+        policy: Optional[Policy] = None,
+    ):
+        self.requests = RateLimiter(requests_per_minute, burst=max(requests_per_minute / 60, 1))
+        self.tokens = RateLimiter(tokens_per_minute, burst=tokens_per_minute)
+        self.policy = policy or Policy()
+        self.metrics = Metrics()
+
+    @classmethod
+    def from_env(cls, requests_per_minute: Optional[float] = None) -> "Scheduler":
+        """
+        Reads the limits and the policy from the environment.
+
+        Args:
+            requests_per_minute: Overrides `CI_REQUESTS_PER_MINUTE`.
+        """
+        if requests_per_minute is None:
+            requests_per_minute = float(os.environ.get("CI_REQUESTS_PER_MINUTE", REQUESTS_PER_MINUTE))
+        return cls(
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=float(os.environ.get("CI_TOKENS_PER_MINUTE", TOKENS_PER_MINUTE)),
+            policy=Policy.from_env(),
+        )
+
+    def _remaining(self, deadline: Optional[float]) -> Optional[float]:
+        if deadline is None:
+            return self.policy.timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError("Request deadline exceeded")
+        return remaining if self.policy.timeout is None else min(remaining, self.policy.timeout)
+
+    async def _acquire(self, tokens: int) -> None:
+        await self.requests.acquire()
+        if tokens:
+            await self.tokens.acquire(tokens)
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[T]],
+        tokens: int = 0,
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+    ) -> T:
+        """
+        Runs `call` under the rate limits and the retry policy.
+
+        Args:
+            call: Starts one attempt of the request.
+            tokens: The tokens the request counts against the token limit.
+            discard: Releases the result of a hedged attempt that lost,
+                e.g. closes its stream.
+
+        Returns:
+            The result of the first successful attempt.
+        """
+        policy = self.policy
+        deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+        self.metrics.requests += 1
+
+        for attempt in range(1, policy.max_attempts + 1):
+            queued = time.monotonic()
+            remaining = self._remaining(deadline)
+            await asyncio.wait_for(self._acquire(tokens), remaining)
+            self.metrics.queue_wait.append(time.monotonic() - queued)
+            self.metrics.attempts += 1
+
+            started = time.monotonic()
+            try:
+                result = await self._attempt(call, tokens, deadline, discard)
+            except Exception as e:
+                if not is_retryable(e) or attempt == policy.max_attempts:
+                    self.metrics.failures += 1
+                    raise
+                delay = max(
+                    random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1))), _retry_after(e)
+                )
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    self.metrics.failures += 1
+                    raise
+                LOGGER.debug("Attempt %d failed with %r, retrying in %.1fs", attempt, e, delay)
+                self.metrics.retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self.metrics.service_time.append(time.monotonic() - started)
+            return result
+
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    async def _attempt(
+        self,
+        call: Callable[[], Awaitable[T]],
+        tokens: int,
+        deadline: Optional[float],
+        discard: Optional[Callable[[T], Awaitable[None]]],
+    ) -> T:
+        timeout = self._remaining(deadline)
+        hedge_after = self.policy.hedge_after
+        if hedge_after is None or (timeout is not None and hedge_after >= timeout):
+            return await asyncio.wait_for(call(), timeout)
+
+        started = time.monotonic()
+        pending = {asyncio.ensure_future(call())}
+        hedged = False
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                elapsed = time.monotonic() - started
+                wait = None if timeout is None else timeout - elapsed
+                if not hedged:
+                    wait = hedge_after - elapsed if wait is None else min(wait, hedge_after - elapsed)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(wait, 0) if wait is not None else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    if discard is not None:
+                        for task in succeeded[1:]:
+                            await discard(task.result())
+                    return succeeded[0].result()
+                for task in done:
+                    error = task.exception()
+
+                if not done and not hedged and time.monotonic() - started >= hedge_after:
+                    hedged = True
+                    self.metrics.hedges += 1
+                    wait = None if timeout is None else max(timeout - (time.monotonic() - started), 0)
+                    await asyncio.wait_for(self._acquire(tokens), wait)
+                    pending.add(asyncio.ensure_future(call()))
+                elif not done and timeout is not None and time.monotonic() - started >= timeout:
+                    raise asyncio.TimeoutError("Request attempt timed out")
+        finally:
+            for task in pending:
+                task.cancel()
+
+        assert error is not None
+        raise error
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
+
+import openai
+
+from ci.llm import tokens
+
+LOGGER = logging.getLogger(__name__)
+
+DIFF_PATH = re.compile(r"^diff --git a/(\S+) b/", re.MULTILINE)
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.0
+    """
+    Seconds before the response, or the first chunk of a stream.
+    """
+
+    chunk_latency: float = 0.0
+    """
+    Seconds between the chunks of a stream.
+    """
+
+    error_rate: float = 0.0
+    """
+    Fraction of requests that fail with a rate limit or server error.
+    """
+
+    fail_first: int = 0
+    """
+    Number of requests that fail before any succeeds.
+    """
+
+    responses: Optional[list[str]] = None
+    """
+    Canned responses, picked by a hash of the request. Synthetic responses
+    are generated if unset.
+    """
+
+    seed: int = 0
+
+    @classmethod
+    def from_env(cls) -> "StubConfig":
+        responses = None
+        if os.environ.get("CI_STUB_RESPONSES"):
+            responses = load_responses(Path(os.environ["CI_STUB_RESPONSES"]))
+        return cls(
+            latency=float(os.environ.get("CI_STUB_LATENCY", 0)),
+            chunk_latency=float(os.environ.get("CI_STUB_CHUNK_LATENCY", 0)),
+            error_rate=float(os.environ.get("CI_STUB_ERROR_RATE", 0)),
+            fail_first=int(os.environ.get("CI_STUB_FAIL_FIRST", 0)),
+            responses=responses,
+            seed=int(os.environ.get("CI_STUB_SEED", 0)),
+        )
+
+
+def load_responses(path: Path) -> list[str]:
+    """
+    Loads canned responses from a JSON list of strings.
+    """
+    responses = json.loads(path.read_text())
+    if not isinstance(responses, list) or not all(isinstance(r, str) for r in responses) or not responses:
+        raise ValueError(f"{path} must contain a non-empty JSON list of strings")
+    return responses
+
+
+def _digest(kwargs: dict[str, Any]) -> str:
+    messages = [[m["role"], m["content"]] for m in kwargs["messages"]]
+    return hashlib.sha256(json.dumps([kwargs["model"], messages]).encode("utf-8")).hexdigest()
+
+
+def synthesize(messages: list[dict], digest: str) -> str:
+    """
+    Returns a synthetic response that only depends on the messages.
+
+    The response mentions the files of any diff in the prompt, so it reads
+    like a short commit message or review.
+    """
+    prompt = messages[-1]["content"] if messages else ""
+    paths = list(dict.fromkeys(DIFF_PATH.findall(prompt)))
+    subject = f"Update {', '.join(paths[:3])}" if paths else f"Respond to request {digest[:7]}"
+    if len(paths) > 3:
+        subject += f" and {len(paths) - 3} more"
+    body = [f"- Change {path}" for path in paths[:10]]
+    return "\n".join([subject, "", *body] if body else [subject])
+
+
+class StubBackend:
+    """
+    A deterministic stand-in for the OpenAI chat completions API.
+
+    Every request is answered with a canned or synthetic response after a
+    configurable latency, streamed chunk by chunk, with optional injected
+    errors, so the pipelines can be load tested and benchmarked without
+    network access. Select it with `CI_LLM_BACKEND=stub`.
+    """
+
+    name = "stub"
+
+    def __init__(self, config: Optional[StubConfig] = None):
+        self.config = config or StubConfig()
+        self.requests = 0
+        self._random = random.Random(self.config.seed)
+
+    @classmethod
+    def from_env(cls) -> "StubBackend":
+        return cls(StubConfig.from_env())
+
+    def _content(self, kwargs: dict[str, Any], index: int) -> str:
+        digest = _digest(kwargs)
+        if self.config.responses:
+            return self.config.responses[(int(digest, 16) + index) % len(self.config.responses)]
+        content = synthesize(kwargs["messages"], digest)
+        return content if index == 0 else f"{content}\n\n(candidate {index + 1})"
+
+    def response(self, kwargs: dict[str, Any]) -> dict:
+        """
+        Returns the full response to a request.
+        """
+        choices = [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": self._content(kwargs, i)},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+            for i in range(kwargs.get("n") or 1)
+        ]
+        prompt_tokens = sum(tokens.estimate(m["content"]) for m in kwargs["messages"])
+        completion_tokens = sum(tokens.estimate(c["message"]["content"]) for c in choices)
+        return {
+            "id": f"chatcmpl-stub-{_digest(kwargs)[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": kwargs["model"],
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "system_fingerprint": "stub",
+        }
+
+    def chunks(self, response: dict) -> list[dict]:
+        """
+        Splits a response into the chunks of a stream, one per word.
+        """
+        chunks = []
+        for choice in response["choices"]:
+            words = re.findall(r"\S+\s*|\s+", choice["message"]["content"])
+            for i, word in enumerate(words):
+                delta = {"content": word}
+                if i == 0:
+                    delta["role"] = "assistant"
+                chunks.append(
+                    {
+                        "id": response["id"],
+                        "object": "chat.completion.chunk",
+                        "created": response["created"],
+                        "model": response["model"],
+                        "system_fingerprint": response["system_fingerprint"],
+                        "choices": [{"index": choice["index"], "delta": delta, "finish_reason": None}],
+                    }
+                )
+        return chunks
+
+    def error(self) -> Optional[openai.error.OpenAIError]:
+        """
+        Returns the error the next request fails with, if any.
+        """
+        self.requests += 1
+        if self.requests <= self.config.fail_first or self._random.random() < self.config.error_rate:
+            if self._random.random() < 0.5:
+                return openai.error.RateLimitError("Stub rate limit", http_status=429)
+            return openai.error.ServiceUnavailableError("Stub unavailable", http_status=503)
+        return None
+
+    async def create(self, kwargs: dict[str, Any]) -> dict:
+        await asyncio.sleep(self.config.latency)
+        error = self.error()
+        if error is not None:
+            raise error
+        return self.response(kwargs)
+
+    async def stream(self, kwargs: dict[str, Any]) -> AsyncIterator[dict]:
+        response = await self.create(kwargs)
+        return self._stream(self.chunks(response))
+
+    async def _stream(self, chunks: list[dict]) -> AsyncIterator[dict]:
+        for i, chunk in enumerate(chunks):
+            if i and self.config.chunk_latency:
+                await asyncio.sleep(self.config.chunk_latency)
+            yield chunk
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def _handle(backend: StubBackend, request) -> Any:
+    from aiohttp import web
+
+    kwargs = await request.json()
+    try:
+        if not kwargs.get("stream"):
+            return web.json_response(await backend.create(kwargs))
+        chunks = await backend.stream(kwargs)
+    except openai.error.OpenAIError as e:
+        return web.json_response(
+            {"error": {"message": e.user_message, "type": type(e).__name__, "code": None}},
+            status=e.http_status or 500,
+        )
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    async for chunk in chunks:
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+def serve(host: str = "127.0.0.1", port: int = 8080, config: Optional[StubConfig] = None) -> None:
+    """
+    Serves the stub as an OpenAI compatible `/v1/chat/completions` endpoint,
+    so the OpenAI backend can be exercised over HTTP:
+
+        python -m ci.llm.stub --port 8080
+        OPENAI_API_BASE=http://127.0.0.1:8080/v1 OPENAI_API_KEY=stub ag review diff
+    """
+    from aiohttp import web
+
+    backend = StubBackend(config or StubConfig.from_env())
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", functools.partial(_handle, backend))
+    web.run_app(app, host=host, port=port, print=lambda message: LOGGER.info(message))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a stub OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, help="Seconds before each response")
+    parser.add_argument("--chunk-latency", type=float, help="Seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, help="Fraction of requests that fail")
+    parser.add_argument("--responses", type=Path, help="JSON list of canned responses")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = StubConfig.from_env()
+    if args.latency is not None:
+        config.latency = args.latency
+    if args.chunk_latency is not None:
+        config.chunk_latency = args.chunk_latency
+    if args.error_rate is not None:
+        config.error_rate = args.error_rate
+    if args.responses is not None:
+        config.responses = load_responses(args.responses)
+    serve(args.host, args.port, config)
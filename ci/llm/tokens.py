@@ -0,0 +1,120 @@
+import functools
+import logging
+from typing import TYPE_CHECKING
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
+if TYPE_CHECKING:
+    from ci.llm.openai import Message
+
+LOGGER = logging.getLogger(__name__)
+
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4_096,
+    "gpt-4": 8_192,
+    "gpt-4-1106-preview": 128_000,
+}
+"""
+The context length of each model in `Models`, in tokens.
+"""
+
+DEFAULT_CONTEXT_WINDOW = 4_096
+
+PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+}
+"""
+USD per 1,000 prompt and completion tokens of each model in `Models`.
+"""
+
+TOKENS_PER_MESSAGE = 4
+"""
+Tokens used by the chat format to wrap each message.
+"""
+
+TOKENS_PER_REPLY = 3
+"""
+Tokens used to prime the reply of the assistant.
+"""
+
+
+def estimate(text: str) -> int:
+    """
+    Estimates the number of tokens in the text.
+
+    OpenAI models average roughly four characters per token for English
+    text and code.
+    """
+    return (len(text) + 3) // 4
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as error:
+        # Without a cached BPE file tiktoken downloads it, which fails
+        # offline. The failure is cached with the encoding, so every later
+        # count estimates without retrying the download.
+        LOGGER.debug("Falling back to estimated token counts for %s: %r", model, error)
+        return None
+
+
+def count(text: str, model: str) -> int:
+    """
+    Counts the tokens in the text for the model.
+
+    Uses the tokenizer of the model if `tiktoken` is installed and can load
+    its encoding, and falls back to `estimate` otherwise.
+    """
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_messages(messages: list["Message"], model: str) -> int:
+    """
+    Counts the tokens a list of chat messages uses in a request.
+    """
+    return sum(count(message.content, model) + TOKENS_PER_MESSAGE for message in messages) + TOKENS_PER_REPLY
+
+
+def truncate(text: str, max_tokens: int, model: str, marker: str = "\n[...]\n") -> str:
+    """
+    Truncates the text to at most `max_tokens` tokens, marking the cut.
+    """
+    if count(text, model) <= max_tokens:
+        return text
+
+    max_tokens = max(max_tokens - count(marker, model), 0)
+    encoding = _encoding(model)
+    if encoding is None:
+        return text[: max_tokens * 4] + marker
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) + marker
+
+
+def context_window(model: str, default: int = DEFAULT_CONTEXT_WINDOW) -> int:
+    """
+    Returns the context length of the model in tokens.
+    """
+    return CONTEXT_WINDOWS.get(model, default)
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Returns the price of a request in USD, or 0 for models without a known
+    price.
+    """
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
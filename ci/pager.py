@@ -0,0 +1,54 @@
+import contextlib
+import os
+import shlex
+import subprocess
+import sys
+from typing import Iterator, TextIO
+
+DEFAULT_PAGER = "less -FRX"
+"""
+Quit if the output fits on one screen, pass colors through and do not
+clear the screen on exit.
+"""
+
+
+@contextlib.contextmanager
+def pager(enabled: bool = True) -> Iterator[TextIO]:
+    """
+    Opens the pager of git for writing, like `git` does for long output.
+
+    The pager is taken from `GIT_PAGER` or `PAGER` and defaults to
+    `less -FRX`. Output goes straight to stdout if it is not a terminal,
+    if the pager is disabled or if it is set to `cat`.
+
+    Closing the pager early, e.g. quitting `less` before the end, stops
+    the output without an error.
+    """
+    command = os.environ.get("GIT_PAGER") or os.environ.get("PAGER") or DEFAULT_PAGER
+    if not enabled or not sys.stdout.isatty() or command == "cat":
+        try:
+            yield sys.stdout
+            sys.stdout.flush()
+        except BrokenPipeError:
+            _silence_stdout()
+        return
+
+    env = {**os.environ, "LESS": os.environ.get("LESS", "FRX"), "LV": os.environ.get("LV", "-c")}
+    p = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, env=env, text=True)
+    assert p.stdin is not None
+    try:
+        yield p.stdin
+    except BrokenPipeError:
+        pass
+    except KeyboardInterrupt:
+        p.terminate()
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            p.stdin.close()
+        p.wait()
+
+
+def _silence_stdout() -> None:
+    # Python flushes stdout again at exit, which would raise once more.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
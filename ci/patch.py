@@ -0,0 +1,525 @@
+import fnmatch
+import hashlib
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, Optional
+
+from ci import telemetry
+from ci.llm import tokens
+
+DIFF_HEADER = re.compile(r"^diff --git a/(.*) b/(.*)$")
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$")
+
+LOW_SIGNAL_GLOBS = [
+    "*.lock",
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "pnpm-lock.yaml",
+    "go.sum",
+    "*.min.js",
+    "*.min.css",
+    "*.map",
+    "*_pb2.py",
+    "*_pb2_grpc.py",
+    "*.pb.go",
+    "*.snap",
+    "vendor/*",
+    "node_modules/*",
+    "dist/*",
+]
+"""
+Lock files, generated and vendored files, which are summarized by default.
+"""
+
+INDENTATION_SENSITIVE_GLOBS = ["*.py", "*.pyi", "*.yaml", "*.yml", "Makefile", "makefile", "GNUmakefile", "*.mk"]
+"""
+Files where a change of indentation changes the meaning.
+"""
+
+
+@dataclass
+class Hunk:
+    """
+    A hunk of a unified diff, starting with its `@@ ... @@` header.
+    """
+
+    header: str
+    lines: list[str] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return "\n".join([self.header, *self.lines]) + "\n"
+
+
+@dataclass
+class FileDiff:
+    """
+    The diff of a single file: the `diff --git` header lines and its hunks.
+    """
+
+    header: list[str]
+    hunks: list[Hunk] = field(default_factory=list)
+
+    @property
+    def path(self) -> str:
+        """
+        The path of the file after the change.
+
+        Taken from the `rename to` or `copy to` line, which git prints
+        without a prefix, or from the `+++` line. Diffs read by the `git`
+        module always have the default `a/` and `b/` prefixes, see
+        `git.DIFF_PREFIXES`, a `+++` path without `b/` is taken as is, as
+        with `diff.noprefix`. Files with neither line, such as binary files
+        and mode changes, fall back to the `diff --git` line.
+        """
+        for line in self.header:
+            if line.startswith(("rename to ", "copy to ")):
+                return line.split(" ", 2)[2]
+            if line.startswith("+++ ") and line != "+++ /dev/null":
+                path = line[len("+++ ") :]
+                return path[len("b/") :] if path.startswith("b/") else path
+        if not self.header:
+            return ""
+        match = DIFF_HEADER.match(self.header[0])
+        if match:
+            return match.group(2)
+        # Without prefixes, an unchanged path is printed twice.
+        paths = self.header[0][len("diff --git ") :]
+        half = len(paths) // 2
+        return paths[:half] if paths[:half] == paths[half + 1 :] else ""
+
+    @property
+    def header_text(self) -> str:
+        return "\n".join(self.header) + "\n"
+
+    @property
+    def text(self) -> str:
+        return self.header_text + "".join(hunk.text for hunk in self.hunks)
+
+
+@dataclass
+class Patch:
+    """
+    A parsed unified diff, as printed by `git diff` or `git show`.
+    """
+
+    preamble: str
+    """
+    Everything before the first file, e.g. the commit header of `git show`.
+    """
+
+    files: list[FileDiff] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return self.preamble + "".join(file.text for file in self.files)
+
+
+def parse(text: str) -> Patch:
+    """
+    Parses a unified diff into files and hunks.
+
+    Args:
+        text: The output of `git diff` or `git show`.
+
+    Returns:
+        The parsed patch.
+    """
+    preamble: list[str] = []
+    files: list[FileDiff] = []
+    hunk: Optional[Hunk] = None
+
+    lines = text.split("\n")
+    if lines and not lines[-1]:
+        lines.pop()
+
+    for line in lines:
+        if line.startswith("diff --git "):
+            files.append(FileDiff(header=[line]))
+            hunk = None
+        elif not files:
+            preamble.append(line)
+        elif line.startswith("@@ "):
+            hunk = Hunk(header=line)
+            files[-1].hunks.append(hunk)
+        elif hunk is None:
+            files[-1].header.append(line)
+        else:
+            hunk.lines.append(line)
+
+    return Patch(
+        preamble="\n".join(preamble) + "\n" if preamble else "",
+        files=files,
+    )
+
+
+def chunks(
+    text: str,
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = tokens.estimate,
+) -> Iterator[str]:
+    """
+    Splits a diff on file and hunk boundaries into chunks of at most
+    `max_tokens` tokens.
+
+    Small files are packed together. Files that do not fit are split
+    between hunks and the file header is repeated in every chunk, so each
+    chunk is a valid diff on its own. Hunks that are larger than the budget
+    on their own are split between lines as a last resort, with the line
+    ranges in their headers recomputed. Text that is not a git diff is
+    split between lines.
+
+    Args:
+        text: The diff to split.
+        max_tokens: The token budget of a chunk.
+        count_tokens: Counts the tokens of a piece of text.
+
+    Returns:
+        An iterator over the chunks.
+    """
+    patch = parse(text)
+    if not patch.files:
+        # Not a git diff, so there are no boundaries to split on.
+        yield from _split_lines(text, max_tokens, count_tokens)
+        return
+
+    chunk: list[str] = []
+    chunk_tokens = 0
+
+    def pieces(file: FileDiff) -> Iterator[str]:
+        header_tokens = count_tokens(file.header_text)
+        if not file.hunks or count_tokens(file.text) <= max_tokens:
+            yield file.text
+            return
+
+        budget = max(max_tokens - header_tokens, 1)
+        piece: list[str] = []
+        piece_tokens = 0
+        for hunk in file.hunks:
+            for part in split_hunk(hunk, budget, count_tokens):
+                part_tokens = count_tokens(part.text)
+                if piece and piece_tokens + part_tokens > budget:
+                    yield file.header_text + "".join(piece)
+                    piece, piece_tokens = [], 0
+                piece.append(part.text)
+                piece_tokens += part_tokens
+        yield file.header_text + "".join(piece)
+
+    for file in patch.files:
+        for piece in pieces(file):
+            piece_tokens = count_tokens(piece)
+            if chunk and chunk_tokens + piece_tokens > max_tokens:
+                yield "".join(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(piece)
+            chunk_tokens += piece_tokens
+
+    yield "".join(chunk)
+
+
+def split_hunk(hunk: Hunk, max_tokens: int, count_tokens: Callable[[str], int] = tokens.estimate) -> Iterator[Hunk]:
+    """
+    Splits a hunk between lines into hunks of at most `max_tokens` tokens,
+    with the line ranges in their headers recomputed.
+
+    Args:
+        hunk: The hunk to split.
+        max_tokens: The token budget of a piece.
+        count_tokens: Counts the tokens of a piece of text.
+
+    Returns:
+        An iterator over the pieces, just the hunk if it fits.
+    """
+    if count_tokens(hunk.text) <= max_tokens:
+        yield hunk
+        return
+
+    match = HUNK_HEADER.match(hunk.header)
+    if match is None:
+        entries = [(line, 0, 0) for line in hunk.lines]
+    else:
+        entries = _number_lines(match, hunk.lines)
+
+    def piece(part: list[tuple[str, int, int]]) -> Hunk:
+        return _sub_hunk(match, part) if match else Hunk(hunk.header, [line for line, _, _ in part])
+
+    header_tokens = count_tokens(hunk.header + "\n")
+    part: list[tuple[str, int, int]] = []
+    part_tokens = header_tokens
+    for entry in entries:
+        line_tokens = count_tokens(entry[0] + "\n")
+        # "\ No newline at end of file" stays with the line before it.
+        if part and part_tokens + line_tokens > max_tokens and not entry[0].startswith("\\"):
+            yield piece(part)
+            part, part_tokens = [], header_tokens
+        part.append(entry)
+        part_tokens += line_tokens
+    yield piece(part)
+
+
+def _split_lines(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> Iterator[str]:
+    part: list[str] = []
+    part_tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        if part and part_tokens + line_tokens > max_tokens:
+            yield "".join(part)
+            part, part_tokens = [], 0
+        part.append(line)
+        part_tokens += line_tokens
+    if part:
+        yield "".join(part)
+
+
+def fingerprint(file: FileDiff, hunk: Optional[Hunk] = None) -> str:
+    """
+    Returns a content address of a hunk that ignores its line numbers and
+    trailing whitespace, so it stays the same when lines are added or
+    removed elsewhere in the file.
+
+    Args:
+        file: The file of the hunk.
+        hunk: The hunk. Without one, the header of the file is addressed
+            instead, e.g. for binary files and mode changes, ignoring the
+            blob hashes on its `index` line.
+    """
+    if hunk is None:
+        lines = [line for line in file.header if not line.startswith("index ")]
+    else:
+        lines = [line.rstrip() for line in hunk.lines]
+    return hashlib.sha256("\n".join([file.path, *lines]).encode("utf-8")).hexdigest()
+
+
+def stat(text: str) -> str:
+    """
+    Summarizes a diff like `git diff --stat`, one line per file.
+
+    Args:
+        text: The diff to summarize.
+
+    Returns:
+        The summary.
+    """
+    lines = []
+    for file in parse(text).files:
+        added = sum(1 for hunk in file.hunks for line in hunk.lines if line.startswith("+"))
+        removed = sum(1 for hunk in file.hunks for line in hunk.lines if line.startswith("-"))
+        lines.append(f"{file.path} | +{added} -{removed}")
+    return "\n".join(lines)
+
+
+@dataclass
+class CompactOptions:
+    """
+    How `compact` reduces a diff.
+    """
+
+    summarize: list[str] = field(default_factory=lambda: list(LOW_SIGNAL_GLOBS))
+    """
+    Files matching these globs are replaced by a one line summary.
+    """
+
+    drop: list[str] = field(default_factory=list)
+    """
+    Files matching these globs are left out entirely.
+    """
+
+    max_file_lines: Optional[int] = 1000
+    """
+    Files with more changed lines than this are summarized.
+    """
+
+    context: Optional[int] = 1
+    """
+    Context lines kept around each change, or None to keep all of them.
+    """
+
+    whitespace: bool = True
+    """
+    If true, hunks that only change whitespace are dropped, except for
+    changes of indentation in files where it matters.
+    """
+
+    @classmethod
+    def from_env(cls) -> "CompactOptions":
+        """
+        Reads the options from the environment: `CI_DIFF_SUMMARIZE` and
+        `CI_DIFF_DROP` add comma separated globs, `CI_DIFF_MAX_FILE_LINES` and
+        `CI_DIFF_CONTEXT` set the sizes, where an empty value means no limit.
+        """
+        options = cls()
+        options.summarize += [g for g in os.environ.get("CI_DIFF_SUMMARIZE", "").split(",") if g]
+        options.drop += [g for g in os.environ.get("CI_DIFF_DROP", "").split(",") if g]
+        for name, env in (("max_file_lines", "CI_DIFF_MAX_FILE_LINES"), ("context", "CI_DIFF_CONTEXT")):
+            if env in os.environ:
+                setattr(options, name, int(os.environ[env]) if os.environ[env] else None)
+        return options
+
+
+def _matches(path: str, globs: list[str]) -> Optional[str]:
+    name = os.path.basename(path)
+    return next((g for g in globs if fnmatch.fnmatch(path, g) or fnmatch.fnmatch(name, g)), None)
+
+
+def _changes(hunks: list[Hunk]) -> tuple[int, int]:
+    lines = [line for hunk in hunks for line in hunk.lines]
+    return sum(1 for line in lines if line.startswith("+")), sum(1 for line in lines if line.startswith("-"))
+
+
+def _is_whitespace_only(hunk: Hunk, path: str) -> bool:
+    """
+    Returns whether a hunk only changes whitespace, like `git diff -w`: both
+    sides of the hunk are the same lines in the same order once whitespace
+    is removed. In files matching `INDENTATION_SENSITIVE_GLOBS`, the
+    indentation has to stay the same as well.
+    """
+    indentation = _matches(path, INDENTATION_SENSITIVE_GLOBS) is not None
+
+    def normalized(line: str) -> str:
+        content = line[1:]
+        text = "".join(content.split())
+        if indentation and text:
+            return content[: len(content) - len(content.lstrip())] + text
+        return text
+
+    old = [normalized(line) for line in hunk.lines if not line.startswith(("+", "\\"))]
+    new = [normalized(line) for line in hunk.lines if not line.startswith(("-", "\\"))]
+    return old == new
+
+
+def shrink_context(hunk: Hunk, context: int) -> list[Hunk]:
+    """
+    Cuts the context lines of a hunk down to `context` lines around each
+    change, splitting it where changes are further apart.
+
+    The line ranges in the headers are recomputed, so the result is still a
+    valid diff.
+    """
+    match = HUNK_HEADER.match(hunk.header)
+    if match is None:
+        return [hunk]
+
+    entries = _number_lines(match, hunk.lines)
+    keep = set()
+    for i, (line, _, _) in enumerate(entries):
+        if line.startswith(("+", "-")):
+            keep.update(range(max(i - context, 0), min(i + context + 1, len(entries))))
+    for i, (line, _, _) in enumerate(entries):
+        # "\ No newline at end of file" belongs to the line before it.
+        if line.startswith("\\") and i - 1 in keep:
+            keep.add(i)
+
+    hunks: list[Hunk] = []
+    group: list[int] = []
+    for i in sorted(keep) + [len(entries) + 1]:
+        if group and i != group[-1] + 1:
+            hunks.append(_sub_hunk(match, [entries[j] for j in group]))
+            group = []
+        group.append(i)
+    return hunks
+
+
+def _number_lines(match: re.Match, lines: list[str]) -> list[tuple[str, int, int]]:
+    """
+    Returns the lines of a hunk with their old and new line numbers.
+    """
+    entries = []
+    old, new = int(match.group(1)), int(match.group(3))
+    if match.group(2) == "0":
+        old += 1
+    if match.group(4) == "0":
+        new += 1
+    for line in lines:
+        entries.append((line, old, new))
+        if line.startswith("-"):
+            old += 1
+        elif line.startswith("+"):
+            new += 1
+        elif not line.startswith("\\"):
+            old += 1
+            new += 1
+    return entries
+
+
+def _sub_hunk(match: re.Match, entries: list[tuple[str, int, int]]) -> Hunk:
+    """
+    Builds a hunk from consecutive numbered lines of a hunk, with the line
+    ranges of its header recomputed.
+    """
+    lines = [line for line, _, _ in entries]
+    old_count = sum(1 for line in lines if not line.startswith(("+", "\\")))
+    new_count = sum(1 for line in lines if not line.startswith(("-", "\\")))
+    old_start = entries[0][1] - (old_count == 0)
+    new_start = entries[0][2] - (new_count == 0)
+    return Hunk(header=f"@@ -{old_start},{old_count} +{new_start},{new_count} @@{match.group(5)}", lines=lines)
+
+
+def compact_file(file: FileDiff, options: CompactOptions) -> Optional[FileDiff]:
+    """
+    Reduces the diff of a single file, or returns None to leave it out.
+    """
+    path = file.path
+    if _matches(path, options.drop):
+        return None
+
+    header = [
+        line for line in file.header if not line.startswith(("index ", "similarity index ", "dissimilarity index "))
+    ]
+    renamed_from = next((line[len("rename from ") :] for line in header if line.startswith("rename from ")), None)
+    renamed_to = next((line[len("rename to ") :] for line in header if line.startswith("rename to ")), None)
+    if renamed_from is not None and renamed_to is not None:
+        header = [line for line in header if not line.startswith(("rename from ", "rename to "))]
+        header.insert(1, f"rename {renamed_from} => {renamed_to}")
+
+    binary = next((i for i, line in enumerate(header) if line.startswith(("Binary files ", "GIT binary patch"))), None)
+    if binary is not None:
+        # Keeps renames, copies and mode changes, drops the binary patch.
+        return FileDiff(header=[*header[:binary], "Binary file changed"])
+
+    added, removed = _changes(file.hunks)
+    glob = _matches(path, options.summarize)
+    if glob or (options.max_file_lines is not None and added + removed > options.max_file_lines):
+        reason = f"matches {glob}" if glob else "large file"
+        return FileDiff(header=[*header, f"[+{added} -{removed} lines not shown: {reason}]"])
+
+    hunks = file.hunks
+    if options.whitespace:
+        hunks = [hunk for hunk in hunks if not _is_whitespace_only(hunk, path)]
+        if file.hunks and not hunks:
+            return FileDiff(header=[*header, f"[+{added} -{removed} lines not shown: whitespace only]"])
+    if options.context is not None:
+        hunks = [part for hunk in hunks for part in shrink_context(hunk, options.context)]
+
+    return FileDiff(header=header, hunks=hunks)
+
+
+def compact(text: str, options: Optional[CompactOptions] = None) -> str:
+    """
+    Reduces a diff to what is worth sending to the model.
+
+    Lock files, generated files and very large files are replaced by a line
+    counting their changes, binary files by a notice, hunks that only change
+    whitespace are dropped, context lines are cut down and renames collapse
+    to a single line. The result is still a diff that `parse` understands.
+
+    Set `CI_DIFF_COMPACT=0` to send diffs unchanged.
+
+    Args:
+        text: The output of `git diff` or `git show`.
+        options: How to reduce the diff. Defaults to `CompactOptions.from_env()`.
+
+    Returns:
+        The reduced diff.
+    """
+    if options is None:
+        if os.environ.get("CI_DIFF_COMPACT") == "0":
+            return text
+        options = CompactOptions.from_env()
+
+    with telemetry.span("patch.compact", bytes=len(text)) as s:
+        result = parse(text)
+        files = [compact_file(file, options) for file in result.files]
+        compacted = Patch(preamble=result.preamble, files=[file for file in files if file is not None]).text
+        s.set(compacted_bytes=len(compacted))
+    return compacted
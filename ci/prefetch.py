@@ -0,0 +1,180 @@
+import contextlib
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+from ci import git
+from ci.llm import cache, openai
+
+LOGGER = logging.getLogger(__name__)
+
+DEBOUNCE = 2.0
+"""
+Seconds the index has to stay unchanged before a message is prefetched.
+"""
+
+POLL_INTERVAL = 0.5
+"""
+Seconds between checks of the index right after it changed. Each check is
+a single `stat` call.
+"""
+
+MAX_POLL_INTERVAL = 5.0
+"""
+The interval doubles while the index stays unchanged, up to this many
+seconds, so an idle `ag prefetch --watch` rarely wakes up.
+"""
+
+MAX_AGE = 7 * 24 * 60 * 60
+"""
+Prefetched messages older than this many seconds are removed.
+"""
+
+
+def _prefetch_dir() -> Path:
+    return git.cache_dir() / "prefetch"
+
+
+def _key(history: int, max_prompt_tokens: Optional[int], model: str = openai.Models.DEFAULT_MODEL) -> Optional[str]:
+    """
+    Returns the key of the commit message for the current index, made of
+    the HEAD commit, the tree hash of the index and a hash of the settings
+    the message is generated with, or None if the index cannot be written
+    as a tree.
+
+    As with `cache.completion_key`, the backend is part of the settings, so
+    a stub message is never taken for a real one.
+    """
+    tree = git.write_tree()
+    if tree is None:
+        return None
+    head = git.resolve("HEAD") or "initial"
+    # The default of `backend.get_backend`, which is too slow to import here.
+    backend = os.environ.get("CI_LLM_BACKEND") or "openai"
+    settings = cache.key("commit_msg", backend, model, history, max_prompt_tokens)
+    return f"{head}-{tree}-{settings[:16]}"
+
+
+def take(history: int = 0, max_prompt_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    Returns the prefetched commit message for the current index, if the
+    index has not changed since it was generated with the same settings.
+
+    The index is only written as a tree if any message has been prefetched,
+    so `ag ci` without prefetching pays nothing for it.
+    """
+    if next(_prefetch_dir().glob("*.txt"), None) is None:
+        return None
+    key = _key(history, max_prompt_tokens)
+    if key is None:
+        return None
+    try:
+        return (_prefetch_dir() / f"{key}.txt").read_text()
+    except FileNotFoundError:
+        return None
+
+
+def prefetch(history: int = 0, max_prompt_tokens: Optional[int] = None) -> None:
+    """
+    Generates the commit message for the current index and stores it under
+    the index tree hash. Does nothing if it is already stored or being
+    generated by another process.
+    """
+    from ci.cmd import commit
+
+    key = _key(history, max_prompt_tokens)
+    if key is None or not git.has_staged_changes():
+        return
+
+    import fcntl
+
+    directory = _prefetch_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{key}.txt"
+    if path.exists():
+        return
+    # Locked with `flock`, so the lock of a killed prefetch is released
+    # right away.
+    with open(directory / f"{key}.lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        if path.exists():
+            return
+        LOGGER.debug("Prefetching commit message %s", key)
+        commit_msg = commit.generate_commit_msg(history, max_prompt_tokens)
+        tmp = directory / f"{key}.{os.getpid()}.tmp"
+        tmp.write_text(commit_msg)
+        tmp.replace(path)
+
+    _remove_stale(directory)
+
+
+def _remove_stale(directory: Path) -> None:
+    cutoff = time.time() - MAX_AGE
+    for path in [*directory.glob("*.txt"), *directory.glob("*.lock")]:
+        with contextlib.suppress(FileNotFoundError):
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+
+
+def start(history: int = 0, max_prompt_tokens: Optional[int] = None) -> None:
+    """
+    Prefetches the commit message in a detached background process.
+    """
+    args = [str(history)] if max_prompt_tokens is None else [str(history), str(max_prompt_tokens)]
+    subprocess.Popen(
+        [sys.executable, "-m", "ci.prefetch", *args],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def watch(history: int = 0, max_prompt_tokens: Optional[int] = None, debounce: float = DEBOUNCE) -> None:
+    """
+    Prefetches a commit message whenever the index changes.
+
+    Runs until interrupted. A message is generated once the index has not
+    changed for `debounce` seconds, so a burst of `git add` calls results
+    in a single request. The index is polled every `POLL_INTERVAL` seconds
+    after a change, backing off to `MAX_POLL_INTERVAL` while it is idle.
+    """
+    # The index of the current worktree, or GIT_INDEX_FILE.
+    index = git.git_path("index")
+    last_seen = None
+    changed_at: Optional[float] = None
+    interval = POLL_INTERVAL
+    while True:
+        try:
+            mtime = index.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime != last_seen:
+            last_seen = mtime
+            changed_at = time.monotonic()
+            interval = POLL_INTERVAL
+        elif changed_at is not None and time.monotonic() - changed_at >= debounce:
+            changed_at = None
+            try:
+                prefetch(history, max_prompt_tokens)
+            except Exception:
+                LOGGER.exception("Prefetch failed")
+        elif changed_at is None:
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    prefetch(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 0,
+        int(sys.argv[2]) if len(sys.argv) > 2 else None,
+    )
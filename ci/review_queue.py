@@ -0,0 +1,269 @@
+import contextlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from ci import git
+
+LOGGER = logging.getLogger(__name__)
+
+DEBOUNCE = 2.0
+"""
+Seconds the queue has to stay unchanged before a commit is reviewed, so a
+burst of commits, amends or a rebase settles before anything is sent.
+Commits the burst amended or rebased away are not reviewed.
+"""
+
+DEADLINE = 10 * 60
+"""
+Seconds after it was queued by which the review of a commit has to be
+done. Later reviews are dropped or aborted. Set with `CI_HOOK_DEADLINE`.
+"""
+
+MAX_WORKERS = 2
+"""
+The maximum number of commits reviewed at once. Set with
+`CI_HOOK_WORKERS`.
+"""
+
+MAX_LOG_BYTES = 1024 * 1024
+
+
+def queue_dir() -> Path:
+    return git.cache_dir() / "review-queue"
+
+
+def _deadline() -> float:
+    return float(os.environ.get("CI_HOOK_DEADLINE", DEADLINE))
+
+
+def _max_workers() -> int:
+    return max(int(os.environ.get("CI_HOOK_WORKERS", MAX_WORKERS)), 1)
+
+
+def enqueue(commit_hash: str) -> None:
+    """
+    Queues the review of a commit. Queuing a commit again restarts its wait.
+    """
+    directory = queue_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp = directory / f"{commit_hash}.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps({"commit": commit_hash, "queued_at": time.time()}))
+    tmp.replace(directory / f"{commit_hash}.job")
+
+
+def pending() -> dict[str, str]:
+    """
+    Returns the queued and running commits, with their state.
+    """
+    try:
+        names = os.listdir(queue_dir())
+    except FileNotFoundError:
+        return {}
+    states = {}
+    for name in names:
+        commit_hash, _, suffix = name.partition(".")
+        if suffix == "job":
+            states[commit_hash] = "queued"
+        elif suffix == "running":
+            states[commit_hash] = "running"
+    return states
+
+
+@contextlib.contextmanager
+def _worker_slot(directory: Path) -> Iterator[bool]:
+    """
+    Holds one of the `CI_HOOK_WORKERS` worker slots, if one is free.
+
+    Slots are locked with `flock`, so the slot of a worker that crashed is
+    free again right away.
+    """
+    import fcntl
+
+    for i in range(_max_workers()):
+        lock = open(directory / f"worker-{i}.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        with lock:
+            yield True
+        return
+    yield False
+
+
+def _read_job(path: Path) -> Optional[dict]:
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _next_job(directory: Path) -> Optional[tuple[Path, dict]]:
+    """
+    Claims the oldest queued commit once nothing was queued for `DEBOUNCE`
+    seconds, by renaming its job from `.job` to `.running`. Jobs past their
+    deadline, including those of crashed workers, and jobs of commits that
+    were amended or rebased away are removed.
+
+    Returns:
+        The claimed job, or None if the queue is empty.
+    """
+    while True:
+        jobs = []
+        for path in [*directory.glob("*.job"), *directory.glob("*.running")]:
+            job = _read_job(path)
+            if job is None:
+                continue
+            if time.time() > job["queued_at"] + _deadline():
+                LOGGER.warning("Dropping the review of %s, its deadline passed", job["commit"])
+                with contextlib.suppress(FileNotFoundError):
+                    path.unlink()
+            elif path.suffix == ".job":
+                jobs.append((path, job))
+        if not jobs:
+            return None
+
+        wait = max(job["queued_at"] for _, job in jobs) + DEBOUNCE - time.time()
+        if wait > 0:
+            time.sleep(wait)
+            continue
+
+        for path, job in _drop_superseded(jobs):
+            running = path.with_suffix(".running")
+            try:
+                os.rename(path, running)
+            except FileNotFoundError:
+                # Claimed by another worker.
+                continue
+            return running, job
+
+
+def _drop_superseded(jobs: list[tuple[Path, dict]]) -> list[tuple[Path, dict]]:
+    """
+    Removes the jobs of commits that were amended or rebased away, see
+    `_is_superseded`, and returns the others, oldest first.
+
+    Commits that other queued commits build on are kept, since a review of
+    a commit only covers its own changes.
+    """
+    live = []
+    for path, job in sorted(jobs, key=lambda item: item[1]["queued_at"]):
+        if not _is_superseded(job["commit"]):
+            live.append((path, job))
+            continue
+        LOGGER.info("Skipping %s, it was amended or rebased", job["commit"])
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+    return live
+
+
+def _is_superseded(commit_hash: str) -> bool:
+    """
+    Returns whether neither HEAD, which may be detached, nor any branch or
+    tag contains the commit any more, e.g. because it was amended or
+    rebased.
+    """
+    if git.is_ancestor(commit_hash):
+        return False
+    # Fails for commits that no longer exist, which are superseded too.
+    cmd = ["git", "for-each-ref", "--count=1", "--contains", commit_hash]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.returncode != 0 or not result.stdout.strip()
+
+
+def _review(commit_hash: str, queued_at: float) -> None:
+    """
+    Reviews a commit into git notes, aborting the review at its deadline.
+    """
+    from ci.cmd import review
+
+    if _is_superseded(commit_hash):
+        LOGGER.info("Skipping %s, it was amended or rebased", commit_hash)
+        return
+    if commit_hash in git.notes():
+        LOGGER.info("Skipping %s, it is already reviewed", commit_hash)
+        return
+
+    def timeout(signum, frame) -> None:
+        raise TimeoutError(f"Review of {commit_hash} missed its deadline")
+
+    started = time.monotonic()
+    previous = signal.signal(signal.SIGALRM, timeout)
+    signal.setitimer(signal.ITIMER_REAL, max(queued_at + _deadline() - time.time(), 0.001))
+    try:
+        review.commit(commit_hash, notes=True)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+    LOGGER.info("Reviewed %s in %.1f s", commit_hash, time.monotonic() - started)
+
+
+def work() -> None:
+    """
+    Reviews queued commits until the queue is empty. Returns right away if
+    all worker slots are taken, since the running workers will pick up the
+    commits.
+    """
+    directory = queue_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    while True:
+        with _worker_slot(directory) as acquired:
+            if not acquired:
+                return
+            while True:
+                claimed = _next_job(directory)
+                if claimed is None:
+                    break
+                path, job = claimed
+                try:
+                    _review(job["commit"], job["queued_at"])
+                except Exception:
+                    LOGGER.exception("Review of %s failed", job["commit"])
+                finally:
+                    with contextlib.suppress(FileNotFoundError):
+                        path.unlink()
+        # A commit queued while the slot was being released would otherwise
+        # wait for the next commit.
+        if not any(directory.glob("*.job")):
+            return
+
+
+def _detach(log: Path) -> None:
+    """
+    Leaves the session of the hook and sends the output to the log, so the
+    worker outlives the terminal of `git commit`.
+    """
+    with contextlib.suppress(OSError):
+        os.setsid()
+    with contextlib.suppress(FileNotFoundError):
+        if log.stat().st_size > MAX_LOG_BYTES:
+            log.unlink()
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+
+
+if __name__ == "__main__":
+    # Run by the post-commit hook as `python -m ci.review_queue enqueue <commit>`
+    # in the background, and then works the queue itself.
+    if len(sys.argv) == 3 and sys.argv[1] == "enqueue":
+        enqueue(sys.argv[2])
+    _detach(queue_dir() / "worker.log")
+    logging.basicConfig(
+        level=logging.DEBUG if os.environ.get("DEBUG") else logging.INFO,
+        format="%(asctime)s %(process)d %(name)s %(levelname)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    work()
@@ -0,0 +1,207 @@
+import ast
+import glob
+import os
+import re
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+from ci.llm import tokens
+
+BOUNDARY = re.compile(
+    r"^(?:"
+    r"@"
+    r"|(?:async\s+)?def\s"
+    r"|class\s"
+    r"|(?:export\s+)?(?:default\s+)?(?:async\s+)?function\b"
+    r"|func\s"
+    r"|(?:pub(?:\([\w:]+\))?\s+)?(?:fn|struct|enum|impl|trait|mod)\b"
+    r"|(?:public|private|protected|internal|static)\s"
+    r")"
+)
+"""
+Lines that start a top-level definition in common languages.
+"""
+
+BINARY_SNIFF_BYTES = 8192
+
+
+@dataclass
+class Segment:
+    """
+    A range of lines of a file, numbered from 1 and inclusive.
+    """
+
+    start: int
+    end: int
+    text: str
+
+
+def expand(paths: Iterable[str]) -> list[Path]:
+    """
+    Expands paths, globs and directories into a sorted list of files.
+
+    Directories are listed with `git ls-files`, so ignored files are left
+    out, and walked directly outside a repository, skipping hidden
+    directories. Globs support `**` for any number of directories.
+
+    Args:
+        paths: Files, directories or glob patterns.
+
+    Returns:
+        The files, without duplicates.
+
+    Raises:
+        FileNotFoundError: If a path does not exist or a glob matches
+            nothing.
+    """
+    files: dict[Path, None] = {}
+    missing = []
+    for path in paths:
+        matches = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+        found = False
+        for match in matches:
+            if os.path.isdir(match):
+                files.update(dict.fromkeys(_list_directory(match)))
+                found = True
+            elif os.path.isfile(match):
+                files[Path(match)] = None
+                found = True
+        if not found:
+            missing.append(path)
+    if missing:
+        raise FileNotFoundError(f"No such file or directory: {', '.join(missing)}")
+    return sorted(files)
+
+
+def _list_directory(directory: str) -> list[Path]:
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard", "--", directory],
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        output = None
+    if output is not None:
+        return [Path(name) for name in output.decode("utf-8").split("\0") if name and os.path.isfile(name)]
+
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        files.extend(Path(root) / name for name in sorted(names) if not name.startswith("."))
+    return files
+
+
+def read_text(path: Path) -> Optional[str]:
+    """
+    Returns the content of a text file, or None for binary files and files
+    that are not UTF-8.
+    """
+    data = path.read_bytes()
+    if b"\0" in data[:BINARY_SNIFF_BYTES]:
+        return None
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def boundaries(text: str, path: Optional[Path] = None) -> list[int]:
+    """
+    Returns the indexes of the lines that start a top-level definition.
+
+    Python files are parsed, so decorators and multi-line strings are
+    handled exactly. Other files, and Python files with syntax errors, are
+    matched line by line against `BOUNDARY`.
+    """
+    if path is not None and path.suffix in (".py", ".pyi"):
+        try:
+            module = ast.parse(text)
+        except (SyntaxError, ValueError):
+            pass
+        else:
+            starts = []
+            for node in module.body:
+                decorators = getattr(node, "decorator_list", [])
+                starts.append(min([node.lineno, *(d.lineno for d in decorators)]) - 1)
+            return sorted(set(starts))
+
+    starts = []
+    previous = ""
+    for i, line in enumerate(text.split("\n")):
+        # A definition right after its decorators starts with them.
+        if BOUNDARY.match(line) and not previous.startswith("@"):
+            starts.append(i)
+        if line.strip():
+            previous = line
+    return starts
+
+
+def split(
+    text: str,
+    max_tokens: int,
+    path: Optional[Path] = None,
+    count_tokens: Callable[[str], int] = tokens.estimate,
+) -> list[Segment]:
+    """
+    Splits a file on top-level definitions into segments of at most
+    `max_tokens` tokens.
+
+    Consecutive definitions are packed together. A definition larger than
+    the budget on its own is split between lines as a last resort.
+
+    Args:
+        text: The content of the file.
+        max_tokens: The token budget of a segment.
+        path: The path of the file, used to pick the parser.
+        count_tokens: Counts the tokens of a piece of text.
+
+    Returns:
+        The segments, covering every line of the file in order.
+    """
+    lines = text.split("\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    if not lines:
+        return []
+
+    starts = sorted({0, *boundaries(text, path)} - {len(lines)})
+    blocks = [(start, end) for start, end in zip(starts, starts[1:] + [len(lines)], strict=True) if start < end]
+
+    segments: list[Segment] = []
+    current: list[tuple[int, int]] = []
+    current_tokens = 0
+
+    def flush() -> None:
+        nonlocal current, current_tokens
+        start, end = current[0][0], current[-1][1]
+        segments.append(Segment(start + 1, end, "\n".join(lines[start:end]) + "\n"))
+        current, current_tokens = [], 0
+
+    for start, end in blocks:
+        for part in _split_block(lines, start, end, max_tokens, count_tokens):
+            part_tokens = count_tokens("\n".join(lines[part[0] : part[1]]) + "\n")
+            if current and current_tokens + part_tokens > max_tokens:
+                flush()
+            current.append(part)
+            current_tokens += part_tokens
+    flush()
+    return segments
+
+
+def _split_block(
+    lines: list[str], start: int, end: int, max_tokens: int, count_tokens: Callable[[str], int]
+) -> Iterator[tuple[int, int]]:
+    if count_tokens("\n".join(lines[start:end]) + "\n") <= max_tokens:
+        yield start, end
+        return
+
+    part_start, part_tokens = start, 0
+    for i in range(start, end):
+        line_tokens = count_tokens(lines[i] + "\n")
+        if i > part_start and part_tokens + line_tokens > max_tokens:
+            yield part_start, i
+            part_start, part_tokens = i, 0
+        part_tokens += line_tokens
+    yield part_start, end
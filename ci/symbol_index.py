@@ -0,0 +1,578 @@
+import ast
+import collections
+import keyword
+import logging
+import re
+import sqlite3
+import subprocess
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from ci import catfile, git, patch, source, telemetry
+from ci.llm import tokens
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_FILE_BYTES = 256 * 1024
+"""
+Larger files are not indexed, they are usually generated or data.
+"""
+
+MAX_UPDATE_FILES = 2_000
+"""
+The most files a single `SymbolIndex.update` reads. Larger updates, such as
+the first build in a large repository, are spread over several refreshes,
+see `refresh`, and reviews use the partial index in the meantime.
+"""
+
+DOCUMENT_TOKENS = 400
+"""
+Token budget of the pieces of a file that the text search returns.
+"""
+
+IDENTIFIER = re.compile(r"(\.?)([A-Za-z_][A-Za-z0-9_]{2,})(\s*\()?")
+
+CODE_WEIGHT = 3
+"""
+Weight of identifiers that look like code, i.e. calls, attributes and names
+with underscores or capitals, over plain words of comments and strings.
+"""
+
+DEFINITION = re.compile(
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:pub(?:\([\w:]+\))?\s+)?(?:async\s+)?"
+    r"(?:def|class|function|func|fn|struct|enum|trait|impl|interface|type)\s+([A-Za-z_]\w*)"
+)
+"""
+Definitions in languages without a parser here, with the defined name.
+"""
+
+STOPWORDS = frozenset(
+    keyword.kwlist + "self cls args kwargs None True False str int float bool dict list set tuple len print range "
+    "the and for not this that with return const let var function public private static void new".split()
+)
+
+MAX_DEFINITIONS_PER_NAME = 3
+"""
+Names defined more often than this are too ambiguous to look up.
+"""
+
+SHOW_HEADER = re.compile(r"commit ([0-9a-f]{40}(?:[0-9a-f]{24})?)\b")
+"""
+The first line of `git show`, with the hash of the commit.
+"""
+
+
+@dataclass(frozen=True)
+class Snippet:
+    path: str
+    start: int
+    end: int
+    """
+    Lines of the snippet, numbered from 1 and inclusive.
+    """
+
+    reason: str
+
+
+class SymbolIndex:
+    """
+    Definitions, references and a full-text index of the files at HEAD.
+
+    Python files are parsed with `ast`; other files are matched line by line
+    for definitions. Every file is also split into small documents for BM25
+    ranked text search. The index is updated from the `git diff` between the
+    last indexed commit and HEAD, so only changed files are read again, and
+    at most `MAX_UPDATE_FILES` files are read per update.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                blob TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS symbols (
+                name TEXT NOT NULL,
+                path TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);
+            CREATE INDEX IF NOT EXISTS symbols_path ON symbols (path);
+            CREATE TABLE IF NOT EXISTS refs (
+                name TEXT NOT NULL,
+                path TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS refs_name ON refs (name);
+            CREATE INDEX IF NOT EXISTS refs_path ON refs (path);
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+                body,
+                path UNINDEXED,
+                start UNINDEXED,
+                end UNINDEXED,
+                tokenize = "unicode61 tokenchars '_'"
+            );
+            """)
+
+    def update(self) -> None:
+        """
+        Brings the index up to date with HEAD.
+        """
+        head = git.resolve("HEAD")
+        if head is None:
+            return
+
+        indexed = self.commit()
+        if indexed == head:
+            return
+
+        with telemetry.span("symbols.update", full=indexed is None) as s:
+            changes = None
+            if indexed is not None and git.resolve(indexed) is not None:
+                changes = list(_diff_tree(indexed, head))
+            complete = changes is not None and len(changes) <= MAX_UPDATE_FILES
+            if not complete:
+                changes, complete = self._tree_changes(head)
+            s.set(files=len(changes), complete=complete)
+
+            worker = catfile.get_catfile()
+            with self._lock:
+                self._db.execute("BEGIN")
+                try:
+                    for path, blob in changes:
+                        self._remove(path)
+                        if blob is not None:
+                            self._add(path, blob, worker)
+                    if complete:
+                        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('commit', ?)", (head,))
+                    else:
+                        # Only the files themselves tell what is left to do.
+                        self._db.execute("DELETE FROM meta WHERE key = 'commit'")
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+
+    def commit(self) -> Optional[str]:
+        """
+        Returns the commit the index is complete for, or None while it is
+        partial.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'commit'").fetchone()
+        return row[0] if row else None
+
+    def _tree_changes(self, head: str) -> tuple[list[tuple[str, Optional[str]]], bool]:
+        """
+        Returns the changes that bring the indexed files closer to the tree
+        of HEAD, reading at most `MAX_UPDATE_FILES` files, and whether they
+        bring it all the way.
+        """
+        tree = dict(_ls_tree(head))
+        with self._lock:
+            indexed = dict(self._db.execute("SELECT path, blob FROM files").fetchall())
+        removed: list[tuple[str, Optional[str]]] = [(path, None) for path in indexed if path not in tree]
+        added = [(path, blob) for path, blob in tree.items() if indexed.get(path) != blob]
+        return removed + added[:MAX_UPDATE_FILES], len(added) <= MAX_UPDATE_FILES
+
+    def _remove(self, path: str) -> None:
+        for table in ("files", "symbols", "refs", "documents"):
+            self._db.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+
+    def _add(self, path: str, blob: str, worker: catfile.CatFile) -> None:
+        # Large and binary files are recorded too, so they are not read again.
+        self._db.execute("INSERT INTO files VALUES (?, ?)", (path, blob))
+        info = worker.check(blob)
+        if info is None or info.size > MAX_FILE_BYTES:
+            return
+        result = worker.read(blob)
+        if result is None or b"\0" in result[1][: source.BINARY_SNIFF_BYTES]:
+            return
+        text = result[1].decode("utf-8", errors="replace")
+
+        self._db.executemany(
+            "INSERT INTO documents VALUES (?, ?, ?, ?)",
+            [
+                (segment.text, path, segment.start, segment.end)
+                for segment in source.split(text, DOCUMENT_TOKENS, Path(path))
+            ],
+        )
+        symbols, refs = _python_symbols(text) if path.endswith((".py", ".pyi")) else (None, [])
+        if symbols is None:
+            symbols = _text_symbols(text)
+        self._db.executemany(
+            "INSERT INTO symbols VALUES (?, ?, ?, ?, ?)", [(n, path, k, s, e) for n, k, s, e in symbols]
+        )
+        self._db.executemany("INSERT INTO refs VALUES (?, ?, ?, ?)", [(n, path, s, e) for n, s, e in refs])
+
+    def definitions(self, names: Iterable[str]) -> dict[str, list[tuple[str, str, int, int]]]:
+        """
+        Returns the `(path, kind, start, end)` of the definitions of the names.
+        """
+        names = list(names)
+        found: dict[str, list[tuple[str, str, int, int]]] = collections.defaultdict(list)
+        with self._lock:
+            for i in range(0, len(names), 500):
+                batch = names[i : i + 500]
+                rows = self._db.execute(
+                    f"SELECT name, path, kind, start, end FROM symbols WHERE name IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for name, path, kind, start, end in rows:
+                    found[name].append((path, kind, start, end))
+        return found
+
+    def definitions_at(self, path: str, start: int, end: int) -> list[str]:
+        """
+        Returns the names defined in the file that overlap the lines.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name FROM symbols WHERE path = ? AND start <= ? AND end >= ?", (path, end, start)
+            ).fetchall()
+        return [name for (name,) in rows]
+
+    def references(self, name: str, limit: int = 5) -> list[tuple[str, int, int]]:
+        """
+        Returns the `(path, start, end)` of definitions that use the name.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT DISTINCT path, start, end FROM refs WHERE name = ? LIMIT ?", (name, limit)
+            ).fetchall()
+
+    def search(self, terms: Iterable[str], limit: int = 5) -> list[tuple[str, int, int]]:
+        """
+        Returns the `(path, start, end)` of the documents that best match the
+        terms, ranked by BM25.
+        """
+        query = " OR ".join(f'"{term}"' for term in terms if '"' not in term)
+        if not query:
+            return []
+        with self._lock:
+            return self._db.execute(
+                "SELECT path, start, end FROM documents WHERE documents MATCH ? ORDER BY bm25(documents) LIMIT ?",
+                (query, limit),
+            ).fetchall()
+
+    def read(self, path: str, start: int, end: int) -> Optional[str]:
+        """
+        Returns lines of an indexed file as of the indexed commit.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT blob FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        result = catfile.get_catfile().read(row[0])
+        if result is None:
+            return None
+        lines = result[1].decode("utf-8", errors="replace").split("\n")
+        return "\n".join(lines[start - 1 : end]) + "\n"
+
+
+def _diff_tree(old: str, new: str) -> Iterator[tuple[str, Optional[str]]]:
+    """
+    Yields the changed paths between two commits with their new blob, or
+    None for deleted files.
+    """
+    output = subprocess.check_output(["git", "diff", "--raw", "-z", "--no-renames", "--no-abbrev", old, new])
+    # Drops the empty field after the last NUL.
+    fields = output.decode("utf-8", errors="replace").split("\0")[:-1]
+    for meta, path in zip(fields[0::2], fields[1::2], strict=True):
+        _, new_mode, _, blob, status = meta.split()
+        if status == "D" or not new_mode.startswith("100"):
+            yield path, None
+        else:
+            yield path, blob
+
+
+def _ls_tree(commit: str) -> Iterator[tuple[str, Optional[str]]]:
+    output = subprocess.check_output(["git", "ls-tree", "-r", "-z", "--full-tree", commit])
+    for entry in output.decode("utf-8", errors="replace").split("\0"):
+        if not entry:
+            continue
+        meta, path = entry.split("\t", 1)
+        mode, object_type, blob = meta.split()
+        if object_type == "blob" and mode.startswith("100"):
+            yield path, blob
+
+
+def _python_symbols(
+    text: str,
+) -> tuple[Optional[list[tuple[str, str, int, int]]], list[tuple[str, int, int]]]:
+    """
+    Returns the definitions `(name, kind, start, end)` and the references
+    `(name, start, end)` of a Python module, where a reference carries the
+    lines of the definition or statement it appears in. Returns None for
+    the definitions if the module cannot be parsed.
+    """
+    try:
+        module = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None, []
+
+    symbols = []
+    refs = set()
+
+    def span(node: ast.AST) -> tuple[int, int]:
+        decorators = getattr(node, "decorator_list", [])
+        start = min([node.lineno, *(d.lineno for d in decorators)])
+        return start, node.end_lineno or node.lineno
+
+    def collect_refs(node: ast.AST, start: int, end: int) -> None:
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name):
+                refs.add((child.id, start, end))
+            elif isinstance(child, ast.Attribute):
+                refs.add((child.attr, start, end))
+
+    for node in module.body:
+        start, end = span(node)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbols.append((node.name, "function", start, end))
+        elif isinstance(node, ast.ClassDef):
+            symbols.append((node.name, "class", start, end))
+            for child in node.body:
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    symbols.append((child.name, "method", *span(child)))
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    symbols.append((target.id, "variable", start, end))
+        collect_refs(node, start, end)
+
+    return symbols, sorted(refs)
+
+
+def _text_symbols(text: str) -> list[tuple[str, str, int, int]]:
+    """
+    Returns the definitions `(name, kind, start, end)` matched by
+    `DEFINITION`, each ending where the next top-level definition starts.
+    """
+    lines = text.split("\n")
+    starts = source.boundaries(text) + [len(lines)]
+    symbols = []
+    for i, line in enumerate(lines):
+        match = DEFINITION.match(line)
+        if match:
+            end = next((s for s in starts if s > i), len(lines))
+            symbols.append((match.group(1), "definition", i + 1, end))
+    return symbols
+
+
+_indexes: dict[Path, Optional[SymbolIndex]] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index() -> Optional[SymbolIndex]:
+    """
+    Returns the symbol index of the current repository, stored in
+    `.git/ci-cache/symbols.sqlite3`, or None if it cannot be opened, e.g.
+    outside a repository or if SQLite lacks FTS5.
+    """
+    try:
+        path = git.cache_dir() / "symbols.sqlite3"
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    with _indexes_lock:
+        if path not in _indexes:
+            try:
+                _indexes[path] = SymbolIndex(path)
+            except (OSError, sqlite3.Error) as e:
+                LOGGER.debug("Symbol index disabled: %s", e)
+                _indexes[path] = None
+        return _indexes[path]
+
+
+_refreshing: set[Path] = set()
+
+
+def refresh() -> Optional[threading.Thread]:
+    """
+    Starts bringing the symbol index up to date with HEAD in a background
+    thread, unless the index cannot be opened or this process is already
+    updating it.
+
+    The update writes through a connection of its own, so readers of the
+    index are not blocked and use what it held before until it commits.
+
+    Returns:
+        The thread of the update, or None if none was started.
+    """
+    index = get_index()
+    if index is None:
+        return None
+    with _indexes_lock:
+        if index.path in _refreshing:
+            return None
+        _refreshing.add(index.path)
+
+    def update() -> None:
+        try:
+            SymbolIndex(index.path).update()
+        except (OSError, EOFError, ValueError, subprocess.CalledProcessError, sqlite3.Error) as e:
+            LOGGER.debug("Symbol index not updated: %s", e)
+        finally:
+            with _indexes_lock:
+                _refreshing.discard(index.path)
+
+    thread = threading.Thread(target=update, name="ci-symbols-update", daemon=True)
+    thread.start()
+    return thread
+
+
+def side(diff: str) -> Optional[str]:
+    """
+    Returns the side of the diff whose line numbers match HEAD: "old" for
+    changes on top of HEAD, such as staged changes, "new" for the diff of
+    HEAD itself as printed by `git show`, or None for the diff of another
+    commit.
+
+    Chunks of a diff lack the `git show` header, so the side is taken from
+    the whole diff and passed along with its chunks.
+    """
+    match = SHOW_HEADER.match(diff)
+    if match is None:
+        return "old"
+    return "new" if match.group(1) == git.resolve("HEAD") else None
+
+
+def _changes(diff: str, side: Optional[str]) -> tuple[dict[str, list[tuple[int, int]]], collections.Counter]:
+    """
+    Returns the changed line ranges of each file on a side of the diff, and
+    the identifiers on the changed lines. Without a side, the changed files
+    are returned without ranges.
+    """
+    ranges: dict[str, list[tuple[int, int]]] = collections.defaultdict(list)
+    identifiers: collections.Counter = collections.Counter()
+    groups = {"old": (1, 2), "new": (3, 4)}.get(side or "")
+    for file in patch.parse(diff).files:
+        path_ranges = ranges[file.path]
+        for hunk in file.hunks:
+            match = patch.HUNK_HEADER.match(hunk.header)
+            if match and groups:
+                start, count = match.group(groups[0]), match.group(groups[1])
+                path_ranges.append((int(start), int(start) + max(int(count or 1), 1) - 1))
+            for line in hunk.lines:
+                if line.startswith(("+", "-")):
+                    for dot, name, call in IDENTIFIER.findall(line[1:]):
+                        if name not in STOPWORDS:
+                            code = dot or call or "_" in name or not name.islower()
+                            identifiers[name] += CODE_WEIGHT if code else 1
+    return ranges, identifiers
+
+
+def _overlaps(snippet: tuple[str, int, int], ranges: dict[str, list[tuple[int, int]]]) -> bool:
+    path, start, end = snippet
+    return any(start <= range_end and end >= range_start for range_start, range_end in ranges.get(path, []))
+
+
+def related(index: SymbolIndex, diff: str, side: Optional[str], limit: int = 20) -> list[Snippet]:
+    """
+    Returns the code the diff touches, most relevant first: the definitions
+    of names used on the changed lines, the code that uses the changed
+    definitions, and the best text matches of the changed identifiers.
+    Code that the diff already shows is left out.
+
+    Line numbers of the diff are only compared with the index on the side
+    that matches the indexed commit, see `side`, if any.
+    """
+    ranges, identifiers = _changes(diff, side)
+    snippets: dict[tuple[str, int, int], Snippet] = {}
+
+    def add(path: str, start: int, end: int, reason: str) -> None:
+        key = (path, start, end)
+        if key not in snippets and not _overlaps(key, ranges) and len(snippets) < limit:
+            snippets[key] = Snippet(path, start, end, reason)
+
+    definitions = index.definitions(identifiers)
+    for name, found in definitions.items():
+        if len(found) > MAX_DEFINITIONS_PER_NAME:
+            # Ambiguous, unless it is defined in a file the diff changes.
+            definitions[name] = [d for d in found if d[0] in ranges]
+    # Names used often and defined once are the most telling.
+    ranked = sorted(
+        (name for name in definitions if definitions[name]), key=lambda n: -identifiers[n] / len(definitions[n])
+    )
+    for name in ranked:
+        for path, kind, start, end in definitions[name]:
+            add(path, start, end, f"{kind} {name}")
+
+    for path, path_ranges in ranges.items():
+        for range_start, range_end in path_ranges:
+            for name in index.definitions_at(path, range_start, range_end):
+                for ref_path, start, end in index.references(name, limit=3):
+                    add(ref_path, start, end, f"uses {name}")
+
+    terms = [name for name, _ in identifiers.most_common(32)]
+    for path, start, end in index.search(terms, limit=5):
+        add(path, int(start), int(end), "text match")
+
+    return list(snippets.values())
+
+
+def context(diff: str, max_tokens: int, model: str, side: Optional[str]) -> str:
+    """
+    Returns the code of the repository that the diff touches, within a
+    token budget, or an empty string if there is none or no index.
+
+    The index is refreshed in the background, see `refresh`, rather than
+    on the way of the review, which uses whatever is indexed already.
+
+    Args:
+        diff: The diff under review, or a chunk of it.
+        max_tokens: The token budget of the context.
+        model: The model the tokens are counted for.
+        side: The side of the whole diff that matches HEAD, see `side`.
+    """
+    if max_tokens <= 0:
+        return ""
+    index = get_index()
+    if index is None:
+        return ""
+
+    with telemetry.span("symbols.context", budget=max_tokens) as s:
+        parts = []
+        remaining = max_tokens
+        # The context is optional, so a failing index or `git cat-file`
+        # worker only leaves it out.
+        try:
+            if index.commit() != git.resolve("HEAD"):
+                # HEAD's line numbers do not match a stale or partial index.
+                side = None
+                refresh()
+            for snippet in related(index, diff, side):
+                text = index.read(snippet.path, snippet.start, snippet.end)
+                if text is None:
+                    continue
+                part = f"{snippet.path}:{snippet.start}-{snippet.end} ({snippet.reason})\n```\n{text}```\n"
+                part_tokens = tokens.count(part, model)
+                if part_tokens > remaining:
+                    if remaining < 100:
+                        break
+                    part = tokens.truncate(part, remaining, model)
+                    part_tokens = remaining
+                parts.append(part)
+                remaining -= part_tokens
+        except (OSError, EOFError, ValueError, subprocess.CalledProcessError, sqlite3.Error) as e:
+            LOGGER.debug("Symbol index not used: %s", e)
+            return ""
+        s.set(snippets=len(parts), tokens=max_tokens - remaining)
+    return "\n".join(parts)
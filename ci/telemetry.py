@@ -0,0 +1,168 @@
+import atexit
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_BYTES = 16 * 1024 * 1024
+"""
+Size of the telemetry file above which the oldest half is dropped.
+"""
+
+
+def enabled_in_env() -> bool:
+    """
+    Returns whether recording is turned on, with `CI_TELEMETRY=1`. It is off
+    by default, so commands do not write to the telemetry file.
+    """
+    return os.environ.get("CI_TELEMETRY") == "1"
+
+
+enabled = enabled_in_env()
+
+RUN_ID = os.urandom(8).hex()
+"""
+Identifies the spans of one `ag` invocation.
+"""
+
+_buffer: list[dict] = []
+_buffer_lock = threading.Lock()
+_registered = False
+
+
+def telemetry_file() -> Path:
+    """
+    Returns the file spans are appended to, `$CI_TELEMETRY_FILE` or
+    `$XDG_CACHE_HOME/ci/telemetry.jsonl`.
+    """
+    if os.environ.get("CI_TELEMETRY_FILE"):
+        return Path(os.environ["CI_TELEMETRY_FILE"])
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(xdg_cache_home) / "ci" / "telemetry.jsonl"
+
+
+class Span:
+    """
+    A timed stage of a command with attributes such as sizes and token
+    counts.
+    """
+
+    __slots__ = ("name", "attributes", "start", "_started")
+
+    def __init__(self, name: str, attributes: dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Times the body of the `with` statement and records it as a span.
+
+    Exceptions are recorded in the `error` attribute and re-raised. Spans
+    of generators closed early are marked as `cancelled`.
+    """
+    s = Span(name, attributes)
+    try:
+        yield s
+    except GeneratorExit:
+        s.attributes["cancelled"] = True
+        raise
+    except BaseException as e:
+        s.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        record(s)
+
+
+def record(s: Span) -> None:
+    """
+    Records a finished span. Spans are buffered and written at exit.
+    """
+    duration_ms = s.elapsed_ms()
+    LOGGER.debug("%s %.1f ms %s", s.name, duration_ms, s.attributes)
+    if not enabled:
+        return
+
+    global _registered
+    with _buffer_lock:
+        _buffer.append(
+            {
+                "run": RUN_ID,
+                "name": s.name,
+                "start": round(s.start, 3),
+                "duration_ms": round(duration_ms, 3),
+                "attributes": s.attributes,
+            }
+        )
+        if not _registered:
+            atexit.register(flush)
+            _registered = True
+
+
+def flush() -> None:
+    """
+    Appends the buffered spans to the telemetry file as JSON lines.
+    """
+    with _buffer_lock:
+        if not _buffer:
+            return
+        lines = "".join(json.dumps(entry, default=str) + "\n" for entry in _buffer)
+        _buffer.clear()
+
+    path = telemetry_file()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        if path.stat().st_size > MAX_BYTES:
+            _drop_oldest(path)
+    except OSError as e:
+        LOGGER.debug("Telemetry not written: %s", e)
+
+
+def _drop_oldest(path: Path) -> None:
+    lines = path.read_text(encoding="utf-8").splitlines(keepends=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text("".join(lines[len(lines) // 2 :]), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def read(path: Optional[Path] = None, since: Optional[float] = None) -> Iterator[dict]:
+    """
+    Yields the recorded spans, optionally only those started after `since`.
+
+    Lines that cannot be parsed, e.g. of an interrupted write, are skipped.
+    """
+    path = path or telemetry_file()
+    try:
+        f = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if since is None or entry.get("start", 0) >= since:
+                yield entry
+
+
+def clear(path: Optional[Path] = None) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        (path or telemetry_file()).unlink()
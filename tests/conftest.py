@@ -0,0 +1,59 @@
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+
+class Repo:
+    """
+    A git repository in a temporary directory, which is the current
+    directory while the test runs.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def git(self, *args: str) -> str:
+        return subprocess.check_output(["git", *args], cwd=self.path).decode("utf-8").strip()
+
+    def write(self, name: str, text: str) -> Path:
+        path = self.path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+        return path
+
+    def commit(self, message: str, files: Optional[dict[str, str]] = None) -> str:
+        """
+        Writes and commits the files and returns the hash of the commit.
+        """
+        for name, text in (files or {}).items():
+            self.write(name, text)
+        self.git("add", "--all")
+        self.git("commit", "--quiet", "--allow-empty", "-m", message)
+        return self.git("rev-parse", "HEAD")
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch) -> Repo:
+    path = tmp_path / "repo"
+    path.mkdir()
+    monkeypatch.chdir(path)
+    for name in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{name}_NAME", "Test")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "test@example.com")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    subprocess.run(["git", "init", "--quiet", "--initial-branch=main"], cwd=path, check=True)
+    return Repo(path)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """
+    Answers LLM requests with the stub backend, without the completion
+    cache.
+    """
+    from ci.llm import cache
+
+    monkeypatch.setenv("CI_LLM_BACKEND", "stub")
+    monkeypatch.setattr(cache, "enabled", False)
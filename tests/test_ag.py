@@ -0,0 +1,254 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from ci import ag, cmd, llm
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_review_file_reports_missing_paths(repo, stub):
+    result = CliRunner().invoke(ag.cli, ["review", "file", "missing.py"])
+
+    assert result.exit_code == 1
+    assert "No such file or directory: missing.py" in result.output
+
+
+def test_show_reports_unknown_commits(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+
+    result = CliRunner().invoke(ag.cli, ["show", "--no-pager", "HEAD~1"])
+
+    assert result.exit_code == 1
+    assert "Unknown revision HEAD~1" in result.output
+
+
+def test_status_does_not_import_the_llm_client(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "ci.ag", "st"],
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert "On branch main" in result.stdout
+    imported = {line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines()}
+    assert "ci.git" in imported
+    assert not imported & {"openai", "aiohttp", "pygments", "ci.llm.openai"}
+
+
+def test_lazy_modules():
+    assert cmd.status.__name__ == "ci.cmd.status"
+    assert llm.tokens.__name__ == "ci.llm.tokens"
+    assert not hasattr(cmd, "missing")
+    assert not hasattr(llm, "missing")
+
+
+def test_placeholder_commands():
+    assert CliRunner().invoke(ag.cli, ["aliases"]).output == "Managing model aliases...\n"
+    assert CliRunner().invoke(ag.cli, ["review", "pr"]).output == "Pull request\n"
+
+
+def test_cache_commands(repo, monkeypatch):
+    from ci.llm import cache
+
+    monkeypatch.setattr(cache, "enabled", True)
+    cache.get_cache().put("key", {})
+    cache.get_cache(cache.REVIEWS).put("key", {})
+
+    assert "entries: 1\n" in CliRunner().invoke(ag.cli, ["cache", "stats"]).output
+
+    assert CliRunner().invoke(ag.cli, ["cache", "clear"]).exit_code == 0
+    assert cache.get_cache().get("key") is None
+    assert cache.get_cache(cache.REVIEWS).get("key") is None
+
+
+def test_no_cache_option(repo, stub, monkeypatch):
+    from ci.llm import cache
+
+    monkeypatch.setattr(cache, "enabled", True)
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.git("add", "a.txt")
+    monkeypatch.setenv("GIT_EDITOR", "true")
+
+    result = CliRunner().invoke(ag.cli, ["ci", "--no-cache"])
+
+    assert result.exit_code == 0, result.output
+    assert not cache.enabled
+    assert repo.git("log", "-1", "--format=%s") == "Update a.txt"
+
+
+def test_review_range(repo, monkeypatch):
+    from ci.cmd import review
+
+    repo.commit("Initial", {"a.txt": "a\n"})
+    result = CliRunner().invoke(ag.cli, ["review", "range", "HEAD"])
+    assert result.exit_code == 1
+    assert "Error" in result.output
+
+    calls = []
+
+    def commit_range(revision_range, **kwargs):
+        calls.append((revision_range, kwargs))
+        return ["0123456"] * (len(calls) - 1)
+
+    monkeypatch.setattr(review, "commit_range", commit_range)
+    args = ["review", "range", "main~1..main", "--workers", "2", "--requests-per-minute", "30", "--restart"]
+    assert CliRunner().invoke(ag.cli, args).exit_code == 0
+    assert calls == [("main~1..main", {"workers": 2, "requests_per_minute": 30.0, "restart": True})]
+
+    result = CliRunner().invoke(ag.cli, ["review", "range", "main~1..main"])
+    assert result.exit_code == 1
+    assert "1 reviews failed" in result.output
+
+
+def test_review_diff(repo, stub):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.commit("Change a", {"a.txt": "b\n"})
+
+    result = CliRunner().invoke(ag.cli, ["review", "diff", "--cached"])
+    assert result.exit_code == 0
+    assert "No staged changes to review." in result.output
+
+    repo.write("a.txt", "c\n")
+    repo.git("add", "a.txt")
+    for args, kwargs in [
+        (["--cached"], {}),
+        (["HEAD", "--context-tokens", "0"], {}),
+        (["--chunk-threshold", "1", "--chunk-tokens", "100"], {"input": repo.git("diff", "--cached")}),
+    ]:
+        result = CliRunner().invoke(ag.cli, ["review", "diff", *args], **kwargs)
+        assert result.exit_code == 0, result.output
+        assert "a.txt" in result.output
+
+    result = CliRunner().invoke(ag.cli, ["review", "diff", "HEAD~2"])
+    assert result.exit_code == 1
+    assert "Unknown revision HEAD~2" in result.output
+
+
+def test_ci_candidates_and_amend(repo, stub, monkeypatch):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.git("add", "a.txt")
+    monkeypatch.setenv("GIT_EDITOR", "true")
+
+    assert CliRunner().invoke(ag.cli, ["ci", "--candidates", "2"]).exit_code == 0
+    assert repo.git("log", "-1", "--format=%s") == "Update a.txt"
+
+    assert CliRunner().invoke(ag.cli, ["ci", "--amend", "--candidates", "2"]).exit_code == 0
+    assert repo.git("log", "-1", "--format=%B").endswith("(candidate 2)")
+    assert repo.git("rev-list", "--count", "HEAD") == "2"
+
+
+def test_add_and_prefetch(repo, stub, monkeypatch):
+    from ci import prefetch
+
+    started = []
+    watched = []
+    monkeypatch.setattr(prefetch, "start", lambda *args: started.append(args))
+    monkeypatch.setattr(prefetch, "watch", lambda *args: watched.append(args))
+    repo.commit("Initial", {"a.txt": "a\n", "b.txt": "b\n"})
+    repo.write("a.txt", "c\n")
+    repo.write("b.txt", "c\n")
+
+    assert CliRunner().invoke(ag.cli, ["add", "a.txt"]).exit_code == 0
+    assert (
+        CliRunner()
+        .invoke(ag.cli, ["add", "b.txt", "--prefetch", "--history", "2", "--max-prompt-tokens", "100"])
+        .exit_code
+        == 0
+    )
+    assert repo.git("diff", "--cached", "--name-only").split() == ["a.txt", "b.txt"]
+    assert started == [(2, 100)]
+
+    assert CliRunner().invoke(ag.cli, ["prefetch", "--watch"]).exit_code == 0
+    assert watched == [(0, None)]
+
+    assert CliRunner().invoke(ag.cli, ["prefetch", "--history", "1"]).exit_code == 0
+    assert prefetch.take(history=1) == "Update a.txt, b.txt\n\n- Change a.txt\n- Change b.txt"
+
+
+def test_hook_commands(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+
+    result = CliRunner().invoke(ag.cli, ["hook", "install"])
+    assert result.exit_code == 0
+    assert result.output == f"Installed {repo.path / '.git' / 'hooks' / 'post-commit'}\n"
+    assert CliRunner().invoke(ag.cli, ["hook", "uninstall"]).exit_code == 0
+
+    result = CliRunner().invoke(ag.cli, ["hook", "uninstall"])
+    assert result.exit_code == 1
+    assert "No hook installed" in result.output
+
+    repo.write(".git/hooks/post-commit", "#!/bin/sh\n")
+    result = CliRunner().invoke(ag.cli, ["hook", "install"])
+    assert result.exit_code == 1
+    assert "use --force" in result.output
+    assert CliRunner().invoke(ag.cli, ["hook", "install", "--force"]).exit_code == 0
+
+
+def test_review_notes(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.git("notes", "--ref=ci-review", "add", "-m", "Looks good.", "HEAD")
+
+    result = CliRunner().invoke(ag.cli, ["review", "notes", "-n", "1"])
+    assert result.exit_code == 0
+    assert "Looks good." in result.output
+
+    result = CliRunner().invoke(ag.cli, ["review", "notes", "--", "--all"])
+    assert result.exit_code == 1
+    assert "Error" in result.output
+
+
+def test_serve(tmp_path, monkeypatch):
+    from ci import daemon
+
+    directory = tmp_path / "d"
+    directory.mkdir(mode=0o700)
+    monkeypatch.setenv("CI_DAEMON_SOCKET", str(directory / "ag.sock"))
+    monkeypatch.setenv("PYTHONPATH", str(ROOT))
+
+    result = CliRunner().invoke(ag.cli, ["serve", "--idle-timeout", "30"])
+    assert result.output == f"Serving on {directory / 'ag.sock'}\n"
+    try:
+        assert CliRunner().invoke(ag.cli, ["serve"]).output == f"Already serving on {directory / 'ag.sock'}\n"
+    finally:
+        assert CliRunner().invoke(ag.cli, ["serve", "--stop"]).exit_code == 0
+
+    result = CliRunner().invoke(ag.cli, ["serve", "--stop"])
+    assert result.exit_code == 1
+    assert "No daemon is running." in result.output
+
+    served = []
+    monkeypatch.setattr(daemon, "serve", served.append)
+    assert CliRunner().invoke(ag.cli, ["serve", "--foreground", "--idle-timeout", "5"]).exit_code == 0
+    assert served == [5.0]
+
+    def start(idle_timeout):
+        raise RuntimeError("Daemon exited with status 1")
+
+    monkeypatch.setattr(daemon, "start", start)
+    result = CliRunner().invoke(ag.cli, ["serve"])
+    assert result.exit_code == 1
+    assert "Daemon exited with status 1" in result.output
+
+
+def test_diff_cached_and_show(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.git("add", "a.txt")
+
+    result = CliRunner().invoke(ag.cli, ["dc", "--no-pager"])
+    assert result.exit_code == 0
+    assert "+b" in result.output
+
+    result = CliRunner().invoke(ag.cli, ["show", "--no-pager", "--pygments"])
+    assert result.exit_code == 0
+    assert "Initial" in result.output
@@ -0,0 +1,76 @@
+import pytest
+
+from ci.llm import cache, openai
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000.0
+
+    def time(self) -> float:
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock.time)
+    return clock
+
+
+def test_get_and_put(tmp_path):
+    store = cache.Cache(tmp_path / "cache.sqlite3")
+
+    assert store.get("key") is None
+    store.put("key", {"value": 1})
+
+    assert store.get("key") == {"value": 1}
+    stats = store.stats()
+    assert (stats.hits, stats.misses, stats.entries) == (1, 1, 1)
+
+
+def test_evicts_least_recently_used_above_max_bytes(tmp_path, clock):
+    # Fits two of the 19 byte entries.
+    store = cache.Cache(tmp_path / "cache.sqlite3", max_bytes=45)
+    store.put("a", {"v": "x" * 10})
+    store.put("b", {"v": "x" * 10})
+    assert store.get("a") is not None
+
+    store.put("c", {"v": "x" * 10})
+
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.get("c") is not None
+
+
+def test_evicts_entries_older_than_max_age(tmp_path, clock):
+    store = cache.Cache(tmp_path / "cache.sqlite3", max_age=10)
+    store.put("old", {"v": 1})
+    clock.now += 100
+
+    store.put("new", {"v": 2})
+
+    assert store.get("old") is None
+    assert store.get("new") == {"v": 2}
+
+
+def test_completion_key_separates_backends_and_requests():
+    request = openai.ChatRequest(model="gpt-4", messages=[openai.UserMessage("diff")])
+    other = openai.ChatRequest(model="gpt-4", messages=[openai.UserMessage("other diff")])
+
+    assert cache.completion_key(request) == cache.completion_key(request, "openai")
+    assert cache.completion_key(request) != cache.completion_key(request, "stub")
+    assert cache.completion_key(request) != cache.completion_key(other)
+
+
+def test_caches_are_kept_apart(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    reviews = cache.get_cache(cache.REVIEWS)
+    assert reviews.get("key") is None
+    reviews.put("key", {"review": "Looks good to me"})
+
+    assert cache.get_cache(cache.REVIEWS) is reviews
+    assert cache.get_cache() is not reviews
+    assert cache.get_cache().stats() == cache.Stats(hits=0, misses=0, entries=0, size=0)
+    assert reviews.path == tmp_path / "ci" / "reviews.sqlite3"
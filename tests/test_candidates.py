@@ -0,0 +1,43 @@
+import os
+import time
+
+from ci import candidates
+
+
+def test_take_in_order(repo):
+    candidates.store("key", ["one", "two"])
+
+    assert candidates.take("key") == "one"
+    assert candidates.take("key") == "two"
+    assert candidates.take("key") is None
+    assert not (candidates._candidates_dir() / "key.json").exists()
+
+
+def test_take_unknown_or_corrupt_key(repo):
+    assert candidates.take("key") is None
+
+    candidates._candidates_dir().mkdir(parents=True)
+    (candidates._candidates_dir() / "key.json").write_text("{")
+    assert candidates.take("key") is None
+
+    (candidates._candidates_dir() / "key.json").write_text("[]")
+    assert candidates.take("key") is None
+
+
+def test_store_nothing_removes_the_key(repo):
+    candidates.store("key", ["one"])
+    candidates.store("key", [])
+    candidates.store("key", [])
+
+    assert candidates.take("key") is None
+
+
+def test_store_removes_stale_candidates(repo):
+    candidates.store("old", ["one"])
+    stale = time.time() - candidates.MAX_AGE - 1
+    os.utime(candidates._candidates_dir() / "old.json", (stale, stale))
+
+    candidates.store("new", ["two"])
+
+    assert candidates.take("old") is None
+    assert candidates.take("new") == "two"
@@ -0,0 +1,105 @@
+import subprocess
+import sys
+
+import pytest
+
+from ci import catfile
+
+
+@pytest.fixture
+def worker(repo):
+    repo.commit("Initial", {"a b.txt": "a\n"})
+    worker = catfile.CatFile(str(repo.path))
+    yield worker
+    worker.close()
+
+
+def test_check_many(worker, monkeypatch):
+    monkeypatch.setattr(catfile, "BATCH_SIZE", 2)
+
+    head, tree, blob, missing = worker.check_many(["HEAD", "HEAD^{tree}", "HEAD:a b.txt", "HEAD~1"])
+
+    assert head.object_type == "commit"
+    assert tree.object_type == "tree"
+    assert (blob.object_type, blob.size) == ("blob", 2)
+    assert missing is None
+    assert worker.check("HEAD") == head
+
+
+def test_read(worker):
+    info, content = worker.read("HEAD:a b.txt")
+
+    assert info.object_type == "blob"
+    assert content == b"a\n"
+    assert worker.read("HEAD:missing.txt") is None
+
+
+def test_lookups_reuse_the_process(worker):
+    worker.check("HEAD")
+    p = worker._processes["--batch-check"]
+    worker.check("HEAD")
+    assert worker._processes["--batch-check"] is p
+
+    p.kill()
+    p.wait()
+    assert worker.check("HEAD") is not None
+    assert worker._processes["--batch-check"] is not p
+
+
+def test_names_with_newlines_are_rejected(worker):
+    with pytest.raises(ValueError, match="Invalid object name"):
+        worker.check("HEAD\nHEAD")
+    with pytest.raises(ValueError, match="Invalid object name"):
+        worker.read("HEAD\nHEAD")
+
+
+def test_failed_lookups_stop_the_process(tmp_path):
+    worker = catfile.CatFile(str(tmp_path))
+    # Exits once it has read the lookup, like `git cat-file` outside a repository.
+    fake = subprocess.Popen(
+        [sys.executable, "-c", "import sys; sys.stdin.readline()"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    worker._processes["--batch-check"] = fake
+
+    with pytest.raises(EOFError):
+        worker.check("HEAD")
+
+    assert fake.returncode is not None
+    assert worker._processes == {}
+
+    # The real one may exit before the lookup is even written.
+    with pytest.raises((EOFError, BrokenPipeError)):
+        worker.check("HEAD")
+
+
+def test_truncated_content_is_an_error(tmp_path):
+    worker = catfile.CatFile(str(tmp_path))
+    script = "import sys; sys.stdin.readline(); sys.stdout.write('0123 blob 10\\nshort')"
+    fake = subprocess.Popen([sys.executable, "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    worker._processes["--batch"] = fake
+
+    with pytest.raises(EOFError):
+        worker.read("HEAD")
+
+    assert fake.returncode is not None
+    assert worker._processes == {}
+
+
+def test_get_catfile_is_shared_per_directory(repo, tmp_path, monkeypatch):
+    worker = catfile.get_catfile()
+    assert catfile.get_catfile() is worker
+
+    monkeypatch.chdir(tmp_path)
+    assert catfile.get_catfile() is not worker
+
+    catfile.close_all()
+    assert catfile._catfiles == {}
+
+
+def test_close_without_pipes(tmp_path):
+    worker = catfile.CatFile(str(tmp_path))
+    worker._processes["--batch"] = subprocess.Popen(["true"])
+
+    worker.close()
+
+    assert worker._processes == {}
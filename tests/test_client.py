@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+
+from ci.llm import cache, client, openai, scheduler
+from ci.llm.stub import StubBackend, StubConfig
+
+
+class SlowBackend:
+    name = "slow"
+
+    def __init__(self):
+        self.closed = 0
+
+    async def stream(self, kwargs):
+        async def chunks():
+            try:
+                await asyncio.sleep(10)
+                yield {}
+            finally:
+                self.closed += 1
+
+        return chunks()
+
+    async def aclose(self):
+        pass
+
+
+def test_open_stream_closes_cancelled_streams():
+    backend = SlowBackend()
+    async_client = client.AsyncClient(backend, scheduler.Scheduler())
+
+    async def main():
+        task = asyncio.ensure_future(async_client._open_stream({}))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+
+    assert backend.closed == 1
+
+
+class EmptyBackend:
+    name = "empty"
+
+    async def stream(self, kwargs):
+        async def chunks():
+            return
+            yield
+
+        return chunks()
+
+    async def aclose(self):
+        pass
+
+
+class FailingBackend(EmptyBackend):
+    name = "failing"
+
+    async def stream(self, kwargs):
+        raise ValueError("Bad request")
+
+
+def _request(**kwargs) -> openai.ChatRequest:
+    return openai.ChatRequest(model=openai.Models.GPT_4, messages=[openai.UserMessage("Hi")], **kwargs)
+
+
+@pytest.fixture
+def sync_client(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(cache, "enabled", True)
+    clients = []
+
+    def make(backend) -> client.Client:
+        clients.append(client.Client(backend, scheduler.Scheduler()))
+        return clients[-1]
+
+    yield make
+    for c in clients:
+        c.close()
+
+
+def test_responses_are_cached(sync_client):
+    backend = StubBackend()
+    c = sync_client(backend)
+
+    response = c.chat_completion(_request())
+    assert c.chat_completion(_request()) == response
+    assert "".join(c.chat_completion_stream(_request())) == response.message.content
+    assert backend.requests == 1
+
+
+def test_streamed_responses_are_assembled_and_cached(sync_client):
+    backend = StubBackend()
+    c = sync_client(backend)
+
+    deltas = list(c.chat_completion_stream(_request(n=2)))
+    assert len(deltas) > 1
+
+    response = c.chat_completion(_request(n=2, stream=True))
+    assert backend.requests == 1
+    assert [choice.message.content for choice in response.choices] == [
+        "".join(deltas),
+        "".join(deltas) + "\n\n(candidate 2)",
+    ]
+    assert response.choices[1].finish_reason is None
+
+    uncached = c.chat_completion(_request(temperature=0.5, stream=True))
+    assert uncached.message.content == "".join(deltas)
+    assert backend.requests == 2
+
+
+def test_empty_streams(sync_client):
+    c = sync_client(EmptyBackend())
+
+    assert list(c.chat_completion_stream(_request())) == []
+    assert c.chat_completion(_request(temperature=0.5, stream=True)).choices == []
+
+
+def test_stream_errors_are_raised_in_the_caller(sync_client):
+    c = sync_client(FailingBackend())
+
+    with pytest.raises(ValueError, match="Bad request"):
+        list(c.chat_completion_stream(_request()))
+
+
+def test_gather_keeps_the_order_of_the_requests(sync_client):
+    c = sync_client(StubBackend(StubConfig(responses=["a", "b", "c"])))
+    requests = [_request(temperature=t) for t in (0.0, 0.1, 0.2, 0.3)]
+
+    responses = c.gather(requests, concurrency=2)
+
+    assert responses == [c.chat_completion(request) for request in requests]
+
+
+def test_close_twice(sync_client):
+    c = sync_client(StubBackend())
+
+    c.close()
+    c.close()
+
+
+def test_close_streams_without_aclose():
+    asyncio.run(client._close(iter([])))
+
+
+def test_shared_client_follows_the_environment(stub_env, monkeypatch):
+    shared = client.get_client()
+    assert client.get_client() is shared
+    response = client.chat_completion(_request())
+    assert client.gather([_request()]) == [response]
+    assert "".join(client.chat_completion_stream(_request())) == response.message.content
+
+    monkeypatch.setenv("CI_STUB_SEED", "1")
+    assert client.get_client() is not shared
+    assert shared._loop.is_closed()
+
+
+def test_close_without_shared_client(monkeypatch):
+    monkeypatch.setattr(client, "_client", None)
+
+    client._close_client()
+
+
+@pytest.fixture
+def stub_env(stub, monkeypatch):
+    monkeypatch.setattr(client, "_client", None)
+    yield
+    client._close_client()
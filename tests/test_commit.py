@@ -0,0 +1,123 @@
+import io
+
+import pytest
+
+from ci import git, prefetch
+from ci.cmd import commit
+from ci.llm import openai
+
+
+@pytest.fixture
+def staged(repo, stub, monkeypatch):
+    monkeypatch.setenv("GIT_EDITOR", "true")
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.git("add", "a.txt")
+    return repo
+
+
+class Tty(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def test_create_new_commit_streams_the_message(staged, capsys):
+    commit.create_new_commit(history=1)
+
+    assert staged.git("log", "-1", "--format=%B") == "Update a.txt\n\n- Change a.txt"
+    assert "Update a.txt" in capsys.readouterr().err
+
+
+def test_create_new_commit_without_staged_changes(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+
+    with pytest.raises(ValueError, match="No changes"):
+        commit.create_new_commit()
+
+
+def test_create_new_commit_uses_a_prefetched_message(staged, monkeypatch, capsys):
+    monkeypatch.setattr(prefetch, "take", lambda history, max_prompt_tokens: "Prefetched")
+
+    commit.create_new_commit()
+
+    assert staged.git("log", "-1", "--format=%s") == "Prefetched"
+    assert "prefetched" in capsys.readouterr().err
+
+
+def test_candidates_are_kept_for_the_next_commit(staged, capsys):
+    commit.create_new_commit(n_candidates=3)
+    assert staged.git("log", "-1", "--format=%s") == "Update a.txt"
+    assert "[3]" in capsys.readouterr().err
+
+    # Retrying the same commit picks the next candidate without a request.
+    staged.git("reset", "--soft", "HEAD^")
+    commit.create_new_commit(n_candidates=3)
+    assert staged.git("log", "-1", "--format=%B").endswith("(candidate 2)")
+    assert "next candidate" in capsys.readouterr().err
+
+
+def test_amend_rewords_the_latest_commit(staged):
+    staged.git("commit", "--quiet", "-m", "wip")
+
+    commit.amend_commit()
+
+    assert staged.git("log", "-1", "--format=%s") == "Update a.txt"
+    assert staged.git("rev-list", "--count", "HEAD") == "2"
+
+
+def test_amend_with_staged_changes(staged):
+    staged.git("commit", "--quiet", "-m", "wip")
+    staged.write("b.txt", "b\n")
+    staged.git("add", "b.txt")
+
+    commit.amend_commit()
+
+    assert staged.git("log", "-1", "--format=%s") == "Update b.txt"
+    assert staged.git("show", "--format=", "--name-only", "HEAD").split() == ["a.txt", "b.txt"]
+
+
+def test_amend_picks_from_the_candidates_of_the_commit(staged):
+    commit.create_new_commit(n_candidates=2)
+
+    commit.amend_commit(n_candidates=2)
+    assert staged.git("log", "-1", "--format=%B").endswith("(candidate 2)")
+
+    # With no candidates left, new ones are generated.
+    commit.amend_commit(n_candidates=2)
+    assert staged.git("log", "-1", "--format=%s") == "Update a.txt"
+    assert staged.git("rev-list", "--count", "HEAD") == "2"
+
+
+def test_candidates_are_not_stored_during_conflicts(staged, monkeypatch):
+    monkeypatch.setattr(git, "write_tree", lambda: None)
+
+    commit.create_new_commit(n_candidates=2)
+
+    assert staged.git("log", "-1", "--format=%s") == "Update a.txt"
+    assert not commit.candidates._candidates_dir().exists()
+
+
+def test_empty_messages_are_rejected(staged, monkeypatch):
+    monkeypatch.setattr(commit, "_ask_for_commit_msgs", lambda *args, **kwargs: [])
+    with pytest.raises(ValueError, match="empty"):
+        commit.create_new_commit(n_candidates=2)
+
+    monkeypatch.setattr(openai, "chat_completion_stream", lambda request: iter(["", " \n"]))
+    with pytest.raises(ValueError, match="empty"):
+        commit.create_new_commit()
+    assert staged.git("rev-list", "--count", "HEAD") == "1"
+
+
+def test_pick_asks_on_a_terminal(monkeypatch):
+    monkeypatch.setattr("sys.stdin", Tty("3\nx\n2\n"))
+    assert commit._pick(["one", "two"]) == 1
+
+    monkeypatch.setattr("sys.stdin", Tty("\n"))
+    assert commit._pick(["one", "two"]) == 0
+
+    monkeypatch.setattr("sys.stdin", Tty(""))
+    assert commit._pick(["one"]) == 0
+
+
+def test_generate_commit_msg(staged):
+    assert commit.generate_commit_msg(history=1) == "Update a.txt\n\n- Change a.txt"
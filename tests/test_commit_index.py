@@ -0,0 +1,89 @@
+import subprocess
+
+from ci import commit_index, git
+
+
+def test_reviews_are_kept_apart_by_key(tmp_path):
+    index = commit_index.CommitIndex(tmp_path / "index.sqlite3")
+    index.put_review("a" * 40, "openai-key", "Real review")
+    index.put_review("a" * 40, "other-key", "Other review")
+
+    assert index.get_reviews(["a" * 40, "b" * 40], "openai-key") == {"a" * 40: "Real review"}
+    assert index.get_reviews(["a" * 40], "missing-key") == {}
+
+
+def test_reviews_persist(tmp_path):
+    commit_index.CommitIndex(tmp_path / "index.sqlite3").put_review("a" * 40, "key", "Review")
+
+    assert commit_index.CommitIndex(tmp_path / "index.sqlite3").get_reviews(["a" * 40], "key") == {"a" * 40: "Review"}
+
+
+def test_commits_round_trip(tmp_path):
+    index = commit_index.CommitIndex(tmp_path / "index.sqlite3")
+    commits = [
+        git.Commit("a" * 40, "A <a@example.com>", "Mon Jan 1 2024", "First", git.Diff("diff --git a/x b/x\n")),
+        git.Commit("b" * 40, "B <b@example.com>", "Tue Jan 2 2024", "Merge"),
+    ]
+    index.put(commits)
+
+    assert index.get(["a" * 40, "b" * 40, "c" * 40]) == {commit.commit_hash: commit for commit in commits}
+
+
+def test_latest_commits_fill_the_index(repo):
+    first = repo.commit("First\n\nBody", {"a.txt": "a\n"})
+    second = repo.commit("Second", {"a.txt": "b\n"})
+
+    assert [commit.commit_hash for commit in git.latest_commits(1)] == [second]
+    assert list(commit_index.get_index().get([first, second])) == [second]
+
+    commits = git.latest_commits(2)
+
+    assert [commit.commit_hash for commit in commits] == [second, first]
+    assert commits[1].message == "First\n\nBody"
+    assert git.last_commit() == commits[0]
+
+
+def test_show_renders_indexed_commits(repo):
+    commit_hash = repo.commit("Subject\n\nBody\nsecond line", {"a.txt": "a\n", "b.txt": "b\n"})
+    expected = subprocess.check_output(["git", "show", commit_hash]).decode("utf-8")
+
+    assert git.show(commit_hash[:7]) == expected
+    assert commit_index.get_index().get([commit_hash])
+    assert git.show(commit_hash) == expected
+    assert "".join(git.iter_show(commit_hash)) == expected
+
+
+def test_show_reads_merges_from_git(repo):
+    repo.commit("Base", {"a.txt": "a\n"})
+    repo.git("checkout", "-q", "-b", "side")
+    repo.commit("Side", {"b.txt": "b\n"})
+    repo.git("checkout", "-q", "main")
+    repo.commit("Main", {"a.txt": "c\n"})
+    repo.git("merge", "-q", "--no-edit", "side")
+    merge = repo.git("rev-parse", "HEAD")
+    expected = subprocess.check_output(["git", "show", merge]).decode("utf-8")
+
+    assert git.show(merge) == expected
+    assert "".join(git.iter_show(merge)) == expected
+
+
+def test_show_without_index(repo, monkeypatch):
+    commit_hash = repo.commit("Subject", {"a.txt": "a\n"})
+    monkeypatch.setattr(commit_index, "get_index", lambda: None)
+
+    assert git.show(commit_hash).startswith(f"commit {commit_hash}\n")
+    assert "".join(git.iter_show(commit_hash)).startswith(f"commit {commit_hash}\n")
+    assert [commit.commit_hash for commit in git.latest_commits(1)] == [commit_hash]
+
+
+def test_get_index_outside_a_repository(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert commit_index.get_index() is None
+
+
+def test_get_index_disabled(repo, monkeypatch):
+    monkeypatch.setattr(commit_index, "_indexes", {})
+    repo.write(".git/ci-cache", "not a directory\n")
+
+    assert commit_index.get_index() is None
+    assert commit_index._indexes == {git.cache_dir() / "index.sqlite3": None}
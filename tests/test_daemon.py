@@ -0,0 +1,450 @@
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Iterator
+
+import pytest
+
+from ci import daemon
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def socket_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "d"
+    directory.mkdir(mode=0o700)
+    monkeypatch.setenv("CI_DAEMON_SOCKET", str(directory / "ag.sock"))
+    return directory
+
+
+def test_socket_path(monkeypatch):
+    monkeypatch.delenv("CI_DAEMON_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert daemon.socket_path() == Path("/run/user/1000/ci/ag.sock")
+
+    monkeypatch.setenv("CI_DAEMON_SOCKET", "/tmp/x.sock")
+    assert daemon.socket_path() == Path("/tmp/x.sock")
+
+
+def test_messages_carry_file_descriptors():
+    left, right = socket.socketpair(socket.AF_UNIX)
+    read, write = os.pipe()
+    with left, right:
+        daemon._send(left, {"argv": ["review"]}, fds=(write,))
+        message, fds = daemon._recv(right, max_fds=3)
+        os.close(write)
+
+        assert message == {"argv": ["review"]}
+        assert len(fds) == 1
+        os.write(fds[0], b"through the daemon")
+        os.close(fds[0])
+        assert os.read(read, 100) == b"through the daemon"
+    os.close(read)
+
+
+def test_recv_rejects_large_messages(monkeypatch):
+    monkeypatch.setattr(daemon, "MAX_MESSAGE_BYTES", 10)
+    left, right = socket.socketpair(socket.AF_UNIX)
+    with left, right:
+        daemon._send(left, {"argv": ["review", "diff"]})
+        with pytest.raises(ValueError):
+            daemon._recv(right)
+
+
+@pytest.mark.parametrize("max_fds", [0, 3])
+def test_recv_of_closed_connections(max_fds):
+    left, right = socket.socketpair(socket.AF_UNIX)
+    with right:
+        left.close()
+        with pytest.raises(EOFError):
+            daemon._recv(right, max_fds=max_fds)
+
+
+def test_command():
+    assert daemon._command(["--backend", "stub", "review", "diff"]) == "review"
+    assert daemon._command(["-v"]) is None
+
+
+def test_ci_runs_in_process():
+    # `git commit -e` needs the controlling terminal, which the daemon lacks.
+    assert daemon._command(["ci"]) not in daemon.COMMANDS
+
+
+def test_no_daemon(socket_dir):
+    assert not daemon.is_running()
+    assert daemon.run(["review", "--help"]) is None
+    assert not daemon.stop()
+
+
+def test_socket_in_a_shared_directory_is_not_used(tmp_path, monkeypatch):
+    os.chmod(tmp_path, 0o755)
+    monkeypatch.setenv("CI_DAEMON_SOCKET", str(tmp_path / "ag.sock"))
+
+    assert daemon._connect(tmp_path / "ag.sock") is None
+
+
+def test_silent_clients_do_not_block_others(socket_dir, monkeypatch):
+    monkeypatch.setattr(daemon, "REQUEST_TIMEOUT", 0.1)
+    server = daemon.Server(daemon.socket_path())
+    server._listener.bind(str(server.path))
+    server._listener.listen()
+    accept = threading.Thread(target=server._accept, daemon=True)
+    accept.start()
+
+    with socket.socket(socket.AF_UNIX) as silent:
+        silent.connect(str(server.path))
+        assert daemon.stop()
+        accept.join(timeout=5)
+
+    assert not accept.is_alive()
+    assert server._requests.get(timeout=1) is None
+    server._listener.close()
+
+
+@pytest.fixture
+def served(socket_dir, tmp_path):
+    """
+    A daemon running in a subprocess.
+    """
+    env = {**os.environ, "PYTHONPATH": str(ROOT)}
+    p = subprocess.Popen([sys.executable, "-m", "ci.daemon", "--idle-timeout", "30"], cwd=tmp_path, env=env)
+    try:
+        for _ in range(200):
+            if daemon.is_running():
+                break
+            assert p.poll() is None
+            threading.Event().wait(0.05)
+        yield p
+        # Stopped rather than killed, so its coverage is written.
+        daemon.stop()
+        p.wait(timeout=10)
+    finally:
+        p.kill()
+
+
+def test_commands_run_in_the_daemon_with_the_streams_of_the_client(served, capfd):
+    assert daemon.run(["review", "--help"]) == 0
+    assert daemon.run(["review", "no-such-command"]) == 2
+    out, err = capfd.readouterr()
+    assert "Usage: ag review" in out
+    assert "No such command" in err
+
+    assert daemon.stop()
+    assert served.wait(timeout=10) == 0
+    assert not daemon.stop()
+
+
+def _start_slow_review(tmp_path) -> socket.socket:
+    """
+    Sends a review that takes a long time to the daemon, without waiting
+    for it.
+    """
+    (tmp_path / "a.py").write_text("pass\n")
+    env = {**os.environ, "CI_LLM_BACKEND": "stub", "CI_STUB_LATENCY": "30", "XDG_CACHE_HOME": str(tmp_path)}
+    sock = daemon._connect(daemon.socket_path())
+    assert sock is not None
+    with open(os.devnull, "r+") as devnull:
+        fds = (devnull.fileno(),) * 3
+        daemon._send(sock, {"argv": ["review", "file", "a.py"], "cwd": str(tmp_path), "env": env}, fds=fds)
+    assert daemon._recv(sock)[0] == {"status": "started"}
+    return sock
+
+
+def test_clients_interrupt_commands(served, tmp_path):
+    with _start_slow_review(tmp_path) as sock:
+        daemon._send(sock, {"ignored": True})
+        daemon._send(sock, {"interrupt": True})
+
+        # Click reports an interrupt during the command as "Aborted!".
+        assert daemon._recv(sock)[0] in ({"exit": 1}, {"exit": 130})
+
+
+def test_clients_that_go_away_interrupt_commands(served, tmp_path):
+    _start_slow_review(tmp_path).close()
+
+    for _ in range(200):
+        # Busy until the interrupted command is done.
+        if daemon.run(["review", "--help"]) == 0:
+            break
+        threading.Event().wait(0.05)
+    else:
+        pytest.fail("The command was not interrupted")
+
+
+def test_commands_in_missing_directories_fail(served, capfd):
+    sock = daemon._connect(daemon.socket_path())
+    with sock:
+        daemon._send(sock, {"argv": ["review"], "cwd": "/nonexistent", "env": {}}, fds=(0, 1, 2))
+        assert daemon._recv(sock)[0] == {"status": "started"}
+        assert daemon._recv(sock)[0] == {"exit": 1}
+
+    assert daemon.run(["review", "--help"]) == 0
+
+
+def test_interrupts_outside_of_the_command(socket_dir, monkeypatch):
+    def execute(argv, cwd, env, fds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(daemon, "_execute", execute)
+    server = daemon.Server(daemon.socket_path())
+    server._busy.acquire()
+    left, right = socket.socketpair(socket.AF_UNIX)
+    read, write = os.pipe()
+
+    with right:
+        server._handle(left, {"argv": ["review"], "cwd": "/", "env": {}}, [read, write])
+        assert daemon._recv(right)[0] == {"status": "started"}
+        assert daemon._recv(right)[0] == {"exit": 130}
+
+    assert server._busy.acquire(blocking=False)
+
+
+def test_default_socket_path(monkeypatch):
+    monkeypatch.delenv("CI_DAEMON_SOCKET", raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+
+    assert daemon.socket_path() == Path(tempfile.gettempdir()) / f"ci-{os.getuid()}" / "ag.sock"
+
+
+def test_private_directories(tmp_path):
+    assert not daemon._is_private(tmp_path / "missing")
+
+    daemon._make_private_dir(tmp_path / "private")
+    assert daemon._is_private(tmp_path / "private")
+
+    os.chmod(tmp_path, 0o755)
+    with pytest.raises(RuntimeError, match="mode 0700"):
+        daemon._make_private_dir(tmp_path)
+
+
+@contextlib.contextmanager
+def fake_daemon(handler: Callable[[socket.socket], None]) -> Iterator[None]:
+    """
+    Listens on the socket and handles one connection with `handler`.
+    """
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(str(daemon.socket_path()))
+    listener.listen()
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn:
+            handler(conn)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        thread.join(timeout=5)
+        listener.close()
+        daemon.socket_path().unlink()
+
+
+def _recv_request(conn: socket.socket) -> dict:
+    request, fds = daemon._recv(conn, max_fds=3)
+    for fd in fds:
+        os.close(fd)
+    return request
+
+
+def test_daemons_of_other_users_are_not_used(socket_dir, monkeypatch):
+    monkeypatch.setattr(daemon, "_peer_uid", lambda sock: os.getuid() + 1)
+
+    with fake_daemon(lambda conn: None):
+        assert not daemon.is_running()
+        # Lets the fake daemon return.
+        socket.socket(socket.AF_UNIX).connect(str(daemon.socket_path()))
+
+
+def test_peer_uid(monkeypatch):
+    left, right = socket.socketpair(socket.AF_UNIX)
+    with left, right:
+        assert daemon._peer_uid(left) == os.getuid()
+
+        monkeypatch.delattr(socket, "SO_PEERCRED")
+        assert daemon._peer_uid(left) is None
+
+
+def test_run_in_process_if_the_daemon_hangs_up(socket_dir):
+    with fake_daemon(lambda conn: None):
+        assert daemon.run(["review"]) is None
+    with fake_daemon(lambda conn: None):
+        assert daemon.stop()
+
+
+def test_run_in_process_if_the_daemon_is_busy(socket_dir):
+    with fake_daemon(lambda conn: (_recv_request(conn), daemon._send(conn, {"status": "busy"}))):
+        assert daemon.run(["review"]) is None
+
+
+def test_run_reports_lost_connections(socket_dir, capsys):
+    with fake_daemon(lambda conn: (_recv_request(conn), daemon._send(conn, {"status": "started"}))):
+        assert daemon.run(["review"]) == 1
+
+    assert "lost connection to the daemon" in capsys.readouterr().err
+
+
+def test_run_forwards_interrupts(socket_dir, monkeypatch):
+    def handle(conn):
+        _recv_request(conn)
+        daemon._send(conn, {"status": "started"})
+        message, _ = daemon._recv(conn)
+        daemon._send(conn, {"exit": 130 if message == {"interrupt": True} else 0})
+
+    calls = []
+    recv = daemon._recv
+
+    def interrupted_recv(sock, max_fds=0):
+        # Only the client runs in the main thread.
+        if threading.current_thread() is threading.main_thread():
+            calls.append(1)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+        return recv(sock, max_fds)
+
+    monkeypatch.setattr(daemon, "_recv", interrupted_recv)
+    with fake_daemon(handle):
+        assert daemon.run(["review"]) == 130
+
+
+def test_start_and_stop(socket_dir, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(ROOT))
+
+    assert daemon.start(idle_timeout=30) == daemon.socket_path()
+    try:
+        assert daemon.is_running()
+        with pytest.raises(RuntimeError, match="already listening"):
+            daemon.Server(daemon.socket_path()).serve_forever()
+    finally:
+        assert daemon.stop()
+    assert not daemon.is_running()
+    assert (socket_dir / "ag.log").exists()
+
+
+def test_start_failures(socket_dir, monkeypatch):
+    monkeypatch.setattr(sys, "executable", "false")
+    with pytest.raises(RuntimeError, match="exited with status 1"):
+        daemon.start()
+
+    monkeypatch.setattr(daemon, "START_TIMEOUT", 0)
+    with pytest.raises(RuntimeError, match="did not start listening"):
+        daemon.start()
+
+
+def test_reset_settings_without_openai(monkeypatch):
+    from ci.llm import cache
+
+    monkeypatch.delitem(sys.modules, "openai", raising=False)
+    monkeypatch.setattr(cache, "enabled", False)
+
+    daemon._reset_settings()
+
+    assert cache.enabled
+    assert "openai" not in sys.modules
+
+
+@pytest.mark.parametrize(
+    "error, code, err",
+    [(None, 0, ""), (SystemExit("Bad usage"), 1, "Bad usage\n"), (ValueError("Bug"), 1, "ValueError: Bug")],
+)
+def test_main_of_commands_in_the_daemon(monkeypatch, capsys, error, code, err):
+    from ci import ag
+
+    def main(args, prog_name):
+        if error is not None:
+            raise error
+
+    monkeypatch.setattr(ag.cli, "main", main)
+
+    assert daemon._main(["review"]) == code
+    assert err in capsys.readouterr().err
+
+
+def test_server_exits_when_idle(socket_dir):
+    server = daemon.Server(daemon.socket_path(), idle_timeout=0.1)
+
+    server.serve_forever()
+
+    assert not daemon.socket_path().exists()
+
+
+class InterruptedQueue:
+    def __init__(self):
+        self.items = [KeyboardInterrupt, None]
+
+    def get(self, timeout):
+        item = self.items.pop(0)
+        if item is KeyboardInterrupt:
+            raise KeyboardInterrupt
+        return item
+
+
+def test_server_ignores_late_interrupts(socket_dir):
+    server = daemon.Server(daemon.socket_path())
+    server._requests = InterruptedQueue()
+    server._interrupted = True
+
+    server.serve_forever()
+
+    server = daemon.Server(daemon.socket_path())
+    server._requests = InterruptedQueue()
+    with pytest.raises(KeyboardInterrupt):
+        server.serve_forever()
+
+
+class ReplacedSocketQueue:
+    def get(self, timeout):
+        # A new daemon took over the path.
+        path = daemon.socket_path()
+        path.with_name("new.sock").write_text("")
+        os.replace(path.with_name("new.sock"), path)
+
+
+def test_server_leaves_the_socket_of_a_new_daemon(socket_dir):
+    server = daemon.Server(daemon.socket_path())
+    server._requests = ReplacedSocketQueue()
+
+    server.serve_forever()
+
+    assert daemon.socket_path().exists()
+
+
+def test_busy_server(socket_dir):
+    server = daemon.Server(daemon.socket_path())
+    server._listener.bind(str(server.path))
+    server._listener.listen()
+    threading.Thread(target=server._accept, daemon=True).start()
+    server._busy.acquire()
+
+    assert daemon.run(["review"]) is None
+
+    daemon.stop()
+    server._listener.close()
+
+
+def test_main_runs_review_in_the_daemon(socket_dir, monkeypatch):
+    runs = []
+    monkeypatch.setattr(daemon, "run", lambda argv: runs.append(argv) or 3)
+    monkeypatch.setattr(sys, "argv", ["ag", "review", "diff"])
+
+    with pytest.raises(SystemExit) as exc_info:
+        daemon.main()
+    assert exc_info.value.code == 3
+
+    monkeypatch.setattr(daemon, "run", lambda argv: runs.append(argv))
+    monkeypatch.setattr(sys, "argv", ["ag", "review", "--help"])
+    with pytest.raises(SystemExit) as exc_info:
+        daemon.main()
+    assert exc_info.value.code == 0
+
+    monkeypatch.setenv("CI_DAEMON", "0")
+    with pytest.raises(SystemExit):
+        daemon.main()
+    assert runs == [["review", "diff"], ["review", "--help"]]
@@ -0,0 +1,46 @@
+import pytest
+
+from ci import highlight
+from ci.cmd import diff, show
+
+
+@pytest.fixture
+def changed(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.commit("Change a", {"a.txt": "b\n"})
+    repo.write("a.txt", "c\n")
+    repo.git("add", "a.txt")
+    return repo
+
+
+def test_cached(changed, capsys):
+    diff.cached(use_pager=False)
+
+    out = capsys.readouterr().out
+    assert f"{highlight.GREEN}+c{highlight.RESET}\n" in out
+    assert f"{highlight.BOLD}--- a/a.txt{highlight.RESET}\n" in out
+
+
+def test_cached_with_pygments(changed, capsys):
+    diff.cached(pygments=True, use_pager=False)
+
+    assert capsys.readouterr().out == highlight.diff(changed.git("diff", "--cached") + "\n")
+
+
+def test_show(changed, capsys):
+    show.show("HEAD", use_pager=False)
+
+    out = capsys.readouterr().out
+    assert out.startswith(f"{highlight.YELLOW}commit {changed.git('rev-parse', 'HEAD')}{highlight.RESET}\n")
+    assert "    Change a\n" in out
+    assert f"{highlight.GREEN}+b{highlight.RESET}\n" in out
+
+
+def test_show_with_pygments(changed, capsys):
+    commit_hash = changed.git("rev-parse", "HEAD")
+
+    show.show(commit_hash[:7], pygments=True, use_pager=False)
+
+    out = capsys.readouterr().out
+    assert commit_hash in out
+    assert "Change a" in out
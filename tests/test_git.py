@@ -0,0 +1,201 @@
+import io
+import subprocess
+
+import pytest
+
+from ci import git
+
+
+def _log_output(*commits: tuple[str, str, str, str, str]) -> bytes:
+    """
+    Builds the output of `git log --format=LOG_FORMAT -p` for the commits.
+    """
+    return b"".join(b"\0%s\0%s\0%s\0%s\0%s" % tuple(field.encode("utf-8") for field in commit) for commit in commits)
+
+
+def _records(data: bytes) -> list[list[bytes]]:
+    return list(git._log_records(git._read_fields(io.BytesIO(data), git.FIELD_SEPARATOR)))
+
+
+FIRST = ("a" * 40, "A <a@example.com>", "Mon Jan 1 2024", "First\n\nBody\n", "\ndiff --git a/x b/x\n+1\n")
+SECOND = ("b" * 40, "B <b@example.com>", "Tue Jan 2 2024", "Second\n", "")
+
+
+def test_log_records():
+    records = _records(_log_output(FIRST, SECOND))
+
+    assert records == [[field.encode("utf-8") for field in FIRST], [field.encode("utf-8") for field in SECOND]]
+
+
+def test_log_records_keep_nul_bytes_in_patches():
+    commit = (*FIRST[:4], "\ndiff --git a/x b/x\n+a\0b\n")
+
+    (record,) = _records(_log_output(commit))
+
+    assert record[4] == b"\ndiff --git a/x b/x\n+a\0b\n"
+
+
+def test_log_records_across_reads(monkeypatch):
+    monkeypatch.setattr(git, "READ_SIZE", 7)
+
+    records = _records(_log_output(FIRST, SECOND))
+
+    assert [record[0] for record in records] == [b"a" * 40, b"b" * 40]
+    assert records[0][3] == b"First\n\nBody\n"
+
+
+def test_log_records_of_empty_output():
+    assert _records(b"") == []
+
+
+def test_parse_log_record():
+    commit = git.parse_log_record(list(FIRST))
+
+    assert commit.commit_hash == "a" * 40
+    assert commit.message == "First\n\nBody"
+    assert commit.diff.text == "diff --git a/x b/x\n+1\n"
+    assert isinstance(git.parse_log_record(list(SECOND)).diff, git.EmptyDiff)
+
+
+def test_iter_commits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    env = ["-c", "user.name=A", "-c", "user.email=a@example.com"]
+    subprocess.run(["git", "init", "-q"], check=True)
+    for i in range(2):
+        (tmp_path / "file.txt").write_text(f"{i}\n")
+        subprocess.run(["git", "add", "file.txt"], check=True)
+        subprocess.run(["git", *env, "commit", "-q", "-m", f"Commit {i}"], check=True)
+
+    commits = list(git.iter_commits())
+
+    assert [commit.message for commit in commits] == ["Commit 1", "Commit 0"]
+    assert "+1" in commits[0].diff.text
+
+
+@pytest.mark.parametrize("rev", ["--output=/tmp/x", "HEAD\n--all"])
+def test_iter_commits_rejects_options_and_lines(rev):
+    with pytest.raises(ValueError):
+        list(git.iter_commits(revs=[rev]))
+
+
+def test_iter_commits_reads_revisions_from_stdin(repo):
+    hashes = [repo.commit(f"Commit {i}", {"a.txt": f"{i}\n"}) for i in range(3)]
+
+    commits = git.iter_commits(revs=[hashes[0], hashes[2], hashes[1]], patch=False, walk=False)
+
+    assert [commit.commit_hash for commit in commits] == [hashes[0], hashes[2], hashes[1]]
+    assert [commit.message for commit in git.iter_commits(revs=[f"{hashes[0]}..HEAD"])] == ["Commit 2", "Commit 1"]
+
+
+@pytest.mark.parametrize(
+    "commit_hash, valid",
+    [
+        ("HEAD", True),
+        ("HEAD~2", True),
+        ("HEAD^^", True),
+        ("abc1234", True),
+        ("a" * 64, True),
+        ("abc12", False),
+        ("HEAD:secret.txt", False),
+        ("HEAD --output=x", False),
+        ("--output=x", False),
+    ],
+)
+def test_validate_commit_hash(commit_hash, valid):
+    assert git.validate_commit_hash(commit_hash) is valid
+
+
+def test_show_rejects_invalid_and_unknown_commits(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+
+    with pytest.raises(ValueError, match="Invalid"):
+        git.show("HEAD --output=x")
+    with pytest.raises(ValueError, match="Invalid"):
+        git.iter_show("HEAD --output=x")
+    with pytest.raises(ValueError, match="Unknown"):
+        git.show("0" * 40)
+    with pytest.raises(ValueError, match="Unknown"):
+        git.iter_show("HEAD~5")
+
+
+def test_commit_and_diff():
+    commit = git.Commit("a" * 40, "A <a@example.com>", "Mon Jan 1 2024", "First", diff="+1\n")
+
+    assert commit.diff == git.Diff("+1\n")
+    assert str(commit.diff) == "+1\n"
+    assert str(commit) == f"{'a' * 40} A <a@example.com> Mon Jan 1 2024\nFirst"
+    assert str(git.Commit("a" * 40, "A", "Mon", "First").diff) == ""
+
+
+def test_add(repo, monkeypatch):
+    repo.write("a.txt", "a\n")
+    git.add("a.txt")
+
+    assert git.has_staged_changes()
+
+    calls = []
+    monkeypatch.setattr(subprocess, "check_call", calls.append)
+    git.add(None, patch=True)
+
+    assert calls == [["git", "add", "-p"]]
+
+
+def test_notes(repo, tmp_path, monkeypatch):
+    commit_hash = repo.commit("Initial")
+    git.add_note(commit_hash, "Looks good")
+
+    assert list(git.notes()) == [commit_hash]
+
+    monkeypatch.chdir(tmp_path)
+    assert git.notes() == {}
+
+
+def test_write_tree(repo):
+    repo.commit("Base", {"a.txt": "a\n"})
+    tree = repo.git("rev-parse", "HEAD^{tree}")
+
+    assert git.write_tree() == tree
+
+    repo.git("checkout", "--quiet", "-b", "side")
+    repo.commit("Side", {"a.txt": "side\n"})
+    repo.git("checkout", "--quiet", "main")
+    repo.commit("Main", {"a.txt": "main\n"})
+    subprocess.run(["git", "merge", "--quiet", "side"], capture_output=True)
+
+    assert git.write_tree() is None
+
+
+@pytest.mark.parametrize(
+    "cmd, name",
+    [
+        (["git", "-c", "core.untrackedCache=true", "status"], "git status"),
+        (["git", "--no-pager", "log"], "git log"),
+        (["git", "--version"], "git"),
+    ],
+)
+def test_span_name(cmd, name):
+    assert git._span_name(cmd) == name
+
+
+def test_stream_failures(repo):
+    with pytest.raises(subprocess.CalledProcessError):
+        list(git._iter_output(["git", "show", "--no-such-option"]))
+
+
+def test_pipe_message_to_an_exited_process():
+    p = subprocess.Popen(["true"], stdin=subprocess.PIPE)
+    p.wait()
+
+    git._pipe_message(p, iter(["x" * 1_000_000]))
+
+    assert p.returncode == 0
+
+
+def test_resolve_and_list_commits(repo):
+    first = repo.commit("First")
+    second = repo.commit("Second")
+
+    assert git.commit_hash_exists(first[:7])
+    assert not git.commit_hash_exists("0" * 40)
+    assert git.rev_list() == [second, first]
+    assert git.rev_list(1) == [second]
@@ -0,0 +1,127 @@
+import pytest
+
+from ci import highlight
+
+
+def test_markdown_blocks():
+    text = "# Title\n\nFirst line\nsecond line\n\n```python\nx = 1\n\ny = 2\n```\nAfter\n"
+
+    blocks = list(highlight.markdown_blocks([text]))
+
+    assert blocks == [
+        "# Title\n",
+        "First line\nsecond line\n",
+        "```python\nx = 1\n\ny = 2\n```\n",
+        "After\n",
+    ]
+
+
+def test_markdown_blocks_of_streamed_chunks():
+    text = "# Title\n\nSome text\n\n```\ncode\n```\nlast line without newline"
+
+    streamed = list(highlight.markdown_blocks(text[i : i + 3] for i in range(0, len(text), 3)))
+
+    assert streamed == list(highlight.markdown_blocks([text]))
+    assert streamed[-1] == "last line without newline\n"
+
+
+def test_markdown_blocks_of_unclosed_fence():
+    assert list(highlight.markdown_blocks(["```\ncode\n\nmore"])) == ["```\ncode\n\nmore\n"]
+
+
+def test_markdown_blocks_skip_blank_lines():
+    assert list(highlight.markdown_blocks(["\n\ntext\n\n\n"])) == ["text\n"]
+
+
+def test_markdown_stream():
+    assert list(highlight.markdown_stream(["# Title\n\nte", "xt\n"])) == [
+        highlight.markdown("# Title\n"),
+        "\n",
+        highlight.markdown("text\n"),
+    ]
+    assert "\x1b[" in highlight.markdown("# " + "long " * 30, wrap=False)
+    assert list(highlight.markdown_stream([])) == []
+
+
+@pytest.mark.parametrize(
+    "line, group",
+    [
+        ("On branch main", "branch"),
+        ("HEAD detached at 1234567", "branch"),
+        ("# branch.oid 0123456789abcdef", "branch"),
+        ("Changes to be committed:", "staged"),
+        ("Changes not staged for commit:", "unstaged"),
+        ("Untracked files:", "untracked"),
+        ("? new.txt", "untracked"),
+        ("Unmerged paths:", "conflict"),
+        ("both modified:   a.py", "conflict"),
+        ("deleted by them: a.py", "conflict"),
+        ("u UU N... 100644 100644 100644 100644 a b c a.py", "conflict"),
+        ("modified:   a.py", "change"),
+        ("new file:   a.py", "change"),
+        ("1 .M N... 100644 100644 100644 a b a.py", "change"),
+        ("2 R. N... 100644 100644 100644 a b R100 new.py\told.py", "change"),
+        ("Ignored files:", "ignored"),
+        ("! build/", "ignored"),
+    ],
+)
+def test_status_pattern(line, group):
+    match = highlight.STATUS_PATTERN.match(line)
+
+    assert match is not None
+    assert match.lastgroup == group
+
+
+@pytest.mark.parametrize("line", ["", "  (use \"git add <file>...\" to update)", "nothing to commit", "modified"])
+def test_status_pattern_leaves_other_lines(line):
+    assert highlight.STATUS_PATTERN.match(line) is None
+
+
+def test_git_status_line():
+    assert highlight.git_status_line("\tmodified:   a.py\n") == (
+        f"{highlight.PURPLE}\tmodified:   a.py{highlight.RESET}\n"
+    )
+    assert highlight.git_status_line("nothing to commit\n") == "nothing to commit\n"
+
+
+def test_git_status():
+    assert highlight.git_status("On branch main\n\nnothing to commit") == (
+        f"{highlight.BLUE}On branch main{highlight.RESET}\n\nnothing to commit"
+    )
+    assert list(highlight.iter_git_status(["?? a\n", "Untracked files:\n"])) == [
+        "?? a\n",
+        f"{highlight.BRIGHT_RED}Untracked files:{highlight.RESET}\n",
+    ]
+
+
+def test_diff_line():
+    assert highlight.diff_line("commit 0123\n") == f"{highlight.YELLOW}commit 0123{highlight.RESET}\n"
+    assert highlight.diff_line("diff --git a/a b/a") == f"{highlight.BOLD}diff --git a/a b/a{highlight.RESET}"
+    assert highlight.diff_line("--- a/a\n", in_header=True) == f"{highlight.BOLD}--- a/a{highlight.RESET}\n"
+    assert highlight.diff_line("--- a/a\n") == f"{highlight.RED}--- a/a{highlight.RESET}\n"
+    assert highlight.diff_line("@@ -1 +1 @@\n") == f"{highlight.CYAN}@@ -1 +1 @@{highlight.RESET}\n"
+    assert highlight.diff_line("+a\n") == f"{highlight.GREEN}+a{highlight.RESET}\n"
+    assert highlight.diff_line(" a\n") == " a\n"
+    assert highlight.diff_line("\n") == "\n"
+
+
+def test_iter_diff_tracks_file_headers():
+    lines = ["diff --git a/a b/a\n", "--- a/a\n", "+++ b/a\n", "@@ -1 +1 @@\n", "--- a\n", "+++ b\n"]
+
+    highlighted = list(highlight.iter_diff(lines))
+
+    assert highlighted[1:3] == [
+        f"{highlight.BOLD}--- a/a{highlight.RESET}\n",
+        f"{highlight.BOLD}+++ b/a{highlight.RESET}\n",
+    ]
+    assert highlighted[4:] == [f"{highlight.RED}--- a{highlight.RESET}\n", f"{highlight.GREEN}+++ b{highlight.RESET}\n"]
+
+
+def test_pygments_diff():
+    assert "\x1b[" in highlight.diff("--- a/a\n+++ b/a\n@@ -1 +1 @@\n-a\n+b\n")
+
+
+def test_wrap_text():
+    assert highlight.wrap_text("a b c\n\nd", width=3) == "a b\nc\n\nd"
+    assert highlight.wrap_text("abcdef", width=3) == "abcdef"
+    assert highlight.wrap_text("abcdef", width=3, break_long_words=True) == "abc\ndef"
@@ -0,0 +1,79 @@
+import datetime
+import json
+
+from ci.llm import openai
+
+
+def _request(**kwargs) -> openai.ChatRequest:
+    return openai.ChatRequest(model=openai.Models.GPT_4, messages=[openai.UserMessage("Hi")], **kwargs)
+
+
+def test_request_kwargs_leave_out_unset_parameters():
+    kwargs = openai.request_kwargs(_request())
+
+    assert kwargs["messages"] == [{"role": "user", "content": "Hi"}]
+    assert kwargs["stream"] is False
+    assert not {"stop", "max_tokens", "logit_bias", "user"} & kwargs.keys()
+
+
+def test_request_kwargs_with_all_parameters():
+    request = _request(stop=["\n"], max_tokens=10, logit_bias={"1": -100}, user="me", stream=True)
+
+    kwargs = openai.request_kwargs(request)
+
+    assert (kwargs["stop"], kwargs["max_tokens"], kwargs["logit_bias"], kwargs["user"]) == (
+        ["\n"],
+        10,
+        {"1": -100},
+        "me",
+    )
+    assert kwargs["stream"] is True
+    assert json.loads(str(request))["messages"] == [{"content": "Hi", "role": "user"}]
+
+
+def test_assemble_chunks():
+    chunks = [
+        {"id": "id", "created": 1, "model": "m", "choices": [{"index": 1, "delta": {"role": "assistant"}}]},
+        {"choices": [{"index": 0, "delta": {"content": "Hel"}}, {"index": 1, "delta": {"content": "Bye"}}]},
+        {"choices": [{"index": 0, "delta": {"content": "lo"}, "finish_reason": "stop"}]},
+        {"choices": [{"index": 1, "delta": None, "finish_reason": "length"}]},
+    ]
+
+    response = openai.ChatCompletionResponse(**openai.assemble_chunks(chunks))
+
+    assert [(c.index, c.message.content, c.finish_reason) for c in response.choices] == [
+        (0, "Hello", "stop"),
+        (1, "Bye", "length"),
+    ]
+    assert response.message == openai.Message(content="Hello", role="assistant")
+    assert response.created == datetime.datetime.fromtimestamp(1)
+    assert (response.id, response.model, response.usage.total_tokens) == ("id", "m", 0)
+
+
+def test_assemble_no_chunks():
+    response = openai.assemble_chunks([])
+
+    assert response["choices"] == []
+    assert response["id"] == ""
+
+
+def test_response_from_parsed_fields():
+    created = datetime.datetime(2024, 1, 1)
+    message = openai.AssistantMessage("Hi")
+    usage = openai.ChatCompletionResponse.Usage(1, 2, 3)
+    choice = openai.ChatCompletionResponse.Choices(message=message, index=0, logprobs=None, finish_reason="stop")
+
+    response = openai.ChatCompletionResponse("id", "chat.completion", created, "m", [choice], usage, "fp")
+
+    assert (response.created, response.message, response.usage) == (created, message, usage)
+
+
+def test_chat_completion(stub, monkeypatch):
+    from ci.llm import client
+
+    monkeypatch.setattr(client, "_client", None)
+    try:
+        response = openai.chat_completion(_request())
+        assert "".join(openai.chat_completion_stream(_request())) == response.message.content
+    finally:
+        client._close_client()
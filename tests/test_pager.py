@@ -0,0 +1,77 @@
+import io
+import os
+
+import pytest
+
+from ci import pager
+
+
+class Stdout(io.StringIO):
+    def __init__(self, tty: bool, fd: int = -1):
+        super().__init__()
+        self.tty = tty
+        self.fd = fd
+
+    def isatty(self):
+        return self.tty
+
+    def fileno(self):
+        return self.fd
+
+
+@pytest.mark.parametrize("tty, enabled, command", [(False, True, None), (True, False, None), (True, True, "cat")])
+def test_output_goes_to_stdout(monkeypatch, tty, enabled, command):
+    stdout = Stdout(tty)
+    monkeypatch.setattr("sys.stdout", stdout)
+    monkeypatch.delenv("PAGER", raising=False)
+    if command:
+        monkeypatch.setenv("GIT_PAGER", command)
+
+    with pager.pager(enabled) as out:
+        out.write("text\n")
+
+    assert out is stdout
+    assert stdout.getvalue() == "text\n"
+
+
+def test_closed_stdout_is_silenced(monkeypatch, tmp_path):
+    with open(tmp_path / "out", "w") as target:
+        monkeypatch.setattr("sys.stdout", Stdout(False, target.fileno()))
+
+        with pager.pager() as out:
+            out.write("text\n")
+            raise BrokenPipeError
+
+        os.write(target.fileno(), b"dropped\n")
+
+    assert (tmp_path / "out").read_text() == ""
+
+
+def test_pager_receives_the_output(monkeypatch, tmp_path):
+    monkeypatch.setattr("sys.stdout", Stdout(True))
+    monkeypatch.setenv("GIT_PAGER", f"sh -c 'cat > {tmp_path}/out; echo $LESS >> {tmp_path}/out'")
+    monkeypatch.delenv("LESS", raising=False)
+
+    with pager.pager() as out:
+        out.write("text\n")
+
+    assert (tmp_path / "out").read_text() == "text\nFRX\n"
+
+
+def test_pager_quit_early(monkeypatch):
+    monkeypatch.setattr("sys.stdout", Stdout(True))
+    monkeypatch.setenv("GIT_PAGER", "true")
+
+    with pager.pager() as out:
+        while True:
+            out.write("text\n" * 1000)
+            out.flush()
+
+
+def test_interrupted_pager_is_stopped(monkeypatch):
+    monkeypatch.setattr("sys.stdout", Stdout(True))
+    monkeypatch.setenv("PAGER", "sleep 60")
+    monkeypatch.delenv("GIT_PAGER", raising=False)
+
+    with pager.pager():
+        raise KeyboardInterrupt
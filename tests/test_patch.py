@@ -0,0 +1,263 @@
+import pytest
+
+from ci import git, patch
+
+DIFF = """\
+commit 0123456789abcdef0123456789abcdef01234567
+
+    Message
+
+diff --git a/a.py b/a.py
+index 1111111..2222222 100644
+--- a/a.py
++++ b/a.py
+@@ -1,3 +1,3 @@ def f():
+ one
+-two
++TWO
+ three
+@@ -10,2 +10,3 @@
+ ten
++eleven
+ twelve
+diff --git a/b.bin b/b.bin
+Binary files a/b.bin and b/b.bin differ
+"""
+
+
+def test_parse():
+    parsed = patch.parse(DIFF)
+
+    assert parsed.preamble == "commit 0123456789abcdef0123456789abcdef01234567\n\n    Message\n\n"
+    assert [file.path for file in parsed.files] == ["a.py", "b.bin"]
+    assert [hunk.header for hunk in parsed.files[0].hunks] == ["@@ -1,3 +1,3 @@ def f():", "@@ -10,2 +10,3 @@"]
+    assert parsed.files[0].hunks[0].lines == [" one", "-two", "+TWO", " three"]
+    assert parsed.files[1].hunks == []
+    assert parsed.text == DIFF
+
+
+def test_parse_without_files():
+    parsed = patch.parse("not a diff\n")
+
+    assert parsed.preamble == "not a diff\n"
+    assert parsed.files == []
+
+
+def count_lines(text):
+    return text.count("\n")
+
+
+def test_chunks_pack_small_files():
+    files = ["diff --git a/a.py b/a.py\n@@ -1 +1 @@\n-a\n+b\n", "diff --git a/b.py b/b.py\n@@ -1 +1 @@\n-c\n+d\n"]
+
+    assert list(patch.chunks("".join(files), max_tokens=8, count_tokens=count_lines)) == ["".join(files)]
+    assert list(patch.chunks("".join(files), max_tokens=4, count_tokens=count_lines)) == files
+
+
+def test_chunks_repeat_the_header_of_split_files():
+    header = "diff --git a/a.py b/a.py\n--- a/a.py\n+++ b/a.py\n"
+    hunks = ["@@ -1,1 +1,1 @@\n-a\n+b\n", "@@ -10,1 +10,1 @@\n-c\n+d\n"]
+
+    assert list(patch.chunks(header + "".join(hunks), max_tokens=6, count_tokens=count_lines)) == [
+        header + hunks[0],
+        header + hunks[1],
+    ]
+
+
+def test_chunks_of_text_that_is_not_a_diff():
+    assert list(patch.chunks("a\nb\nc\n", max_tokens=2, count_tokens=count_lines)) == ["a\nb\n", "c\n"]
+    assert list(patch.chunks("", max_tokens=2)) == []
+
+
+def test_split_hunk():
+    hunk = patch.Hunk("@@ -1,4 +1,4 @@ f", [" a", "-b", "+B", " c", " d"])
+
+    pieces = list(patch.split_hunk(hunk, max_tokens=3, count_tokens=count_lines))
+
+    assert [piece.text for piece in pieces] == [
+        "@@ -1,2 +1,1 @@ f\n a\n-b\n",
+        "@@ -3,1 +2,2 @@ f\n+B\n c\n",
+        "@@ -4,1 +4,1 @@ f\n d\n",
+    ]
+
+
+def test_split_hunk_that_fits():
+    hunk = patch.Hunk("@@ -1 +1 @@", ["-a", "+b"])
+
+    assert list(patch.split_hunk(hunk, max_tokens=100)) == [hunk]
+
+
+def test_split_hunk_keeps_no_newline_marker():
+    hunk = patch.Hunk("@@ -1,2 +1,2 @@", [" a", "-b", "\\ No newline at end of file", "+c"])
+
+    pieces = list(patch.split_hunk(hunk, max_tokens=3, count_tokens=count_lines))
+
+    assert pieces[0].lines == [" a", "-b", "\\ No newline at end of file"]
+
+
+def test_split_hunk_of_invalid_header():
+    hunk = patch.Hunk("@@ invalid @@", ["+a", "+b"])
+
+    assert list(patch.split_hunk(hunk, max_tokens=2, count_tokens=count_lines)) == [
+        patch.Hunk("@@ invalid @@", ["+a"]),
+        patch.Hunk("@@ invalid @@", ["+b"]),
+    ]
+
+
+def test_shrink_context():
+    lines = [" 1", "-2", "+two", " 3", " 4", " 5", " 6", "+7", " 8"]
+    hunk = patch.Hunk("@@ -1,7 +1,8 @@ f", lines)
+
+    hunks = patch.shrink_context(hunk, context=1)
+
+    assert [h.text for h in hunks] == [
+        "@@ -1,3 +1,3 @@ f\n 1\n-2\n+two\n 3\n",
+        "@@ -6,2 +6,3 @@ f\n 6\n+7\n 8\n",
+    ]
+
+
+def test_shrink_context_of_invalid_header():
+    hunk = patch.Hunk("@@ invalid @@", [" a", "+b"])
+
+    assert patch.shrink_context(hunk, context=0) == [hunk]
+
+
+def test_fingerprint_ignores_line_numbers_and_trailing_whitespace():
+    file = patch.FileDiff(["diff --git a/a.py b/a.py"])
+    hunk = patch.Hunk("@@ -1,2 +1,2 @@", [" a", "-b", "+c"])
+    moved = patch.Hunk("@@ -5,2 +6,2 @@", [" a  ", "-b", "+c\t"])
+
+    assert patch.fingerprint(file, hunk) == patch.fingerprint(file, moved)
+
+
+def test_fingerprint_depends_on_path_and_changes():
+    file = patch.FileDiff(["diff --git a/a.py b/a.py"])
+    other = patch.FileDiff(["diff --git a/b.py b/b.py"])
+    hunk = patch.Hunk("@@ -1 +1 @@", ["-a", "+b"])
+
+    assert patch.fingerprint(file, hunk) != patch.fingerprint(other, hunk)
+    assert patch.fingerprint(file, hunk) != patch.fingerprint(file, patch.Hunk("@@ -1 +1 @@", ["-a", "+c"]))
+
+
+def test_fingerprint_of_file_header_ignores_blob_hashes():
+    file = patch.FileDiff(["diff --git a/b.bin b/b.bin", "index 1111111..2222222 100644", "Binary files differ"])
+    changed = patch.FileDiff(["diff --git a/b.bin b/b.bin", "index 3333333..4444444 100644", "Binary files differ"])
+
+    assert patch.fingerprint(file) == patch.fingerprint(changed)
+
+
+@pytest.mark.parametrize(
+    "header, path",
+    [
+        (["diff --git a/a.py b/a.py", "--- a/a.py", "+++ b/a.py"], "a.py"),
+        (["diff --git a.py a.py", "--- a.py", "+++ a.py"], "a.py"),
+        (["diff --git a/a.py b/a.py", "deleted file mode 100644", "--- a/a.py", "+++ /dev/null"], "a.py"),
+        (["diff --git a/old.py b/new.py", "rename from old.py", "rename to new.py"], "new.py"),
+        (["diff --git a/a.py b/c.py", "copy from a.py", "copy to c.py", "--- a/a.py", "+++ b/c.py"], "c.py"),
+        (["diff --git b.bin b.bin", "Binary files b.bin and b.bin differ"], "b.bin"),
+        (["diff --git x y"], ""),
+        ([], ""),
+    ],
+)
+def test_path(header, path):
+    assert patch.FileDiff(header).path == path
+
+
+@pytest.mark.parametrize("config", ["diff.noprefix=true", "diff.mnemonicPrefix=true"])
+def test_paths_of_git_diffs_ignore_prefix_settings(repo, config):
+    repo.commit("Initial", {"dir/a.py": "a\n"})
+    repo.git("config", *config.split("="))
+    repo.write("dir/a.py", "b\n")
+    repo.git("add", "dir/a.py")
+    commit_hash = repo.commit("Change")
+
+    for diff in (git.show(commit_hash), git._show(commit_hash), next(git.iter_commits(n=1)).diff.text):
+        assert [file.path for file in patch.parse(diff).files] == ["dir/a.py"]
+    repo.write("dir/a.py", "c\n")
+    repo.git("add", "dir/a.py")
+    assert [file.path for file in patch.parse(git.cached_diff().text).files] == ["dir/a.py"]
+
+
+def test_compact_keeps_metadata_of_binary_files():
+    diff = (
+        "diff --git a/old.bin b/new.bin\n"
+        "old mode 100644\n"
+        "new mode 100755\n"
+        "similarity index 90%\n"
+        "rename from old.bin\n"
+        "rename to new.bin\n"
+        "index 1111111..2222222\n"
+        "GIT binary patch\n"
+        "literal 3\n"
+        "KcmZ>Y%mDxc0RR91\n"
+    )
+
+    assert patch.compact(diff, patch.CompactOptions()) == (
+        "diff --git a/old.bin b/new.bin\n"
+        "rename old.bin => new.bin\n"
+        "old mode 100644\n"
+        "new mode 100755\n"
+        "Binary file changed\n"
+    )
+
+
+def test_compact_options_from_env(monkeypatch):
+    monkeypatch.setenv("CI_DIFF_SUMMARIZE", "*.gen,")
+    monkeypatch.setenv("CI_DIFF_DROP", "docs/*")
+    monkeypatch.setenv("CI_DIFF_MAX_FILE_LINES", "")
+    monkeypatch.setenv("CI_DIFF_CONTEXT", "3")
+
+    options = patch.CompactOptions.from_env()
+
+    assert options.summarize == [*patch.LOW_SIGNAL_GLOBS, "*.gen"]
+    assert options.drop == ["docs/*"]
+    assert (options.max_file_lines, options.context) == (None, 3)
+
+
+def test_compact_drops_and_summarizes_files():
+    diff = (
+        "diff --git a/docs/a.md b/docs/a.md\n@@ -1 +1 @@\n-a\n+b\n"
+        "diff --git a/poetry.lock b/poetry.lock\n@@ -1 +1 @@\n-a\n+b\n"
+        "diff --git a/big.py b/big.py\n@@ -1,2 +1,2 @@\n-a\n-b\n+c\n+d\n"
+        "diff --git a/space.txt b/space.txt\n@@ -1 +1 @@\n-a  b\n+a b\n"
+    )
+
+    assert patch.compact(diff, patch.CompactOptions(drop=["docs/*"], max_file_lines=3)) == (
+        "diff --git a/poetry.lock b/poetry.lock\n[+1 -1 lines not shown: matches *.lock]\n"
+        "diff --git a/big.py b/big.py\n[+2 -2 lines not shown: large file]\n"
+        "diff --git a/space.txt b/space.txt\n[+1 -1 lines not shown: whitespace only]\n"
+    )
+
+
+def test_compact_without_whitespace_and_context_reduction():
+    diff = "diff --git a/a.txt b/a.txt\n@@ -1,3 +1,3 @@\n x\n y\n-a  b\n+a b\n"
+
+    assert patch.compact(diff, patch.CompactOptions(whitespace=False, context=None)) == diff
+
+
+def test_compact_cuts_context(monkeypatch):
+    for name in ("CI_DIFF_COMPACT", "CI_DIFF_MAX_FILE_LINES", "CI_DIFF_CONTEXT"):
+        monkeypatch.delenv(name, raising=False)
+    diff = "diff --git a/a.txt b/a.txt\n@@ -1,4 +1,4 @@\n w\n x\n y\n-a\n+b\n"
+
+    assert patch.compact(diff) == "diff --git a/a.txt b/a.txt\n@@ -3,2 +3,2 @@\n y\n-a\n+b\n"
+
+
+def test_compact_disabled(monkeypatch):
+    monkeypatch.setenv("CI_DIFF_COMPACT", "0")
+
+    assert patch.compact(DIFF) == DIFF
+
+
+def test_shrink_context_keeps_no_newline_marker():
+    hunk = patch.Hunk("@@ -1,2 +1,2 @@", [" a", "-b", "+c", "\\ No newline at end of file"])
+
+    assert [h.text for h in patch.shrink_context(hunk, context=0)] == [
+        "@@ -2,1 +2,1 @@\n-b\n+c\n\\ No newline at end of file\n"
+    ]
+
+
+def test_shrink_context_of_deleted_lines():
+    hunk = patch.Hunk("@@ -1,3 +0,0 @@", ["-a", "-b", "-c"])
+
+    assert patch.shrink_context(hunk, context=1) == [hunk]
@@ -0,0 +1,200 @@
+import fcntl
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from ci import git, prefetch
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def staged(repo, stub):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.git("add", "a.txt")
+    return repo
+
+
+def test_take_without_prefetched_messages_skips_the_index(repo, monkeypatch):
+    monkeypatch.setattr(git, "write_tree", lambda: pytest.fail("The index was written as a tree"))
+
+    assert prefetch.take() is None
+
+
+def test_prefetch_and_take(staged):
+    prefetch.prefetch(history=1)
+
+    assert prefetch.take(history=1)
+    assert prefetch.take(history=1) == prefetch.take(history=1)
+
+
+def test_take_is_keyed_by_settings_and_index(staged, monkeypatch):
+    prefetch.prefetch(history=1, max_prompt_tokens=1000)
+
+    assert prefetch.take(history=1, max_prompt_tokens=1000)
+    assert prefetch.take(history=0, max_prompt_tokens=1000) is None
+    assert prefetch.take(history=1) is None
+
+    monkeypatch.setenv("CI_LLM_BACKEND", "openai")
+    assert prefetch.take(history=1, max_prompt_tokens=1000) is None
+    monkeypatch.setenv("CI_LLM_BACKEND", "stub")
+
+    staged.write("a.txt", "c\n")
+    staged.git("add", "a.txt")
+    assert prefetch.take(history=1, max_prompt_tokens=1000) is None
+
+
+def test_prefetch_without_staged_changes(repo, stub):
+    repo.commit("Initial", {"a.txt": "a\n"})
+
+    prefetch.prefetch()
+
+    assert not prefetch._prefetch_dir().exists()
+
+
+def test_prefetch_skips_messages_being_generated(staged, monkeypatch):
+    from ci.cmd import commit
+
+    directory = prefetch._prefetch_dir()
+    directory.mkdir(parents=True)
+    key = prefetch._key(0, None)
+    monkeypatch.setattr(commit, "generate_commit_msg", lambda *args: pytest.fail("Generated twice"))
+
+    with open(directory / f"{key}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        prefetch.prefetch()
+
+    assert not (directory / f"{key}.txt").exists()
+
+
+def test_prefetch_removes_stale_messages(staged):
+    directory = prefetch._prefetch_dir()
+    directory.mkdir(parents=True)
+    stale = directory / "stale.txt"
+    stale.write_text("Old message")
+    os.utime(stale, (0, 0))
+
+    prefetch.prefetch()
+
+    assert not stale.exists()
+    assert prefetch.take()
+
+
+def test_watch_backs_off_while_the_index_is_idle(staged, monkeypatch):
+    prefetched = []
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            staged.write("a.txt", "d\n")
+            staged.git("add", "a.txt")
+        if len(sleeps) == 10:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(prefetch, "prefetch", lambda *args: prefetched.append(args))
+    monkeypatch.setattr(prefetch.time, "sleep", sleep)
+
+    with pytest.raises(KeyboardInterrupt):
+        prefetch.watch(history=2, debounce=0)
+
+    assert prefetched == [(2, None), (2, None)]
+    assert sleeps == [0.5, 0.5, 1.0, 0.5, 0.5, 1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_nothing_is_prefetched_during_conflicts(staged, monkeypatch):
+    prefetch.prefetch()
+    monkeypatch.setattr(git, "write_tree", lambda: None)
+
+    assert prefetch.take() is None
+    prefetch.prefetch(history=1)
+    assert len(list(prefetch._prefetch_dir().glob("*.txt"))) == 1
+
+
+def test_prefetch_once(staged, monkeypatch):
+    from ci.cmd import commit
+
+    prefetch.prefetch()
+    monkeypatch.setattr(commit, "generate_commit_msg", lambda *args: pytest.fail("Generated twice"))
+
+    prefetch.prefetch()
+
+
+def test_prefetch_finished_while_waiting_for_the_lock(staged, monkeypatch):
+    from ci.cmd import commit
+
+    path = prefetch._prefetch_dir() / f"{prefetch._key(0, None)}.txt"
+    monkeypatch.setattr(fcntl, "flock", lambda lock, operation: path.write_text("Done"))
+    monkeypatch.setattr(commit, "generate_commit_msg", lambda *args: pytest.fail("Generated twice"))
+
+    prefetch.prefetch()
+
+    assert prefetch.take() == "Done"
+
+
+def test_start_prefetches_in_the_background(staged, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(ROOT))
+
+    prefetch.start(history=1, max_prompt_tokens=1000)
+    prefetch.start()
+
+    deadline = time.monotonic() + 30
+    while not (prefetch.take() and prefetch.take(history=1, max_prompt_tokens=1000)) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert prefetch.take() == prefetch.take(history=1, max_prompt_tokens=1000) == "Update a.txt\n\n- Change a.txt"
+
+
+def test_watch_waits_for_the_debounce(staged, monkeypatch):
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(prefetch, "prefetch", lambda *args: pytest.fail("Prefetched before the debounce"))
+    monkeypatch.setattr(prefetch.time, "sleep", sleep)
+
+    with pytest.raises(KeyboardInterrupt):
+        prefetch.watch(debounce=60)
+
+    assert sleeps == [0.5, 0.5, 0.5]
+
+
+def test_watch_without_an_index(repo, monkeypatch):
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(prefetch.time, "sleep", sleep)
+
+    with pytest.raises(KeyboardInterrupt):
+        prefetch.watch()
+
+    assert sleeps == [1.0, 2.0]
+
+
+def test_watch_logs_failures(staged, monkeypatch, caplog):
+    sleeps = []
+
+    def fail(*args):
+        raise RuntimeError("No network")
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(prefetch, "prefetch", fail)
+    monkeypatch.setattr(prefetch.time, "sleep", sleep)
+
+    with pytest.raises(KeyboardInterrupt):
+        prefetch.watch(debounce=0)
+
+    assert "Prefetch failed" in caplog.text
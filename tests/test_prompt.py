@@ -0,0 +1,75 @@
+import pytest
+
+from ci.llm import prompt, tokens
+from ci.llm.openai import SystemMessage, UserMessage
+
+
+def _builder(budget: int) -> prompt.PromptBuilder:
+    builder = prompt.PromptBuilder("gpt-4", budget=budget)
+    builder.add(SystemMessage("instruction " * 10), required=True)
+    builder.add(UserMessage("old " * 200), priority=-1, summary=[UserMessage("old summary")])
+    builder.add(UserMessage("recent " * 100), priority=0)
+    builder.add(UserMessage("diff " * 100), required=True)
+    return builder
+
+
+def test_keeps_everything_within_budget():
+    builder = _builder(10_000)
+
+    assert builder.build() == [section.messages[0] for section in builder.sections]
+
+
+def test_summarizes_lowest_priority_first():
+    builder = _builder(500)
+
+    messages = builder.build()
+
+    assert [message.content for message in messages][1] == "old summary"
+    assert len(messages) == 4
+    assert tokens.count_messages(messages, "gpt-4") <= 500
+
+
+def test_drops_sections_that_do_not_fit():
+    builder = _builder(200)
+
+    messages = builder.build()
+
+    assert [message.content.split()[0] for message in messages] == ["instruction", "diff"]
+
+
+def test_truncates_required_sections_last():
+    builder = _builder(50)
+
+    messages = builder.build()
+
+    assert messages[-1].content.endswith("[...]\n")
+    assert tokens.count_messages(messages, "gpt-4") <= 50
+
+
+def test_truncates_everything_if_the_budget_is_too_small():
+    builder = prompt.PromptBuilder("gpt-4", budget=5)
+    builder.add(required=True)
+    builder.add(UserMessage("first " * 100), required=True)
+    builder.add(UserMessage("second " * 100), required=True)
+
+    messages = builder.build()
+
+    assert [message.content for message in messages] == ["\n[...]\n", "\n[...]\n"]
+
+
+def test_count_matches_the_messages():
+    builder = _builder(10_000)
+    messages = [message for section in builder.sections for message in section.messages]
+
+    assert builder.count() == tokens.count_messages(messages, "gpt-4")
+
+
+def test_budget_is_capped_by_the_context_window():
+    assert prompt.PromptBuilder("gpt-4").budget == tokens.context_window("gpt-4") - prompt.COMPLETION_RESERVE
+    assert prompt.PromptBuilder("gpt-4-1106-preview").budget == prompt.DEFAULT_BUDGET
+
+
+@pytest.mark.parametrize("budget", [0, -1])
+def test_rejects_non_positive_budgets(budget):
+    with pytest.raises(ValueError):
+        prompt.PromptBuilder("gpt-4", budget=budget)
@@ -0,0 +1,82 @@
+import asyncio
+import types
+
+import pytest
+
+from ci.llm import ratelimit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(ratelimit, "asyncio", types.SimpleNamespace(sleep=clock.sleep, Lock=asyncio.Lock))
+    return clock
+
+
+def test_burst_is_not_delayed(clock):
+    limiter = ratelimit.RateLimiter(per_minute=60, burst=3)
+
+    async def main():
+        for _ in range(3):
+            await limiter.acquire()
+
+    asyncio.run(main())
+
+    assert clock.sleeps == []
+
+
+def test_waits_for_refill(clock):
+    limiter = ratelimit.RateLimiter(per_minute=60)
+
+    async def main():
+        for _ in range(3):
+            await limiter.acquire()
+
+    asyncio.run(main())
+
+    assert clock.sleeps == pytest.approx([1.0, 1.0])
+
+
+def test_refills_over_time(clock):
+    limiter = ratelimit.RateLimiter(per_minute=60)
+
+    async def main():
+        await limiter.acquire()
+        clock.now += 0.5
+        await limiter.acquire()
+
+    asyncio.run(main())
+
+    assert clock.sleeps == pytest.approx([0.5])
+
+
+def test_amounts_above_burst_wait_for_full_bucket(clock):
+    limiter = ratelimit.RateLimiter(per_minute=600, burst=10)
+
+    async def main():
+        await limiter.acquire(10)
+        await limiter.acquire(1_000)
+
+    asyncio.run(main())
+
+    assert clock.sleeps == pytest.approx([1.0])
+
+
+@pytest.mark.parametrize("per_minute", [0, -1])
+def test_rejects_non_positive_rates(per_minute):
+    with pytest.raises(ValueError):
+        ratelimit.RateLimiter(per_minute)
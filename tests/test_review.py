@@ -0,0 +1,310 @@
+import dataclasses
+import json
+
+import pytest
+
+from ci.cmd import review
+
+
+@pytest.mark.parametrize(
+    "line, label, text",
+    [
+        ("[H1]", "H1", ""),
+        ("[H12] Off by one", "H12", "Off by one"),
+        ("### [H2]", "H2", ""),
+        ("**[H3]**: Missing check", "H3", "Missing check"),
+        ("- [H4]", None, None),
+        ("[general]", "general", ""),
+        ("See [H1] above", None, None),
+    ],
+)
+def test_hunk_label(line, label, text):
+    match = review.HUNK_LABEL.match(line)
+
+    if label is None:
+        assert match is None
+    else:
+        assert match is not None
+        assert match.groups() == (label, text)
+
+
+def test_split_findings():
+    text = "Overall fine.\n\n[H1]\n- Off by one\n\n**[H2]**: Missing check\n[general]\nAdd tests."
+
+    findings = review._split_findings(text)
+
+    assert findings == {
+        "general": "Overall fine.\n\nAdd tests.",
+        "H1": "- Off by one",
+        "H2": "Missing check",
+    }
+
+
+def test_split_findings_without_issues():
+    assert review._split_findings("Looks good to me.") == {"general": ""}
+
+
+def test_relabel():
+    done = []
+    chunks = ["[H", "1] Off by one\n", "[general]\nAdd", " tests."]
+
+    relabeled = "".join(review._relabel(chunks, {"H1": "a.py:10", "general": "General"}, done.append))
+
+    assert relabeled == "### a.py:10\n\nOff by one\n### General\n\nAdd tests."
+    assert done == ["".join(chunks)]
+
+
+def test_checkpoint_key_depends_on_backend_and_options():
+    options = review.ChunkOptions()
+    key = review.checkpoint_key("openai", "gpt-4", 0.2, options)
+
+    assert key == review.checkpoint_key("openai", "gpt-4", 0.2, review.ChunkOptions())
+    assert key != review.checkpoint_key("stub", "gpt-4", 0.2, options)
+    assert key != review.checkpoint_key("openai", "gpt-4", 0.2, review.ChunkOptions(chunk_tokens=1_000))
+
+
+@pytest.fixture
+def range_client(monkeypatch, stub):
+    """
+    A client whose backend is the stub under another name, so range
+    reviews are checkpointed.
+    """
+    from ci.llm import client
+    from ci.llm import stub as stub_backend
+
+    backend = stub_backend.StubBackend()
+    backend.name = "test"
+    llm = client.Client(backend=backend)
+    monkeypatch.setattr(client, "get_client", lambda: llm)
+    yield backend
+    llm.close()
+
+
+def test_commit_range_rejects_single_revisions(repo):
+    repo.commit("First", {"a.txt": "a\n"})
+
+    with pytest.raises(ValueError):
+        review.commit_range("HEAD")
+
+
+def test_commit_range_resumes_from_checkpoints(repo, range_client, capsys):
+    base = repo.commit("Base", {"a.txt": "a\n"})
+    repo.commit("Second", {"b.txt": "b\n"})
+    repo.commit("Third", {"c.txt": "c\n"})
+
+    assert review.commit_range(f"{base}..HEAD") == []
+    assert range_client.requests == 2
+    assert "Reviewing 2 of 2 commits" in capsys.readouterr().err
+
+    assert review.commit_range(f"{base}..HEAD") == []
+    assert range_client.requests == 2
+    assert "Update c.txt" in capsys.readouterr().out
+
+    review.commit_range(f"{base}..HEAD", restart=True)
+    assert range_client.requests == 4
+
+
+def test_commit_range_carries_on_after_failures(repo, range_client, monkeypatch, capsys):
+    monkeypatch.setenv("CI_MAX_ATTEMPTS", "1")
+    range_client.config.fail_first = 1
+    base = repo.commit("Base", {"a.txt": "a\n"})
+    repo.commit("Second", {"b.txt": "b\n"})
+    repo.commit("Third", {"c.txt": "c\n"})
+
+    failed = review.commit_range(f"{base}..HEAD", workers=1)
+
+    assert len(failed) == 1
+    assert "failed" in capsys.readouterr().err
+
+    # Only the failed commit is reviewed again.
+    assert review.commit_range(f"{base}..HEAD") == []
+    assert range_client.requests == 3
+
+
+def test_commit_range_reviews_large_commits_in_chunks(repo, range_client):
+    base = repo.commit("Base", {"a.txt": "a\n", "b.txt": "b\n"})
+    repo.commit("Both", {"a.txt": "c\n", "b.txt": "d\n"})
+    repo.commit("One", {"a.txt": "e\n"})
+
+    assert review.commit_range(f"{base}..HEAD", options=review.ChunkOptions(threshold=1, chunk_tokens=25)) == []
+    # Two chunks and their merge, and a single chunk.
+    assert range_client.requests == 4
+
+
+def test_commit_range_of_the_stub_is_not_checkpointed(repo, stub, capsys):
+    base = repo.commit("Base", {"a.txt": "a\n"})
+    repo.commit("Second", {"a.txt": "b\n"})
+
+    review.commit_range(f"{base}..HEAD")
+    review.commit_range(f"{base}..HEAD")
+
+    assert capsys.readouterr().err.count("Reviewing 1 of 1 commits") == 2
+
+
+def test_files_reviews_and_caches(repo, stub, monkeypatch, capsys):
+    from ci.llm import cache
+
+    monkeypatch.setattr(cache, "enabled", True)
+    repo.write("a.py", "def f():\n    return 1\n")
+    repo.write("b.bin", "\0")
+
+    review.files(["a.py", "b.bin"])
+    assert "Reviewing 1 of 1 files" in capsys.readouterr().err
+
+    review.files(["a.py"])
+    captured = capsys.readouterr()
+    assert "Reviewing" not in captured.err
+    assert "a.py" in captured.out
+    assert cache.get_cache(cache.REVIEWS).stats().hits == 1
+
+
+def test_files_splits_large_files(repo, stub, capsys):
+    repo.write("a.py", "def f():\n    return 1\n\n\ndef g():\n    return 2\n")
+
+    review.files(["a.py"], review.ChunkOptions(threshold=5, chunk_tokens=8))
+
+    assert "Lines 1-4" in capsys.readouterr().out
+
+
+def test_file(repo, stub, capsys):
+    repo.write("a.py", "def f():\n    return 1\n")
+
+    review.file("a.py")
+
+    assert "# a.py" in capsys.readouterr().out
+
+
+def test_ask_for_code_review(stub):
+    assert review.ask_for_code_review("def f():\n    return 1\n")
+
+
+def test_files_without_text_files(repo, stub):
+    repo.write("b.bin", "\0")
+
+    with pytest.raises(ValueError):
+        review.files(["b.bin"])
+
+
+def test_incremental_review_reuses_unchanged_hunks(repo, stub, monkeypatch, capsys):
+    from ci.llm import cache
+
+    monkeypatch.setattr(cache, "enabled", True)
+    repo.commit("Initial", {"a.py": "a = 1\n", "b.py": "b = 1\n"})
+    repo.write("a.py", "a = 2\n")
+    repo.write("b.py", "b = 2\n")
+    diff = repo.git("diff") + "\n"
+
+    "".join(review.incremental_review(diff))
+    completions = cache.get_cache().stats()
+    "".join(review.incremental_review(diff))
+
+    assert "All 2 hunks are unchanged since their review." in capsys.readouterr().err
+    # Hunk lookups are not completion lookups.
+    assert cache.get_cache().stats() == completions
+    assert cache.get_cache(cache.REVIEWS).stats().hits == 3
+
+
+TWO_FILES = (
+    "diff --git a/a.txt b/a.txt\n--- a/a.txt\n+++ b/a.txt\n@@ -1 +1 @@\n-a\n+b\n"
+    "diff --git a/b.txt b/b.txt\n--- a/b.txt\n+++ b/b.txt\n@@ -1 +1 @@\n-c\n+d\n"
+)
+
+
+CALL = "diff --git a/main.py b/main.py\n--- a/main.py\n+++ b/main.py\n@@ -0,0 +1,1 @@\n+parse_config('x')\n"
+
+
+@pytest.fixture
+def indexed(repo):
+    from ci import symbol_index
+
+    repo.commit("Add helpers", {"helpers.py": "def parse_config(path):\n    return path\n"})
+    symbol_index.get_index().update()
+
+
+def test_review_diff_sends_related_code(indexed, stub, monkeypatch):
+    from ci.llm import openai
+
+    requests = []
+    monkeypatch.setattr(openai, "chat_completion_stream", lambda request: requests.append(request) or iter(["Done"]))
+
+    assert "".join(review.review_diff(CALL)) == "Done"
+    assert [type(message) for message in requests[0].messages] == [
+        openai.SystemMessage,
+        openai.UserMessage,
+        openai.UserMessage,
+    ]
+    assert "helpers.py:1-2 (function parse_config)" in requests[0].messages[1].content
+    assert requests[0].messages[2].content == CALL
+
+
+def test_ask_for_review(indexed, stub):
+    assert review.ask_for_review(CALL)
+
+
+def test_map_reduce_review_merges_the_reviews_of_chunks(repo, stub, monkeypatch, capsys):
+    from ci.llm import openai
+
+    requests = []
+    stream = openai.chat_completion_stream
+    monkeypatch.setattr(openai, "chat_completion_stream", lambda request: requests.append(request) or stream(request))
+
+    merged = "".join(review.map_reduce_review(TWO_FILES, review.ChunkOptions(chunk_tokens=20, context_tokens=0)))
+
+    assert "Reviewing 2 chunks" in capsys.readouterr().err
+    assert merged
+    assert requests[0].messages[0].content == review.REDUCE_INSTRUCTION
+    assert requests[0].messages[1].content.startswith("# Review of part 1 of 2\n\n")
+
+
+def test_relabel_of_a_complete_last_line():
+    done = []
+
+    assert (
+        "".join(review._relabel(["[H1] Off by one\n"], {"H1": "a.py:10"}, done.append)) == "### a.py:10\n\nOff by one\n"
+    )
+    assert done == ["[H1] Off by one\n"]
+
+
+def test_incremental_review_of_text_without_hunks(stub):
+    assert "".join(review.incremental_review("not a diff\n"))
+
+
+@pytest.fixture
+def hunks(repo):
+    """
+    The diff of a binary file and of two hunks of a text file.
+    """
+    lines = [f"line {i}" for i in range(20)]
+    repo.commit("Initial", {"a.py": "\n".join(lines) + "\n", "b.bin": "\0a"})
+    repo.write("a.py", "\n".join(["first", *lines[1:-1], "last"]) + "\n")
+    repo.write("b.bin", "\0b")
+    return repo.git("diff") + "\n"
+
+
+def test_incremental_review_in_batches(hunks, stub, capsys):
+    options = review.ChunkOptions(threshold=1, context_tokens=0)
+
+    assert "".join(review.incremental_review(hunks, options)).startswith("### General\n\n")
+    assert "Reviewing 3 hunks in 1 batches" in capsys.readouterr().err
+
+    "".join(review.incremental_review(hunks, dataclasses.replace(options, chunk_tokens=40)))
+    assert "Reviewing 3 hunks in 2 batches" in capsys.readouterr().err
+
+
+def test_incremental_review_of_changed_hunks(repo, hunks, stub, tmp_path, monkeypatch, capsys):
+    from ci.llm import cache
+
+    responses = tmp_path / "responses.json"
+    responses.write_text(json.dumps(["[H1]\nOff by one\n[general]\nAdd tests."]))
+    monkeypatch.setenv("CI_STUB_RESPONSES", str(responses))
+    monkeypatch.setattr(cache, "enabled", True)
+    "".join(review.incremental_review(hunks))
+
+    lines = [f"line {i}" for i in range(20)]
+    repo.write("a.py", "\n".join(["first", *lines[1:-1], "end"]) + "\n")
+    changed = "".join(review.incremental_review(repo.git("diff") + "\n"))
+
+    assert "Reviewing 1 of 3 hunks, the others are unchanged." in capsys.readouterr().err
+    assert changed.startswith("## Unchanged hunks\n\n### a.py:1\n\nOff by one\n\n## Changed hunks\n\n")
+    # The comments on the whole diff were made on a hunk that changed.
+    assert changed.count("Add tests.") == 1
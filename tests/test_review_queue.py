@@ -0,0 +1,275 @@
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from ci import git, review_queue
+from ci.cmd import hook, notes
+
+ROOT = Path(__file__).resolve().parent.parent
+
+LOCK_AND_SLEEP = """
+import fcntl, sys, time
+lock = open(sys.argv[1], "w")
+fcntl.flock(lock, fcntl.LOCK_EX)
+print("locked", flush=True)
+time.sleep(60)
+"""
+
+
+@pytest.fixture
+def queue(repo, stub, monkeypatch):
+    monkeypatch.setattr(review_queue, "DEBOUNCE", 0)
+    repo.commit("Initial", {"a.py": "a = 1\n"})
+    return repo
+
+
+def test_enqueue_and_pending(queue):
+    assert review_queue.pending() == {}
+
+    review_queue.enqueue("a" * 40)
+    review_queue.enqueue("b" * 40)
+    os.rename(review_queue.queue_dir() / f"{'b' * 40}.job", review_queue.queue_dir() / f"{'b' * 40}.running")
+
+    assert review_queue.pending() == {"a" * 40: "queued", "b" * 40: "running"}
+
+
+def test_worker_slots(queue, monkeypatch):
+    monkeypatch.setenv("CI_HOOK_WORKERS", "1")
+    directory = review_queue.queue_dir()
+    directory.mkdir(parents=True)
+
+    with review_queue._worker_slot(directory) as first:
+        with review_queue._worker_slot(directory) as second:
+            assert (first, second) == (True, False)
+    with review_queue._worker_slot(directory) as again:
+        assert again
+
+
+def test_worker_slot_of_a_killed_worker_is_free(queue, monkeypatch):
+    monkeypatch.setenv("CI_HOOK_WORKERS", "1")
+    directory = review_queue.queue_dir()
+    directory.mkdir(parents=True)
+    holder = subprocess.Popen(
+        [sys.executable, "-c", LOCK_AND_SLEEP, directory / "worker-0.lock"], stdout=subprocess.PIPE
+    )
+    holder.stdout.readline()
+    with review_queue._worker_slot(directory) as acquired:
+        assert not acquired
+    holder.kill()
+    holder.wait()
+
+    with review_queue._worker_slot(directory) as acquired:
+        assert acquired
+
+
+def test_superseded_commits(queue):
+    head = git.rev_parse("HEAD")
+    assert not review_queue._is_superseded(head)
+
+    queue.git("commit", "--quiet", "--amend", "-m", "Amended")
+    assert review_queue._is_superseded(head)
+    assert review_queue._is_superseded("0" * 40)
+
+    queue.git("checkout", "--quiet", "--detach", head)
+    assert not review_queue._is_superseded(head)
+
+
+def test_next_job_drops_late_and_superseded_jobs(queue, monkeypatch):
+    directory = review_queue.queue_dir()
+    amended = git.rev_parse("HEAD")
+    queue.git("commit", "--quiet", "--amend", "-m", "Amended")
+    head = git.rev_parse("HEAD")
+    review_queue.enqueue(amended)
+    review_queue.enqueue(head)
+    (directory / "late.job").write_text(json.dumps({"commit": "c" * 40, "queued_at": 0}))
+    (directory / "crashed.running").write_text(json.dumps({"commit": "d" * 40, "queued_at": 0}))
+    (directory / "broken.job").write_text("{")
+
+    path, job = review_queue._next_job(directory)
+
+    assert job["commit"] == head
+    assert path == directory / f"{head}.running"
+    assert sorted(p.name for p in directory.iterdir()) == sorted(["broken.job", f"{head}.running"])
+    assert review_queue._next_job(directory) is None
+
+
+def test_next_job_of_superseded_commits(queue):
+    amended = git.rev_parse("HEAD")
+    queue.git("commit", "--quiet", "--amend", "-m", "Amended")
+    review_queue.enqueue(amended)
+
+    assert review_queue._next_job(review_queue.queue_dir()) is None
+    assert list(review_queue.queue_dir().iterdir()) == []
+
+
+def test_next_job_claimed_by_another_worker(queue, monkeypatch):
+    directory = review_queue.queue_dir()
+    first = git.rev_parse("HEAD")
+    second = queue.commit("Second", {"a.py": "a = 2\n"})
+    review_queue.enqueue(first)
+    review_queue.enqueue(second)
+    rename = os.rename
+
+    def claimed(src, dst):
+        if Path(src).name == f"{first}.job":
+            Path(src).unlink()
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", claimed)
+
+    path, job = review_queue._next_job(directory)
+
+    assert (path, job["commit"]) == (directory / f"{second}.running", second)
+    assert not (directory / f"{first}.running").exists()
+
+
+def test_next_job_waits_for_the_queue_to_settle(queue, monkeypatch):
+    monkeypatch.setattr(review_queue, "DEBOUNCE", 0.2)
+    review_queue.enqueue(git.rev_parse("HEAD"))
+
+    started = time.monotonic()
+    assert review_queue._next_job(review_queue.queue_dir()) is not None
+    assert time.monotonic() - started >= 0.15
+
+
+def test_work_reviews_into_notes(queue, capsys):
+    first = git.rev_parse("HEAD")
+    second = queue.commit("Second", {"a.py": "a = 2\n"})
+    review_queue.enqueue(first)
+    review_queue.enqueue(second)
+
+    review_queue.work()
+
+    assert set(git.notes()) == {first, second}
+    assert review_queue.pending() == {}
+
+    notes.notes()
+    out = capsys.readouterr().out
+    assert f"{second[:7]} Second" in out
+    assert f"{first[:7]} Initial" in out
+
+
+def test_work_skips_reviewed_commits(queue, monkeypatch):
+    from ci.cmd import review
+
+    head = git.rev_parse("HEAD")
+    git.add_note(head, "Reviewed before")
+    monkeypatch.setattr(review, "commit", lambda *args, **kwargs: pytest.fail("Reviewed again"))
+    review_queue.enqueue(head)
+
+    review_queue.work()
+
+    assert review_queue.pending() == {}
+
+
+def test_work_skips_superseded_commits(queue, caplog):
+    caplog.set_level(logging.INFO)
+    review_queue._review("0" * 40, time.time())
+
+    assert "amended or rebased" in caplog.text
+
+
+def test_work_picks_up_commits_queued_while_releasing_its_slot(queue, monkeypatch):
+    first = git.rev_parse("HEAD")
+    second = queue.commit("Second", {"a.py": "a = 2\n"})
+    worker_slot = review_queue._worker_slot
+
+    @contextlib.contextmanager
+    def slot(directory):
+        with worker_slot(directory) as acquired:
+            yield acquired
+        if second not in review_queue.pending() and second not in git.notes():
+            review_queue.enqueue(second)
+
+    monkeypatch.setattr(review_queue, "_worker_slot", slot)
+    review_queue.enqueue(first)
+
+    review_queue.work()
+
+    assert set(git.notes()) == {first, second}
+
+
+def test_work_aborts_reviews_at_their_deadline(queue, monkeypatch, caplog):
+    from ci.cmd import review
+
+    monkeypatch.setenv("CI_HOOK_DEADLINE", "0.2")
+    monkeypatch.setattr(review, "commit", lambda *args, **kwargs: time.sleep(5))
+    review_queue.enqueue(git.rev_parse("HEAD"))
+
+    started = time.monotonic()
+    review_queue.work()
+
+    assert time.monotonic() - started < 4
+    assert "missed its deadline" in caplog.text
+    assert git.notes() == {}
+    assert review_queue.pending() == {}
+
+
+def test_work_returns_when_all_slots_are_taken(queue, monkeypatch):
+    monkeypatch.setenv("CI_HOOK_WORKERS", "1")
+    review_queue.enqueue(git.rev_parse("HEAD"))
+
+    with review_queue._worker_slot(review_queue.queue_dir()):
+        review_queue.work()
+
+    assert review_queue.pending() == {git.rev_parse("HEAD"): "queued"}
+
+
+def test_notes_without_reviews(queue, capsys):
+    review_queue.enqueue(git.rev_parse("HEAD"))
+    notes.notes()
+    assert "Review queued." in capsys.readouterr().out
+
+    review_queue.queue_dir().joinpath(f"{git.rev_parse('HEAD')}.job").unlink()
+    notes.notes()
+    assert "No reviews" in capsys.readouterr().err
+
+
+def test_hook_install_and_uninstall(repo):
+    path = hook.install()
+    assert hook.MARKER in path.read_text()
+    assert os.access(path, os.X_OK)
+    assert hook.uninstall()
+    assert not hook.uninstall()
+
+    path.write_text("#!/bin/sh\n")
+    with pytest.raises(FileExistsError):
+        hook.install()
+    assert not hook.uninstall()
+    hook.install(force=True)
+    assert hook.MARKER in path.read_text()
+
+
+def test_hook_reviews_new_commits_in_the_background(queue, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(ROOT))
+    monkeypatch.setenv("CI_NO_CACHE", "1")
+    hook.install()
+
+    commit_hash = queue.commit("Hooked", {"a.py": "a = 3\n"})
+
+    # The worker waits for `review_queue.DEBOUNCE` seconds in its own process.
+    deadline = time.monotonic() + 30
+    while commit_hash not in git.notes() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert commit_hash in git.notes()
+    log = review_queue.queue_dir() / "worker.log"
+    assert f"Reviewed {commit_hash}" in log.read_text()
+
+
+def test_worker_rotates_its_log(queue):
+    log = review_queue.queue_dir() / "worker.log"
+    log.parent.mkdir(parents=True)
+    log.write_text("x" * (review_queue.MAX_LOG_BYTES + 1))
+
+    subprocess.run(
+        [sys.executable, "-m", "ci.review_queue"], env={**os.environ, "PYTHONPATH": str(ROOT)}, check=True, timeout=30
+    )
+
+    assert log.stat().st_size < review_queue.MAX_LOG_BYTES
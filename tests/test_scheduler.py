@@ -0,0 +1,243 @@
+import asyncio
+
+import openai
+import pytest
+
+from ci.llm import scheduler
+
+
+def _scheduler(**policy) -> scheduler.Scheduler:
+    return scheduler.Scheduler(policy=scheduler.Policy(base_delay=0, max_delay=0, **policy))
+
+
+def test_retries_transient_errors():
+    s = _scheduler()
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise openai.error.RateLimitError("Slow down")
+        return "ok"
+
+    assert asyncio.run(s.run(call)) == "ok"
+    assert len(attempts) == 3
+    assert (s.metrics.requests, s.metrics.attempts, s.metrics.retries, s.metrics.failures) == (1, 3, 2, 0)
+
+
+def test_gives_up_after_max_attempts():
+    s = _scheduler(max_attempts=2)
+
+    async def call():
+        raise openai.error.APIError("Bad gateway", http_status=502)
+
+    with pytest.raises(openai.error.APIError):
+        asyncio.run(s.run(call))
+    assert (s.metrics.attempts, s.metrics.retries, s.metrics.failures) == (2, 1, 1)
+
+
+def test_does_not_retry_client_errors():
+    s = _scheduler()
+
+    async def call():
+        raise openai.error.InvalidRequestError("Bad request", param=None)
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(s.run(call))
+    assert (s.metrics.attempts, s.metrics.retries, s.metrics.failures) == (1, 0, 1)
+
+
+def test_times_out_attempts():
+    s = _scheduler(max_attempts=2, timeout=0.01)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) == 1:
+            await asyncio.sleep(10)
+        return "ok"
+
+    assert asyncio.run(s.run(call)) == "ok"
+    assert s.metrics.retries == 1
+
+
+def test_hedges_slow_attempts():
+    s = _scheduler(hedge_after=0.01)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+            return "slow"
+        return "hedged"
+
+    assert asyncio.run(s.run(call)) == "hedged"
+    assert s.metrics.hedges == 1
+    assert s.metrics.attempts == 1
+
+
+def test_does_not_hedge_fast_attempts():
+    s = _scheduler(hedge_after=10)
+
+    async def call():
+        return "ok"
+
+    assert asyncio.run(s.run(call)) == "ok"
+    assert s.metrics.hedges == 0
+
+
+def test_is_retryable():
+    assert scheduler.is_retryable(openai.error.APIConnectionError("Reset"))
+    assert scheduler.is_retryable(openai.error.APIError("Server error", http_status=500))
+    assert not scheduler.is_retryable(openai.error.APIError("Not found", http_status=404))
+    assert not scheduler.is_retryable(ValueError())
+
+
+def test_hedge_waits_for_the_rate_limit_within_the_timeout():
+    s = scheduler.Scheduler(
+        requests_per_minute=1, policy=scheduler.Policy(max_attempts=1, timeout=0.05, hedge_after=0.01)
+    )
+
+    async def call():
+        await asyncio.sleep(10)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(s.run(call), 1))
+    assert s.metrics.hedges == 1
+
+
+def test_discards_results_of_losing_hedges():
+    s = _scheduler(hedge_after=0.01)
+    discarded = []
+
+    async def main():
+        event = asyncio.Event()
+        calls = []
+
+        async def call():
+            calls.append(len(calls) + 1)
+            number = calls[-1]
+            if number == 2:
+                event.set()
+            await event.wait()
+            return number
+
+        async def discard(result):
+            discarded.append(result)
+
+        return await s.run(call, discard=discard)
+
+    result = asyncio.run(main())
+
+    assert discarded == [{1: 2, 2: 1}[result]]
+
+
+@pytest.mark.parametrize("max_attempts", ["0", "-1"])
+def test_rejects_fewer_than_one_attempt(monkeypatch, max_attempts):
+    monkeypatch.setenv("CI_MAX_ATTEMPTS", max_attempts)
+
+    with pytest.raises(ValueError):
+        scheduler.Policy.from_env()
+
+
+def test_policy_from_env(monkeypatch):
+    monkeypatch.setenv("CI_REQUEST_TIMEOUT", "")
+    monkeypatch.setenv("CI_HEDGE_AFTER", "2.5")
+
+    policy = scheduler.Policy.from_env()
+
+    assert (policy.timeout, policy.deadline, policy.hedge_after) == (None, 300.0, 2.5)
+
+
+def test_metrics():
+    metrics = scheduler.Metrics(requests=2, attempts=3, queue_wait=[0.0, 1.0], service_time=[2.0])
+
+    assert metrics.summary()["queue_wait"] == {"p50": 0.5, "p95": 0.95}
+    assert metrics.summary()["service_time"] == {"p50": 2.0, "p95": 2.0}
+    assert str(scheduler.Metrics()) == (
+        "0 requests, 0 attempts, 0 retries, 0 hedges, 0 failures, "
+        "queue wait p50 0.00s p95 0.00s, service time p50 0.00s p95 0.00s"
+    )
+
+
+def test_retry_after():
+    assert scheduler._retry_after(openai.error.RateLimitError("Slow down", headers={"retry-after": "2"})) == 2
+    assert scheduler._retry_after(openai.error.RateLimitError("Slow down", headers={"retry-after": "soon"})) == 0
+    assert scheduler._retry_after(ValueError()) == 0
+
+
+def test_without_deadline():
+    s = _scheduler(deadline=None, timeout=None)
+
+    async def call():
+        return "ok"
+
+    assert asyncio.run(s.run(call)) == "ok"
+
+
+def test_deadline_exceeded():
+    s = _scheduler(deadline=0)
+
+    async def call():
+        return "ok"
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(s.run(call))
+
+
+def test_does_not_retry_past_the_deadline():
+    s = _scheduler(deadline=1)
+
+    async def call():
+        raise openai.error.RateLimitError("Slow down", headers={"retry-after": "5"})
+
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(s.run(call))
+    assert (s.metrics.attempts, s.metrics.retries, s.metrics.failures) == (1, 0, 1)
+
+
+def test_hedged_attempts_that_all_fail():
+    s = _scheduler(max_attempts=1, hedge_after=0.01)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+        raise ValueError(f"Attempt {len(calls)}")
+
+    with pytest.raises(ValueError):
+        asyncio.run(s.run(call))
+    assert s.metrics.hedges == 1
+
+
+def test_hedged_attempts_time_out():
+    s = _scheduler(max_attempts=1, timeout=0.05, hedge_after=0.01)
+
+    async def call():
+        await asyncio.sleep(10)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(s.run(call))
+    assert s.metrics.hedges == 1
+
+
+def test_scheduler_from_env(monkeypatch):
+    monkeypatch.setenv("CI_REQUESTS_PER_MINUTE", "120")
+    monkeypatch.setenv("CI_TOKENS_PER_MINUTE", "1000")
+    monkeypatch.setenv("CI_MAX_ATTEMPTS", "2")
+
+    s = scheduler.Scheduler.from_env()
+    assert (s.requests.rate, s.tokens.rate, s.policy.max_attempts) == (2, 1000 / 60, 2)
+    assert scheduler.Scheduler.from_env(requests_per_minute=60).requests.rate == 1
+
+
+def test_requests_count_against_the_token_limit():
+    s = _scheduler()
+
+    async def call():
+        return "ok"
+
+    assert asyncio.run(s.run(call, tokens=1000)) == "ok"
+    assert s.tokens._tokens < s.tokens.capacity
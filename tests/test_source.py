@@ -0,0 +1,92 @@
+from pathlib import Path
+
+import pytest
+
+from ci import source
+
+
+def test_expand(repo):
+    repo.write("a.py", "a\n")
+    repo.write("pkg/b.py", "b\n")
+    repo.write("pkg/c.txt", "c\n")
+    repo.write("ignored.py", "i\n")
+    repo.write(".gitignore", "ignored.py\n")
+
+    assert source.expand(["pkg"]) == [Path("pkg/b.py"), Path("pkg/c.txt")]
+    assert source.expand(["**/*.py", "a.py"]) == [Path("a.py"), Path("ignored.py"), Path("pkg/b.py")]
+    assert Path("ignored.py") not in source.expand(["."])
+
+
+def test_expand_outside_repository(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dir" / ".hidden").mkdir(parents=True)
+    (tmp_path / "dir" / "a.py").write_text("a\n")
+    (tmp_path / "dir" / ".hidden" / "b.py").write_text("b\n")
+
+    assert source.expand(["dir"]) == [Path("dir/a.py")]
+
+
+@pytest.mark.parametrize("path", ["missing.py", "*.missing"])
+def test_expand_reports_missing_paths(repo, path):
+    repo.write("a.py", "a\n")
+
+    with pytest.raises(FileNotFoundError, match="missing"):
+        source.expand(["a.py", path])
+
+
+def test_read_text(tmp_path):
+    (tmp_path / "text").write_text("text\n")
+    (tmp_path / "binary").write_bytes(b"a\0b")
+    (tmp_path / "latin1").write_bytes("é".encode("latin-1"))
+
+    assert source.read_text(tmp_path / "text") == "text\n"
+    assert source.read_text(tmp_path / "binary") is None
+    assert source.read_text(tmp_path / "latin1") is None
+
+
+PYTHON = '''\
+import os
+
+
+@decorator
+def first():
+    return 1
+
+
+class Second:
+    x = """
+def not_a_boundary():
+"""
+'''
+
+
+def test_boundaries():
+    assert source.boundaries(PYTHON, Path("a.py")) == [0, 3, 8]
+    assert source.boundaries("fn main() {\n}\n\npub struct A;\n", Path("a.rs")) == [0, 3]
+    assert source.boundaries("@decorator\ndef f(): pass\n") == [0]
+    assert source.boundaries("def broken(:\n", Path("a.py")) == [0]
+
+
+def test_split():
+    segments = source.split(PYTHON, max_tokens=5, path=Path("a.py"), count_tokens=lambda text: text.count("\n"))
+
+    assert [(s.start, s.end) for s in segments] == [(1, 3), (4, 8), (9, 12)]
+    assert "".join(s.text for s in segments) == PYTHON
+
+
+def test_split_large_definitions_between_lines():
+    text = "def f():\n" + "    x = 1\n" * 5
+
+    segments = source.split(text, max_tokens=2, path=Path("a.py"), count_tokens=lambda text: text.count("\n"))
+
+    assert [(s.start, s.end) for s in segments] == [(1, 2), (3, 4), (5, 6)]
+
+
+def test_split_without_a_final_newline():
+    segments = source.split("a = 1\nb = 2", max_tokens=10, path=Path("a.py"))
+
+    assert [(s.start, s.end, s.text) for s in segments] == [(1, 2, "a = 1\nb = 2\n")]
+
+
+def test_split_empty_text():
+    assert source.split("", 10) == []
@@ -0,0 +1,134 @@
+import subprocess
+
+import pytest
+
+from ci import git, highlight
+from ci.cmd import status
+
+
+def _render(*args, **kwargs) -> str:
+    return "".join(status.render(git.iter_status_records(*args, **kwargs), git.show_prefix()))
+
+
+def test_no_commits_yet(repo):
+    assert _render(branch=True) == "On branch main\n\nNo commits yet\n\nnothing to commit, working tree clean\n"
+
+
+def test_sections(repo):
+    repo.commit("Initial", {"a.txt": "a\n", "b.txt": "b\n", "c.txt": "c\n"})
+    repo.write("a.txt", "staged\n")
+    repo.git("add", "a.txt")
+    repo.write("a.txt", "unstaged\n")
+    repo.git("mv", "b.txt", "d.txt")
+    (repo.path / "c.txt").unlink()
+    repo.write("dir/new.txt", "new\n")
+
+    assert _render(branch=True) == (
+        "On branch main\n"
+        "\nChanges to be committed:\n"
+        "\tmodified:   a.txt\n"
+        "\trenamed:    b.txt -> d.txt\n"
+        "\nChanges not staged for commit:\n"
+        "\tmodified:   a.txt\n"
+        "\tdeleted:    c.txt\n"
+        "\nUntracked files:\n"
+        "\tdir/\n"
+    )
+    assert _render(["dir"], untracked="all") == "\nUntracked files:\n\tdir/new.txt\n"
+
+
+def test_paths_are_relative_to_the_current_directory(repo, monkeypatch):
+    repo.commit("Initial", {"dir/a.txt": "a\n", "b.txt": "b\n"})
+    repo.git("mv", "b.txt", "dir/b.txt")
+    repo.write("dir/sub/new.txt", "new\n")
+    monkeypatch.chdir(repo.path / "dir")
+
+    assert _render() == (
+        "\nChanges to be committed:\n" "\trenamed:    ../b.txt -> b.txt\n" "\nUntracked files:\n" "\tsub/\n"
+    )
+
+
+def test_conflicts(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.git("checkout", "--quiet", "-b", "other")
+    repo.commit("Other", {"a.txt": "other\n"})
+    repo.git("checkout", "--quiet", "main")
+    repo.commit("Main", {"a.txt": "main\n"})
+    subprocess.run(["git", "merge", "--quiet", "other"], cwd=repo.path, capture_output=True)
+
+    assert "\nUnmerged paths:\n\tboth modified:   a.txt\n" in _render()
+
+
+def test_detached_head(repo):
+    commit_hash = repo.commit("Initial", {"a.txt": "a\n"})
+    repo.git("checkout", "--quiet", "--detach")
+
+    assert _render(branch=True).startswith(f"HEAD detached at {commit_hash[:7]}\n")
+
+
+def test_stash_header_is_ignored(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.git("stash", "--quiet")
+    repo.git("config", "status.showStash", "true")
+
+    assert _render(branch=True) == "On branch main\n\nnothing to commit, working tree clean\n"
+
+
+def test_status_entries(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+    repo.write("b.txt", "b\n")
+
+    assert [(entry.kind, entry.path) for entry in git.status_entries()] == [("1", "a.txt"), ("?", "b.txt")]
+    assert not git.has_staged_changes()
+
+
+@pytest.fixture
+def clone(repo, tmp_path, monkeypatch):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    path = tmp_path / "clone"
+    subprocess.run(["git", "clone", "--quiet", str(repo.path), str(path)], check=True)
+    monkeypatch.chdir(path)
+    return path
+
+
+def test_upstream(repo, clone):
+    def branch() -> str:
+        return _render(branch=True).split("\n\n")[0]
+
+    assert branch() == "On branch main\nYour branch is up to date with 'origin/main'."
+
+    subprocess.run(["git", "commit", "--quiet", "--allow-empty", "-m", "Ahead"], check=True)
+    assert branch() == "On branch main\nYour branch is ahead of 'origin/main' by 1 commit."
+
+    repo.commit("Behind")
+    repo.commit("Behind")
+    subprocess.run(["git", "fetch", "--quiet"], check=True)
+    assert branch() == "On branch main\nYour branch and 'origin/main' have diverged, by 1 and 2 commits."
+
+    subprocess.run(["git", "reset", "--quiet", "--hard", "HEAD^"], check=True)
+    assert branch() == "On branch main\nYour branch is behind 'origin/main' by 2 commits."
+
+
+def test_status_command(repo, capsys, monkeypatch):
+    repo.commit("Initial", {"a.txt": "a\n", "b.txt": "b\n"})
+    repo.write("a.txt", "changed\n")
+    repo.write("b.txt", "changed\n")
+    monkeypatch.setattr(highlight, "iter_git_status", lambda lines: lines)
+
+    status.status("a.txt")
+
+    assert capsys.readouterr().out == "On branch main\n\nChanges not staged for commit:\n\tmodified:   a.txt\n"
+
+    status.status(None, untracked="no")
+
+    assert capsys.readouterr().out.endswith("\tmodified:   a.txt\n\tmodified:   b.txt\n")
+
+
+def test_git_status_output(repo):
+    repo.commit("Initial", {"a.txt": "a\n"})
+    repo.write("a.txt", "b\n")
+
+    assert "modified:   a.txt" in git.status("a.txt")
+    assert "On branch main" in git.status(None)
@@ -0,0 +1,195 @@
+import asyncio
+import functools
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import openai
+import pytest
+
+from ci.llm import backend, stub
+
+ROOT = Path(__file__).resolve().parent.parent
+
+REQUEST = {
+    "model": "gpt-4",
+    "messages": [
+        {"role": "system", "content": "Review"},
+        {"role": "user", "content": "diff --git a/a.py b/a.py\n+1\ndiff --git a/b.py b/b.py\n+2\n"},
+    ],
+}
+
+
+def test_config_from_env(tmp_path, monkeypatch):
+    responses = tmp_path / "responses.json"
+    responses.write_text(json.dumps(["Looks good to me"]))
+    monkeypatch.setenv("CI_STUB_RESPONSES", str(responses))
+    monkeypatch.setenv("CI_STUB_LATENCY", "0.5")
+    monkeypatch.setenv("CI_STUB_FAIL_FIRST", "2")
+
+    config = stub.StubConfig.from_env()
+
+    assert (config.latency, config.fail_first, config.responses) == (0.5, 2, ["Looks good to me"])
+    assert stub.StubConfig.from_env().seed == 0
+
+
+@pytest.mark.parametrize("content", ["[]", '{"a": 1}', "[1]"])
+def test_load_responses_rejects_other_json(tmp_path, content):
+    path = tmp_path / "responses.json"
+    path.write_text(content)
+
+    with pytest.raises(ValueError):
+        stub.load_responses(path)
+
+
+def test_synthesize():
+    assert stub.synthesize(REQUEST["messages"], "abcdef123") == "Update a.py, b.py\n\n- Change a.py\n- Change b.py"
+    many = "".join(f"diff --git a/{i}.py b/{i}.py\n" for i in range(5))
+    assert stub.synthesize([{"role": "user", "content": many}], "d").startswith("Update 0.py, 1.py, 2.py and 2 more\n")
+    assert stub.synthesize([], "abcdef123") == "Respond to request abcdef1"
+
+
+def test_responses_are_deterministic():
+    first = stub.StubBackend().response({**REQUEST, "n": 2})
+    second = stub.StubBackend().response({**REQUEST, "n": 2})
+
+    assert first["choices"] == second["choices"]
+    assert first["choices"][1]["message"]["content"].endswith("(candidate 2)")
+    assert first["usage"]["total_tokens"] > 0
+
+
+def test_canned_responses():
+    backend = stub.StubBackend(stub.StubConfig(responses=["One", "Two"]))
+
+    contents = {c["message"]["content"] for c in backend.response({**REQUEST, "n": 2})["choices"]}
+
+    assert contents == {"One", "Two"}
+
+
+def test_chunks_add_up_to_the_response():
+    backend = stub.StubBackend()
+    response = backend.response(REQUEST)
+
+    chunks = backend.chunks(response)
+
+    assert chunks[0]["choices"][0]["delta"]["role"] == "assistant"
+    assert "role" not in chunks[1]["choices"][0]["delta"]
+    assert "".join(c["choices"][0]["delta"]["content"] for c in chunks) == response["choices"][0]["message"]["content"]
+
+
+def test_errors():
+    backend = stub.StubBackend(stub.StubConfig(fail_first=1))
+    assert isinstance(backend.error(), (openai.error.RateLimitError, openai.error.ServiceUnavailableError))
+    assert backend.error() is None
+    assert backend.requests == 2
+
+    always = stub.StubBackend(stub.StubConfig(error_rate=1))
+    errors = {type(always.error()) for _ in range(20)}
+    assert errors == {openai.error.RateLimitError, openai.error.ServiceUnavailableError}
+
+
+def test_create_and_stream():
+    backend = stub.StubBackend(stub.StubConfig(chunk_latency=0.001, fail_first=1))
+
+    async def run():
+        with pytest.raises(openai.error.OpenAIError):
+            await backend.create(REQUEST)
+        response = await backend.create(REQUEST)
+        chunks = [chunk async for chunk in await backend.stream(REQUEST)]
+        await backend.aclose()
+        return response, chunks
+
+    response, chunks = asyncio.run(run())
+
+    assert "".join(c["choices"][0]["delta"]["content"] for c in chunks) == response["choices"][0]["message"]["content"]
+
+
+def test_get_backend(monkeypatch):
+    monkeypatch.setenv("CI_LLM_BACKEND", "stub")
+    assert backend.get_backend().name == "stub"
+    assert backend.get_backend("openai").name == "openai"
+    with pytest.raises(ValueError, match="Unknown LLM backend"):
+        backend.get_backend("other")
+
+
+def test_openai_backend_against_the_stub_server(monkeypatch):
+    from aiohttp import test_utils, web
+
+    server_backend = stub.StubBackend(stub.StubConfig(fail_first=1))
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", functools.partial(stub._handle, server_backend))
+
+    async def run():
+        async with test_utils.TestServer(app) as server:
+            monkeypatch.setattr(openai, "api_base", str(server.make_url("/v1")))
+            monkeypatch.setattr(openai, "api_key", "stub")
+            client = backend.OpenAIBackend()
+            try:
+                with pytest.raises(openai.error.OpenAIError):
+                    await client.create(REQUEST)
+                response = await client.create(REQUEST)
+                chunks = [chunk async for chunk in await client.stream(REQUEST)]
+            finally:
+                await client.aclose()
+        return response, chunks
+
+    response, chunks = asyncio.run(run())
+
+    expected = stub.StubBackend().response(REQUEST)["choices"][0]["message"]["content"]
+    assert response["choices"][0]["message"]["content"] == expected
+    assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks) == expected
+
+
+def test_openai_backend_closes_without_a_session():
+    client = backend.OpenAIBackend()
+    asyncio.run(client.aclose())
+    assert client._session is None
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve(*args: str) -> dict:
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "ci.llm.stub", "--port", str(port), *args],
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        stderr=subprocess.DEVNULL,
+    )
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/v1/chat/completions",
+        data=json.dumps(REQUEST).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                with urllib.request.urlopen(request) as response:
+                    body = json.load(response)
+                break
+            except urllib.error.URLError:
+                assert time.monotonic() < deadline
+                time.sleep(0.1)
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(timeout=30)
+    return body["choices"][0]["message"]["content"]
+
+
+def test_serve(tmp_path):
+    responses = tmp_path / "responses.json"
+    responses.write_text(json.dumps(["Looks good to me"]))
+    args = ["--latency", "0", "--chunk-latency", "0", "--error-rate", "0", "--responses", str(responses)]
+    assert _serve(*args) == "Looks good to me"
+    assert _serve() == stub.StubBackend().response(REQUEST)["choices"][0]["message"]["content"]
@@ -0,0 +1,300 @@
+import os
+import sqlite3
+import subprocess
+import threading
+
+import pytest
+
+from ci import git, symbol_index
+from ci.cmd import review
+
+HELPERS = '''\
+import os
+
+
+def parse_config(path):
+    return os.path.basename(path)
+
+
+class Loader:
+    def load(self):
+        return parse_config("x")
+'''
+
+MAIN = '''\
+from helpers import parse_config
+
+
+def main():
+    return parse_config("main.cfg")
+'''
+
+
+@pytest.fixture
+def index(repo, tmp_path):
+    repo.commit("Add helpers", {"helpers.py": HELPERS, "main.py": MAIN, "lib.rs": "pub fn render() {\n}\n"})
+    index = symbol_index.SymbolIndex(tmp_path / "symbols.sqlite3")
+    index.update()
+    return index
+
+
+def test_python_symbols():
+    symbols, refs = symbol_index._python_symbols(HELPERS)
+
+    assert symbols == [
+        ("parse_config", "function", 4, 5),
+        ("Loader", "class", 8, 10),
+        ("load", "method", 9, 10),
+    ]
+    assert ("parse_config", 8, 10) in refs
+    assert symbol_index._python_symbols("def broken(:\n") == (None, [])
+
+
+def test_python_symbols_skip_what_is_not_a_definition():
+    symbols, _ = symbol_index._python_symbols("class A:\n    x = 1\n\n\na, b = 1, 2\nc: int = 3\n")
+
+    assert symbols == [("A", "class", 1, 2), ("c", "variable", 6, 6)]
+
+
+def test_text_symbols():
+    assert symbol_index._text_symbols("pub fn render() {\n}\n\nstruct A;\n") == [
+        ("render", "definition", 1, 3),
+        ("A", "definition", 4, 5),
+    ]
+
+
+def test_update(repo, index):
+    assert index.commit() == git.resolve("HEAD")
+    assert index.definitions(["parse_config", "render", "missing"]) == {
+        "parse_config": [("helpers.py", "function", 4, 5)],
+        "render": [("lib.rs", "definition", 1, 3)],
+    }
+    assert index.definitions_at("helpers.py", 9, 9) == ["Loader", "load"]
+    assert sorted(index.references("parse_config")) == [("helpers.py", 8, 10), ("main.py", 4, 5)]
+    assert index.search(["basename"])[0][0] == "helpers.py"
+    assert index.search(['"']) == []
+    assert index.read("helpers.py", 4, 5) == "def parse_config(path):\n    return os.path.basename(path)\n"
+    assert index.read("missing.py", 1, 1) is None
+
+    repo.git("rm", "-q", "lib.rs")
+    repo.commit("Rename", {"main.py": MAIN.replace("main()", "run()")})
+    index.update()
+
+    assert index.commit() == git.resolve("HEAD")
+    assert "render" not in index.definitions(["render"])
+    assert index.definitions(["run"]) == {"run": [("main.py", "function", 4, 5)]}
+
+
+def test_update_without_head(repo, tmp_path):
+    index = symbol_index.SymbolIndex(tmp_path / "symbols.sqlite3")
+    index.update()
+
+    assert index.commit() is None
+
+
+def test_update_when_up_to_date(index, monkeypatch):
+    monkeypatch.setattr(symbol_index, "_diff_tree", None)
+    index.update()
+
+    assert index.commit() == git.resolve("HEAD")
+
+
+def test_update_rolls_back_on_failure(repo, tmp_path, monkeypatch):
+    repo.commit("First", {"a.py": "a = 1\n", "b.py": "b = 1\n"})
+    index = symbol_index.SymbolIndex(tmp_path / "symbols.sqlite3")
+
+    def fail(self, path, blob, worker):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(symbol_index.SymbolIndex, "_add", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        index.update()
+
+    assert index.commit() is None
+    assert index._db.execute("SELECT COUNT(*) FROM files").fetchone() == (0,)
+
+
+def test_update_skips_large_binary_and_linked_files(repo, tmp_path, monkeypatch):
+    monkeypatch.setattr(symbol_index, "MAX_FILE_BYTES", 64)
+    repo.write("data.bin", "def data():\0\n")
+    os.symlink("a.py", "link.py")
+    repo.commit("First", {"a.py": "def a():\n    pass\n", "large.py": "def large():\n" + "    pass\n" * 10})
+    index = symbol_index.SymbolIndex(tmp_path / "symbols.sqlite3")
+    index.update()
+
+    assert index.commit() == git.resolve("HEAD")
+    assert index.definitions(["a", "data", "large"]) == {"a": [("a.py", "function", 1, 2)]}
+    assert [row[0] for row in index._db.execute("SELECT path FROM files ORDER BY path")] == [
+        "a.py",
+        "data.bin",
+        "large.py",
+    ]
+
+
+def test_read_missing_blob(index, monkeypatch):
+    class Worker:
+        def read(self, name):
+            return None
+
+    monkeypatch.setattr(symbol_index.catfile, "get_catfile", Worker)
+
+    assert index.read("helpers.py", 4, 5) is None
+
+
+def test_update_is_bounded(repo, tmp_path, monkeypatch):
+    monkeypatch.setattr(symbol_index, "MAX_UPDATE_FILES", 1)
+    repo.commit("Add files", {"a.py": "def a():\n    pass\n", "b.py": "def b():\n    pass\n"})
+    index = symbol_index.SymbolIndex(tmp_path / "symbols.sqlite3")
+
+    index.update()
+    assert index.commit() is None
+    assert len(index.definitions(["a", "b"])) == 1
+
+    index.update()
+    assert index.commit() == git.resolve("HEAD")
+    assert len(index.definitions(["a", "b"])) == 2
+
+
+def test_get_index_outside_a_repository(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert symbol_index.get_index() is None
+    assert symbol_index.refresh() is None
+    assert symbol_index.context("diff --git a/a.py b/a.py\n", 1_000, "gpt-4", "old") == ""
+
+
+def test_get_index_disabled(repo, monkeypatch):
+    monkeypatch.setattr(symbol_index, "_indexes", {})
+    repo.write(".git/ci-cache", "not a directory\n")
+
+    assert symbol_index.get_index() is None
+    assert symbol_index._indexes == {git.cache_dir() / "symbols.sqlite3": None}
+
+
+def test_side(repo):
+    first = repo.commit("First", {"a.py": "a = 1\n"})
+    repo.commit("Second", {"a.py": "a = 2\n"})
+
+    assert symbol_index.side("diff --git a/a.py b/a.py\n") == "old"
+    assert symbol_index.side(git.show("HEAD")) == "new"
+    assert symbol_index.side(git.show(first)) is None
+
+
+def test_related_leaves_out_code_the_diff_shows(index):
+    diff = git.show("HEAD")
+    head = symbol_index.related(index, diff, "new")
+    other = symbol_index.related(index, diff, None)
+
+    assert ("helpers.py", 4, 5) not in [(s.path, s.start, s.end) for s in head]
+    assert ("helpers.py", 4, 5, "function parse_config") in [(s.path, s.start, s.end, s.reason) for s in other]
+
+
+def test_changes_count_only_changed_lines():
+    diff = "diff --git a/a.py b/a.py\n@@ -1,2 +1,2 @@\n context_name()\n-old_name()\n+new_name()\n"
+    ranges, identifiers = symbol_index._changes(diff, "new")
+
+    assert ranges == {"a.py": [(1, 2)]}
+    assert set(identifiers) == {"old_name", "new_name"}
+
+
+def test_related_leaves_out_ambiguous_definitions(index, monkeypatch):
+    monkeypatch.setattr(symbol_index, "MAX_DEFINITIONS_PER_NAME", 0)
+    changed = "diff --git a/helpers.py b/helpers.py\n@@ -20,1 +20,1 @@\n+parse_config('x')\n"
+    other = "diff --git a/other.py b/other.py\n@@ -20,1 +20,1 @@\n+parse_config('x')\n"
+
+    assert ("helpers.py", 4, 5, "function parse_config") in [
+        (s.path, s.start, s.end, s.reason) for s in symbol_index.related(index, changed, "old")
+    ]
+    assert "function parse_config" not in [s.reason for s in symbol_index.related(index, other, "old")]
+
+
+def test_context_uses_the_index_and_refreshes_it_in_the_background(repo):
+    repo.commit("Add helpers", {"helpers.py": HELPERS})
+    diff = "diff --git a/main.py b/main.py\n@@ -1,0 +1,1 @@\n+parse_config('x')\n"
+
+    # The first review does not wait for the index to be built.
+    assert symbol_index.context(diff, 1_000, "gpt-4", "old") == ""
+    for thread in threading.enumerate():
+        if thread.name == "ci-symbols-update":
+            thread.join()
+
+    context = symbol_index.context(diff, 1_000, "gpt-4", "old")
+
+    assert "helpers.py:4-5 (function parse_config)" in context
+    assert "def parse_config(path):" in context
+    assert symbol_index.context(diff, 0, "gpt-4", "old") == ""
+
+
+def test_context_is_bounded(repo):
+    body = "    value = 1\n" * 200
+    repo.commit("Add helpers", {"helpers.py": f"def first():\n{body}\n\ndef second():\n{body}"})
+    symbol_index.get_index().update()
+    diff = "diff --git a/main.py b/main.py\n@@ -1,0 +1,2 @@\n+first()\n+second()\n"
+
+    context = symbol_index.context(diff, 150, "gpt-4", "old")
+
+    assert context.startswith("helpers.py:1-")
+    assert context.endswith("\n[...]\n")
+    assert "second" not in context.split("\n", 1)[0]
+    assert "helpers.py:" not in context.split("\n", 1)[1]
+
+
+def test_context_leaves_out_what_cannot_be_read(repo, monkeypatch):
+    repo.commit("Add helpers", {"helpers.py": HELPERS})
+    symbol_index.get_index().update()
+    diff = "diff --git a/main.py b/main.py\n@@ -1,0 +1,1 @@\n+parse_config('x')\n"
+    monkeypatch.setattr(symbol_index.SymbolIndex, "read", lambda self, path, start, end: None)
+
+    assert symbol_index.context(diff, 1_000, "gpt-4", "old") == ""
+
+
+def test_context_failures_are_ignored(repo, monkeypatch):
+    repo.commit("Add helpers", {"helpers.py": HELPERS})
+    symbol_index.get_index().update()
+
+    def fail(index, diff, side):
+        raise sqlite3.DatabaseError("database disk image is malformed")
+
+    monkeypatch.setattr(symbol_index, "related", fail)
+
+    assert symbol_index.context("diff --git a/main.py b/main.py\n", 1_000, "gpt-4", "old") == ""
+
+
+def test_refresh_runs_once_per_index(repo):
+    repo.commit("First", {"a.py": "a = 1\n"})
+    index = symbol_index.get_index()
+    symbol_index._refreshing.add(index.path)
+    try:
+        assert symbol_index.refresh() is None
+    finally:
+        symbol_index._refreshing.discard(index.path)
+
+    thread = symbol_index.refresh()
+    thread.join()
+
+    assert index.commit() == git.resolve("HEAD")
+
+
+def test_refresh_failures_are_ignored(repo, monkeypatch):
+    repo.commit("First", {"a.py": "a = 1\n"})
+
+    def fail(self):
+        raise subprocess.CalledProcessError(1, "git")
+
+    monkeypatch.setattr(symbol_index.SymbolIndex, "update", fail)
+    symbol_index.refresh().join()
+
+    assert symbol_index._refreshing == set()
+
+
+def test_chunks_of_an_older_commit_are_not_matched_against_head(repo, monkeypatch):
+    first = repo.commit("First", {"a.py": "a = 1\n", "b.py": "b = 1\n"})
+    repo.commit("Second", {"a.py": "a = 2\n"})
+    sides = []
+    monkeypatch.setattr(symbol_index, "context", lambda diff, max_tokens, model, side: sides.append(side) or "")
+
+    options = review.ChunkOptions(chunk_tokens=20)
+    requests = review._chunk_requests(git.show(first), options, "gpt-4", 0.2)
+
+    assert len(requests) == 2
+    assert sides == [None, None]
@@ -0,0 +1,176 @@
+import json
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from ci import ag, telemetry
+from ci.cmd import stats
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    path = tmp_path / "telemetry.jsonl"
+    monkeypatch.setenv("CI_TELEMETRY_FILE", str(path))
+    monkeypatch.setattr(telemetry, "enabled", True)
+    monkeypatch.setattr(telemetry, "_buffer", [])
+    registered = []
+    monkeypatch.setattr(telemetry, "_registered", False)
+    monkeypatch.setattr(telemetry.atexit, "register", registered.append)
+    return path
+
+
+def test_enabled_in_env(monkeypatch):
+    monkeypatch.setenv("CI_TELEMETRY", "1")
+    assert telemetry.enabled_in_env()
+    monkeypatch.setenv("CI_TELEMETRY", "0")
+    assert not telemetry.enabled_in_env()
+
+
+def test_telemetry_file(monkeypatch):
+    monkeypatch.delenv("CI_TELEMETRY_FILE", raising=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", "/cache")
+    assert str(telemetry.telemetry_file()) == "/cache/ci/telemetry.jsonl"
+
+
+def test_spans_are_buffered_and_flushed(recording):
+    with telemetry.span("git diff", args="--cached") as s:
+        s.set(bytes=10)
+    with pytest.raises(KeyError):
+        with telemetry.span("failing"):
+            raise KeyError("x")
+
+    def generate():
+        with telemetry.span("generator"):
+            yield 1
+            yield 2
+
+    iterator = generate()
+    next(iterator)
+    iterator.close()
+
+    assert telemetry._registered
+    assert not recording.exists()
+    telemetry.flush()
+    telemetry.flush()
+
+    spans = list(telemetry.read())
+    assert [span["name"] for span in spans] == ["git diff", "failing", "generator"]
+    assert spans[0]["attributes"] == {"args": "--cached", "bytes": 10}
+    assert spans[1]["attributes"] == {"error": "KeyError"}
+    assert spans[2]["attributes"] == {"cancelled": True}
+    assert {span["run"] for span in spans} == {telemetry.RUN_ID}
+
+
+def test_spans_are_not_recorded_when_disabled(recording, monkeypatch):
+    monkeypatch.setattr(telemetry, "enabled", False)
+    with telemetry.span("git diff"):
+        pass
+    telemetry.flush()
+
+    assert not recording.exists()
+
+
+def test_flush_drops_the_oldest_half_of_large_files(recording, monkeypatch):
+    monkeypatch.setattr(telemetry, "MAX_BYTES", 500)
+    for i in range(10):
+        with telemetry.span(f"span {i}"):
+            pass
+    telemetry.flush()
+
+    assert [span["name"] for span in telemetry.read()] == [f"span {i}" for i in range(5, 10)]
+
+
+def test_flush_ignores_unwritable_files(recording, monkeypatch, tmp_path):
+    (tmp_path / "file").write_text("")
+    monkeypatch.setenv("CI_TELEMETRY_FILE", str(tmp_path / "file" / "telemetry.jsonl"))
+    with telemetry.span("git diff"):
+        pass
+
+    telemetry.flush()
+
+    assert telemetry._buffer == []
+
+
+def test_read_skips_broken_lines_and_filters_by_start(recording):
+    recording.write_text('{"name": "old", "start": 1}\n{"name": "cut\n{"name": "new", "start": 5}\n')
+
+    assert [span["name"] for span in telemetry.read(since=2)] == ["new"]
+    assert len(list(telemetry.read())) == 2
+    telemetry.clear()
+    assert list(telemetry.read()) == []
+    telemetry.clear()
+
+
+def _span(name, duration_ms, run="r", **attributes):
+    return {"run": run, "name": name, "start": 0, "duration_ms": duration_ms, "attributes": attributes}
+
+
+SPANS = [
+    _span("git diff", 10),
+    _span("git diff", 30, run="s", error="CalledProcessError"),
+    _span("llm.chat_completion", 1000, model="gpt-4", prompt_tokens=1000, completion_tokens=100, ttft_ms=200),
+    _span("llm.chat_completion", 2000, model="gpt-4", prompt_tokens=1000, completion_tokens=100, ttft_ms=400),
+    _span("llm.chat_completion", 1, model="gpt-4", cached=True),
+    _span("llm.chat_completion", 5, model="gpt-4", error="RateLimitError"),
+    _span("llm.chat_completion", 5, model="stub", backend="stub", prompt_tokens=10, completion_tokens=1),
+]
+
+
+def test_summarize():
+    summary = stats.summarize(SPANS)
+
+    assert summary["runs"] == 2
+    assert summary["stages"]["git diff"] == {"count": 2, "p50_ms": 20.0, "p95_ms": 29.0, "total_ms": 40.0, "errors": 1}
+    gpt4 = summary["models"]["gpt-4"]
+    assert (gpt4["requests"], gpt4["cached"], gpt4["prompt_tokens"], gpt4["completion_tokens"]) == (3, 1, 2000, 200)
+    assert gpt4["cost_usd"] > 0
+    assert (gpt4["ttft_p50_ms"], gpt4["ttft_p95_ms"]) == (300.0, 390.0)
+    assert summary["models"]["stub"]["cost_usd"] == 0
+    assert "ttft_p50_ms" not in summary["models"]["stub"]
+
+
+def test_percentile():
+    assert stats._percentile([], 50) == 0.0
+    assert stats._percentile([7.0], 95) == 7.0
+
+
+def test_stats(recording, capsys):
+    stats.stats()
+    assert "No telemetry recorded" in capsys.readouterr().out
+
+    recording.write_text("".join(json.dumps({**span, "start": 2e9}) + "\n" for span in SPANS))
+    stats.stats()
+    out = capsys.readouterr().out
+    assert out.startswith("2 runs\n")
+    assert "llm.chat_completion" in out
+    assert "gpt-4" in out
+
+    stats.stats(days=1, as_json=True)
+    assert json.loads(capsys.readouterr().out)["runs"] == 2
+
+
+def test_stats_without_completions(recording, capsys):
+    recording.write_text(json.dumps(SPANS[0]) + "\n")
+
+    stats.stats()
+
+    assert "model" not in capsys.readouterr().out
+
+
+def test_ag_runs_are_recorded_as_spans(recording):
+    result = CliRunner().invoke(ag.cli, ["stats", "--json"])
+    assert json.loads(result.output) == stats.summarize([])
+
+    telemetry.flush()
+    assert [span["name"] for span in telemetry.read()] == ["ag stats"]
+
+    assert CliRunner().invoke(ag.cli, ["stats", "--clear"]).exit_code == 0
+    assert not recording.exists()
+
+
+def test_trace_without_subcommand(recording):
+    with click.Context(ag.cli) as ctx:
+        ag._trace(ctx)
+
+    assert telemetry._buffer[0]["name"] == "ag"
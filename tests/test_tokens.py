@@ -0,0 +1,64 @@
+import types
+
+import pytest
+
+from ci.llm import tokens
+
+
+@pytest.fixture
+def offline_tiktoken(monkeypatch):
+    calls = []
+
+    def encoding_for_model(model):
+        calls.append(model)
+        raise ConnectionError("No network")
+
+    monkeypatch.setattr(tokens, "tiktoken", types.SimpleNamespace(encoding_for_model=encoding_for_model))
+    tokens._encoding.cache_clear()
+    yield calls
+    tokens._encoding.cache_clear()
+
+
+class CharEncoding:
+    """
+    Encodes every character as a token.
+    """
+
+    def encode(self, text, disallowed_special):
+        return [ord(c) for c in text]
+
+    def decode(self, encoded):
+        return "".join(map(chr, encoded))
+
+
+@pytest.fixture
+def char_tiktoken(monkeypatch):
+    def encoding_for_model(model):
+        raise KeyError(model)
+
+    fake = types.SimpleNamespace(encoding_for_model=encoding_for_model, get_encoding=lambda name: CharEncoding())
+    monkeypatch.setattr(tokens, "tiktoken", fake)
+    tokens._encoding.cache_clear()
+    yield
+    tokens._encoding.cache_clear()
+
+
+def test_count_falls_back_to_estimate_once(offline_tiktoken):
+    assert tokens.count("x" * 40, "gpt-4") == tokens.estimate("x" * 40)
+    assert tokens.count("y" * 40, "gpt-4") == 10
+    assert offline_tiktoken == ["gpt-4"]
+
+
+def test_truncate_without_tokenizer(offline_tiktoken):
+    assert tokens.truncate("x" * 100, 10, "gpt-4", marker="!") == "x" * 36 + "!"
+    assert tokens.truncate("short", 10, "gpt-4") == "short"
+
+
+def test_count_and_truncate_with_tokenizer(char_tiktoken):
+    assert tokens.count("x" * 40, "unknown") == 40
+    assert tokens.truncate("x" * 100, 10, "unknown", marker="!") == "x" * 9 + "!"
+
+
+def test_cost():
+    assert tokens.cost("gpt-4", 1_000, 1_000) == pytest.approx(0.09)
+    assert tokens.cost("unknown", 1_000, 1_000) == 0